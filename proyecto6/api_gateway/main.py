@@ -1,7 +1,15 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
+import anyio
+import asyncio
+import hashlib
 import httpx
+import math
 import os
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -30,51 +38,463 @@ SERVICES = {
     "notification": "http://localhost:8004"
 }
 
+# Configuración del pool de conexiones hacia cada servicio
+POOL_MAX_CONNECTIONS = int(os.getenv("GATEWAY_POOL_MAX_CONNECTIONS", "100"))
+POOL_MAX_KEEPALIVE = int(os.getenv("GATEWAY_POOL_MAX_KEEPALIVE", "20"))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("GATEWAY_POOL_KEEPALIVE_EXPIRY", "30"))
+DEFAULT_TIMEOUT = float(os.getenv("GATEWAY_TIMEOUT", "10"))
+
+# Timeout por servicio, p. ej. GATEWAY_TIMEOUT_LOAN=30
+SERVICE_TIMEOUTS = {
+    service: float(os.getenv(f"GATEWAY_TIMEOUT_{service.upper()}", DEFAULT_TIMEOUT))
+    for service in SERVICES
+}
+
+# Un cliente (y por tanto un pool de conexiones keep-alive) por servicio
+clients: dict[str, httpx.AsyncClient] = {}
+
+# Contadores de uso de cada pool
+pool_stats = {
+    service: {"requests": 0, "errors": 0, "in_flight": 0, "max_in_flight": 0}
+    for service in SERVICES
+}
+
+def create_client(service: str) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=SERVICES[service],
+        timeout=httpx.Timeout(SERVICE_TIMEOUTS[service]),
+        limits=httpx.Limits(
+            max_connections=POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=POOL_MAX_KEEPALIVE,
+            keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+def get_client(service: str) -> httpx.AsyncClient:
+    # Los clientes se crean al arrancar; si aún no existen (p. ej. en pruebas
+    # sin evento de inicio) se crean bajo demanda
+    client = clients.get(service)
+    if client is None or client.is_closed:
+        client = clients[service] = create_client(service)
+    return client
+
+@app.on_event("startup")
+async def open_clients():
+    for service in SERVICES:
+        get_client(service)
+    global health_task
+    health_task = asyncio.create_task(health_prober())
+
+@app.on_event("shutdown")
+async def close_clients():
+    if health_task is not None:
+        health_task.cancel()
+    for client in clients.values():
+        await client.aclose()
+    clients.clear()
+
+def open_connections(client: httpx.AsyncClient) -> int:
+    # httpx no expone el pool de forma pública; se consulta el de httpcore si está disponible
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    return len(getattr(pool, "connections", []))
+
+# Cabeceras hop-by-hop que no deben reenviarse entre cliente, gateway y servicio
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "transfer-encoding", "upgrade", "host",
+}
+
+def filter_headers(headers) -> dict:
+    return {key: value for key, value in headers.items() if key.lower() not in HOP_BY_HOP_HEADERS}
+
+# Configuración de los circuit breakers
+BREAKER_WINDOW = int(os.getenv("GATEWAY_BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("GATEWAY_BREAKER_MIN_CALLS", "5"))
+BREAKER_ERROR_RATE = float(os.getenv("GATEWAY_BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_CALL_SECONDS = float(os.getenv("GATEWAY_BREAKER_SLOW_CALL_SECONDS", "5"))
+BREAKER_SLOW_RATE = float(os.getenv("GATEWAY_BREAKER_SLOW_RATE", "0.8"))
+BREAKER_OPEN_SECONDS = float(os.getenv("GATEWAY_BREAKER_OPEN_SECONDS", "30"))
+BREAKER_HALF_OPEN_CALLS = int(os.getenv("GATEWAY_BREAKER_HALF_OPEN_CALLS", "1"))
+
+class CircuitBreaker:
+    """Circuit breaker por servicio con estados closed, open y half_open.
+
+    Se abre cuando, en la ventana de las últimas llamadas, la tasa de errores
+    o de llamadas lentas supera el umbral. Mientras está abierto las peticiones
+    fallan de inmediato; pasado BREAKER_OPEN_SECONDS deja pasar unas pocas
+    llamadas de prueba que deciden si se cierra o se vuelve a abrir.
+    """
+
+    def __init__(self, service: str):
+        self.service = service
+        self.state = "closed"
+        self.calls = deque(maxlen=BREAKER_WINDOW)
+        self.opened_at = None
+        self.half_open_calls = 0
+        self.times_opened = 0
+        self.rejected = 0
+
+    def retry_after(self) -> int:
+        remaining = BREAKER_OPEN_SECONDS - (time.monotonic() - self.opened_at)
+        return max(1, math.ceil(remaining))
+
+    def allow_request(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < BREAKER_OPEN_SECONDS:
+                self.rejected += 1
+                return False
+            self.state = "half_open"
+            self.half_open_calls = 0
+        if self.state == "half_open":
+            if self.half_open_calls >= BREAKER_HALF_OPEN_CALLS:
+                self.rejected += 1
+                return False
+            self.half_open_calls += 1
+        return True
+
+    def record(self, success: bool, latency: float):
+        slow = latency > BREAKER_SLOW_CALL_SECONDS
+        if self.state == "half_open":
+            if success and not slow:
+                self.reset()
+            else:
+                self.open()
+            return
+
+        self.calls.append((success, slow))
+        if len(self.calls) < BREAKER_MIN_CALLS:
+            return
+        error_rate = sum(1 for ok, _ in self.calls if not ok) / len(self.calls)
+        slow_rate = sum(1 for _, is_slow in self.calls if is_slow) / len(self.calls)
+        if error_rate >= BREAKER_ERROR_RATE or slow_rate >= BREAKER_SLOW_RATE:
+            self.open()
+
+    def open(self):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.times_opened += 1
+        self.calls.clear()
+
+    def reset(self):
+        self.state = "closed"
+        self.opened_at = None
+        self.calls.clear()
+
+    def snapshot(self) -> dict:
+        calls = len(self.calls)
+        return {
+            "state": self.state,
+            "window_calls": calls,
+            "error_rate": round(sum(1 for ok, _ in self.calls if not ok) / calls, 3) if calls else 0.0,
+            "slow_rate": round(sum(1 for _, slow in self.calls if slow) / calls, 3) if calls else 0.0,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+            "retry_after": self.retry_after() if self.state == "open" else None,
+        }
+
+breakers = {service: CircuitBreaker(service) for service in SERVICES}
+
+# Configuración de la caché de respuestas GET
+CACHE_TTL = float(os.getenv("GATEWAY_CACHE_TTL", "30"))
+CACHE_MAX_ENTRIES = int(os.getenv("GATEWAY_CACHE_MAX_ENTRIES", "256"))
+CACHE_MAX_ENTRY_BYTES = int(os.getenv("GATEWAY_CACHE_MAX_ENTRY_BYTES", str(1024 * 1024)))
+CACHE_SERVICES = [s.strip() for s in os.getenv("GATEWAY_CACHE_SERVICES", "resource,student").split(",") if s.strip()]
+
+# Escrituras en un servicio que modifican datos de otro (un préstamo cambia las unidades prestadas)
+CACHE_INVALIDATES = {"loan": ["resource"]}
+
+class ResponseCache:
+    """Caché LRU en memoria con expiración por TTL para respuestas GET."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "invalidations": 0, "not_modified": 0}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and entry["expires"] < time.monotonic():
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry
+
+    def set(self, key, entry):
+        entry["expires"] = time.monotonic() + self.ttl
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        self.stats["stores"] += 1
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def invalidate(self, service: str, prefix: str = ""):
+        keys = [key for key in self.entries if key[0] == service and key[1].startswith(prefix)]
+        for key in keys:
+            del self.entries[key]
+        self.stats["invalidations"] += len(keys)
+
+    def snapshot(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_ratio": round(self.stats["hits"] / lookups, 3) if lookups else 0.0,
+            "entries": len(self.entries),
+            "bytes": sum(len(entry["body"]) for entry in self.entries.values()),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+        }
+
+response_cache = ResponseCache(CACHE_MAX_ENTRIES, CACHE_TTL)
+
+def cache_key(service: str, path: str, request: Request):
+    # La respuesta puede depender del usuario, así que el token forma parte de la clave.
+    # Los bytes se guardan con su Content-Encoding: un cuerpo gzip solo sirve a quien lo aceptó
+    return (
+        service,
+        path,
+        str(request.query_params),
+        request.headers.get("authorization", ""),
+        request.headers.get("accept-encoding", ""),
+    )
+
+def etag_matches(etag: str, if_none_match: str) -> bool:
+    # Comparación débil de If-None-Match (RFC 9110): se ignora W/ y las etiquetas deben ser idénticas
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    strip_weak = lambda tag: tag[2:] if tag.startswith("W/") else tag
+    return strip_weak(etag) in {strip_weak(tag.strip()) for tag in if_none_match.split(",")}
+
+def path_prefix(path: str) -> str:
+    # "/resources/3/status" -> "/resources"
+    return "/" + path.strip("/").split("/")[0]
+
+def is_cacheable(response: httpx.Response) -> bool:
+    cache_control = response.headers.get("cache-control", "")
+    content_length = response.headers.get("content-length")
+    return (
+        response.status_code == 200
+        and content_length is not None
+        and int(content_length) <= CACHE_MAX_ENTRY_BYTES
+        and "no-store" not in cache_control
+        and "private" not in cache_control
+    )
+
+def cached_response(entry: dict, request: Request, cache_status: str) -> Response:
+    headers = {"ETag": entry["etag"], "X-Cache": cache_status}
+    if etag_matches(entry["etag"], request.headers.get("if-none-match", "")):
+        response_cache.stats["not_modified"] += 1
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry["body"], status_code=entry["status_code"], headers={**entry["headers"], **headers})
+
 async def proxy_request(service: str, request: Request):
     if service not in SERVICES:
         raise HTTPException(status_code=404, detail="Servicio no encontrado")
 
-    client = httpx.AsyncClient()
-    
-    # Construir la URL del servicio destino
-    url = f"{SERVICES[service]}{request.url.path.replace(f'/api/{service}', '')}"
-    
-    # Obtener el cuerpo de la petición
-    body = await request.body()
-    
+    # Construir la ruta en el servicio destino
+    path = request.url.path.replace(f'/api/{service}', '')
+
+    # Las lecturas cacheadas se sirven sin contactar al servicio
+    use_cache = request.method == "GET" and service in CACHE_SERVICES
+    if use_cache:
+        entry = response_cache.get(cache_key(service, path, request))
+        if entry is not None:
+            return cached_response(entry, request, "HIT")
+
+    # Si el circuito está abierto se falla de inmediato sin esperar al servicio
+    breaker = breakers[service]
+    if not breaker.allow_request():
+        raise HTTPException(
+            status_code=503,
+            detail=f"Servicio {service} no disponible temporalmente",
+            headers={"Retry-After": str(breaker.retry_after())},
+        )
+
+    client = get_client(service)
+    stats = pool_stats[service]
+
+    # El cuerpo se reenvía por partes, sin cargarlo completo en memoria
+    has_body = "content-length" in request.headers or "transfer-encoding" in request.headers
+    upstream_request = client.build_request(
+        method=request.method,
+        url=path,
+        headers=filter_headers(request.headers),
+        content=request.stream() if has_body else None,
+        params=request.query_params,
+    )
+
+    stats["requests"] += 1
+    stats["in_flight"] += 1
+    stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+    start = time.perf_counter()
     try:
         # Realizar la petición al servicio correspondiente
-        response = await client.request(
-            method=request.method,
-            url=url,
-            headers={key: value for key, value in request.headers.items() if key.lower() not in ['host', 'content-length']},
-            content=body,
-            params=request.query_params,
-        )
-        
-        return response.json()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        await client.aclose()
+        response = await client.send(upstream_request, stream=True)
+    except httpx.TimeoutException:
+        stats["errors"] += 1
+        stats["in_flight"] -= 1
+        breaker.record(False, time.perf_counter() - start)
+        raise HTTPException(status_code=504, detail=f"Tiempo de espera agotado con el servicio {service}")
+    except httpx.RequestError as e:
+        stats["errors"] += 1
+        stats["in_flight"] -= 1
+        breaker.record(False, time.perf_counter() - start)
+        raise HTTPException(status_code=502, detail=f"Error al contactar el servicio {service}: {e}")
+    except BaseException:
+        # Cliente desconectado, cancelación o fallo inesperado: sin esto una prueba en
+        # half_open consumiría su turno y el circuito quedaría bloqueado para siempre
+        stats["errors"] += 1
+        stats["in_flight"] -= 1
+        breaker.record(False, time.perf_counter() - start)
+        raise
+    breaker.record(response.status_code < 500, time.perf_counter() - start)
+
+    released = False
+
+    async def release():
+        # Se llama desde varios caminos (caché, fin del stream, error); solo cuenta la primera vez
+        nonlocal released
+        if released:
+            return
+        released = True
+        stats["in_flight"] -= 1
+        # Si el cliente se desconectó la tarea ya está cancelada: el cierre no debe interrumpirse
+        with anyio.CancelScope(shield=True):
+            await response.aclose()
+
+    async def stream_upstream():
+        # El finally se ejecuta también si el servicio falla a mitad del cuerpo o el cliente se desconecta,
+        # casos en los que una BackgroundTask nunca llega a correr
+        try:
+            async for chunk in response.aiter_raw():
+                yield chunk
+        finally:
+            await release()
+
+    # Una escritura invalida las lecturas cacheadas del mismo prefijo de ruta
+    if request.method in ("POST", "PUT", "DELETE"):
+        response_cache.invalidate(service, path_prefix(path))
+        for other in CACHE_INVALIDATES.get(service, []):
+            response_cache.invalidate(other)
+
+    if use_cache and is_cacheable(response):
+        try:
+            body = b"".join([chunk async for chunk in response.aiter_raw()])
+        finally:
+            await release()
+        entry = {
+            "status_code": response.status_code,
+            # ETag y X-Cache los pone cached_response; guardarlos duplicaría las cabeceras
+            "headers": {
+                k: v for k, v in filter_headers(response.headers).items()
+                if k.lower() not in ("content-length", "etag", "x-cache")
+            },
+            "body": body,
+            "etag": response.headers.get("etag") or f'"{hashlib.sha1(body).hexdigest()}"',
+        }
+        response_cache.set(cache_key(service, path, request), entry)
+        return cached_response(entry, request, "MISS")
+
+    # La respuesta se devuelve tal cual (estado, cabeceras y bytes sin decodificar)
+    return StreamingResponse(
+        stream_upstream(),
+        status_code=response.status_code,
+        headers=filter_headers(response.headers),
+    )
 
 # Rutas para cada servicio
 @app.api_route("/api/{service}/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
 async def gateway(service: str, path: str, request: Request):
     return await proxy_request(service, request)
 
+# Métricas de uso de los pools de conexiones
+@app.get("/metrics")
+async def metrics():
+    pools = {}
+    for service, stats in pool_stats.items():
+        client = clients.get(service)
+        pools[service] = {
+            **stats,
+            "open_connections": open_connections(client) if client else 0,
+            "max_connections": POOL_MAX_CONNECTIONS,
+            "max_keepalive_connections": POOL_MAX_KEEPALIVE,
+            "keepalive_expiry": POOL_KEEPALIVE_EXPIRY,
+            "timeout": SERVICE_TIMEOUTS[service],
+        }
+    return {"pools": pools, "cache": response_cache.snapshot()}
+
+# Estado de los circuit breakers
+@app.get("/admin/circuit-breakers")
+async def circuit_breakers():
+    return {service: breaker.snapshot() for service, breaker in breakers.items()}
+
+@app.post("/admin/circuit-breakers/{service}/reset")
+async def reset_circuit_breaker(service: str):
+    if service not in breakers:
+        raise HTTPException(status_code=404, detail="Servicio no encontrado")
+    breakers[service].reset()
+    return breakers[service].snapshot()
+
+# Configuración de las comprobaciones de salud
+HEALTH_TIMEOUT = float(os.getenv("GATEWAY_HEALTH_TIMEOUT", "2"))
+HEALTH_INTERVAL = float(os.getenv("GATEWAY_HEALTH_INTERVAL", "10"))
+
+# Último estado conocido de cada servicio, actualizado en segundo plano
+service_health = {
+    service: {
+        "status": "unknown",
+        "latency_ms": None,
+        "last_check": None,
+        "last_success": None,
+        "consecutive_failures": 0,
+    }
+    for service in SERVICES
+}
+health_task = None
+
+async def probe_service(service: str):
+    health = service_health[service]
+    start = time.perf_counter()
+    try:
+        response = await get_client(service).get("/health", timeout=HEALTH_TIMEOUT)
+        up = response.status_code == 200
+    except Exception:
+        up = False
+    now = datetime.utcnow().isoformat()
+    health["latency_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    health["last_check"] = now
+    if up:
+        health["status"] = "up"
+        health["last_success"] = now
+        health["consecutive_failures"] = 0
+    else:
+        health["status"] = "down"
+        health["consecutive_failures"] += 1
+
+async def refresh_health():
+    # Todos los servicios se comprueban a la vez: el tiempo total es el del más lento
+    await asyncio.gather(*(probe_service(service) for service in SERVICES))
+
+async def health_prober():
+    while True:
+        await refresh_health()
+        await asyncio.sleep(HEALTH_INTERVAL)
+
 # Ruta de estado de salud
 @app.get("/health")
 async def health_check():
-    status = {}
-    async with httpx.AsyncClient() as client:
-        for service, url in SERVICES.items():
-            try:
-                response = await client.get(f"{url}/health", timeout=2.0)
-                status[service] = "up" if response.status_code == 200 else "down"
-            except:
-                status[service] = "down"
-    return {"status": "up", "services": status}
+    # Se responde desde memoria; solo se comprueba en línea si aún no hay datos
+    if any(health["last_check"] is None for health in service_health.values()):
+        await refresh_health()
+    status = {service: health["status"] for service, health in service_health.items()}
+    return {"status": "up", "services": status, "details": service_health}
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,19 +1,30 @@
+import time
+
+# Referencia para medir el arranque en frío del servicio
+IMPORT_STARTED = time.perf_counter()
+
+import json
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from passlib.context import CryptContext
 from datetime import datetime, timedelta
 from typing import Optional
-from jose import JWTError, jwt
 from pydantic import BaseModel
 import os
+import sys
 from dotenv import load_dotenv
 
+# Permite importar el paquete común al ejecutar el servicio desde su carpeta
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.passwords import create_hasher
+
 load_dotenv()
 
 # Configuración
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+USERS_FILE = os.getenv("AUTH_USERS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "users.json"))
+STARTUP_BUDGET_MS = float(os.getenv("AUTH_STARTUP_BUDGET_MS", "1500"))
 
 app = FastAPI()
 
@@ -32,36 +43,43 @@ class User(BaseModel):
 class UserInDB(User):
     hashed_password: str
 
-# Configuración de seguridad
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Configuración de seguridad: bcrypt se ejecuta en un pool de hilos acotado
+password_hasher = create_hasher()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-# Base de datos simulada
-fake_users_db = {
-    "admin": {
-        "username": "admin",
-        "hashed_password": pwd_context.hash("admin123"),
-        "disabled": False,
-    }
-}
+# Usuarios con sus hashes bcrypt precalculados (USERS_FILE), cargados al arrancar
+users_db = {}
+startup_stats = {"startup_ms": None, "budget_ms": STARTUP_BUDGET_MS, "users_loaded": 0}
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+def load_users():
+    with open(USERS_FILE, encoding="utf-8") as f:
+        users_db.clear()
+        users_db.update(json.load(f))
+    startup_stats["users_loaded"] = len(users_db)
+    return users_db
+
+def get_users_db():
+    # Si el evento de inicio no se ejecutó (p. ej. en pruebas) se cargan en el primer uso
+    return users_db or load_users()
+
+async def verify_password(plain_password, hashed_password):
+    return await password_hasher.verify(plain_password, hashed_password)
 
 def get_user(db, username: str):
     if username in db:
         user_dict = db[username]
         return UserInDB(**user_dict)
 
-def authenticate_user(fake_db, username: str, password: str):
-    user = get_user(fake_db, username)
+async def authenticate_user(db, username: str, password: str):
+    user = get_user(db, username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password(password, user.hashed_password):
         return False
     return user
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+    from jose import jwt
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
@@ -72,6 +90,7 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 async def get_current_user(token: str = Depends(oauth2_scheme)):
+    from jose import JWTError, jwt
     credentials_exception = HTTPException(
         status_code=401,
         detail="Could not validate credentials",
@@ -85,14 +104,14 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = get_user(fake_users_db, username=token_data.username)
+    user = get_user(get_users_db(), username=token_data.username)
     if user is None:
         raise credentials_exception
     return user
 
 @app.post("/token", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(fake_users_db, form_data.username, form_data.password)
+    user = await authenticate_user(get_users_db(), form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=401,
@@ -105,6 +124,22 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
+@app.on_event("startup")
+def startup():
+    load_users()
+    startup_stats["startup_ms"] = round((time.perf_counter() - IMPORT_STARTED) * 1000, 1)
+    if startup_stats["startup_ms"] > STARTUP_BUDGET_MS:
+        print(f"Arranque del servicio de autenticación por encima del presupuesto: "
+              f"{startup_stats['startup_ms']} ms > {STARTUP_BUDGET_MS} ms")
+
+@app.on_event("shutdown")
+def shutdown_hasher():
+    password_hasher.shutdown()
+
+@app.get("/metrics")
+async def metrics():
+    return {"startup": startup_stats}
+
 @app.get("/users/me")
 async def read_users_me(current_user: User = Depends(get_current_user)):
     return current_user
@@ -4,13 +4,18 @@ from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy import create_engine, Column, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
-from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from pydantic import BaseModel
 import os
+import sys
 from dotenv import load_dotenv
 
+# Allow importing the shared package when the service runs from its own folder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.cache import TTLCache
+from common.passwords import create_hasher
+
 load_dotenv()
 
 # Constants
@@ -19,13 +24,13 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 # Database setup
-SQLALCHEMY_DATABASE_URL = "sqlite:///./auth.db"
+SQLALCHEMY_DATABASE_URL = os.getenv("AUTH_DATABASE_URL", "sqlite:///./auth.db")
 engine = create_engine(SQLALCHEMY_DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing runs in a bounded thread pool (BCRYPT_ROUNDS, PASSWORD_HASH_WORKERS)
+password_hasher = create_hasher()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # Models
@@ -87,10 +92,10 @@ def get_db():
         db.close()
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return password_hasher.verify_sync(plain_password, hashed_password)
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return password_hasher.hash_sync(password)
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
@@ -102,7 +107,32 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+# Cache of user records keyed by username, so hot token validations skip SQLite
+user_cache = TTLCache(
+    maxsize=int(os.getenv("USER_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("USER_CACHE_TTL", "60")),
+)
+
+def load_user(username: str) -> UserInDB | None:
+    user = user_cache.get(username)
+    if user is not None:
+        return user
+    db = SessionLocal()
+    try:
+        db_user = db.query(User).filter(User.username == username).first()
+        if db_user is None:
+            return None
+        user = UserInDB.model_validate(db_user)
+    finally:
+        db.close()
+    user_cache.set(username, user)
+    return user
+
+def invalidate_user(username: str):
+    # Must be called whenever a user is created or modified
+    user_cache.pop(username)
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -116,7 +146,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = db.query(User).filter(User.username == token_data.username).first()
+    user = load_user(token_data.username)
     if user is None:
         raise credentials_exception
     return user
@@ -127,7 +157,8 @@ async def login_for_access_token(
     db: Session = Depends(get_db)
 ):
     user = db.query(User).filter(User.username == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    # bcrypt runs off the event loop so concurrent logins don't stall other requests
+    if not user or not await password_hasher.verify(form_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -160,16 +191,25 @@ def create_user(user: UserCreate, db: Session = Depends(get_db)):
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    invalidate_user(db_user.username)
     return db_user
 
 @app.get("/users/me/", response_model=UserInDB)
-async def read_users_me(current_user: User = Depends(get_current_user)):
+async def read_users_me(current_user: UserInDB = Depends(get_current_user)):
     return current_user
 
 @app.get("/validate-token")
-async def validate_token(current_user: User = Depends(get_current_user)):
+async def validate_token(current_user: UserInDB = Depends(get_current_user)):
     return {"valid": True, "user": current_user}
 
+@app.on_event("shutdown")
+def shutdown_hasher():
+    password_hasher.shutdown()
+
+@app.get("/metrics")
+async def metrics():
+    return {"user_cache": user_cache.stats()}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
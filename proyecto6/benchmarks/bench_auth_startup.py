@@ -0,0 +1,44 @@
+"""Mide el arranque en frío de auth_service/app.py.
+
+Cada repetición importa el módulo y ejecuta su evento de inicio en un
+proceso nuevo, de modo que no se reaprovecha nada del anterior. Termina con
+código 1 si la mediana supera el presupuesto (AUTH_STARTUP_BUDGET_MS).
+
+Uso: python benchmarks/bench_auth_startup.py [--runs 5] [--budget-ms 1500]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MEASURE = """
+import json, time
+start = time.perf_counter()
+from auth_service import app
+imported = time.perf_counter()
+app.startup()
+print(json.dumps({"import_ms": (imported - start) * 1000, "total_ms": (time.perf_counter() - start) * 1000}))
+"""
+
+def measure_once() -> dict:
+    import json
+    output = subprocess.run(
+        [sys.executable, "-c", MEASURE], cwd=ROOT, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("AUTH_STARTUP_BUDGET_MS", "1500")))
+    args = parser.parse_args()
+
+    samples = [measure_once() for _ in range(args.runs)]
+    import_ms = statistics.median(s["import_ms"] for s in samples)
+    total_ms = statistics.median(s["total_ms"] for s in samples)
+    print(f"import: {import_ms:.1f} ms, import + inicio: {total_ms:.1f} ms (mediana de {args.runs})")
+    print(f"presupuesto: {args.budget_ms:.0f} ms -> {'OK' if total_ms <= args.budget_ms else 'EXCEDIDO'}")
+    sys.exit(0 if total_ms <= args.budget_ms else 1)
@@ -0,0 +1,67 @@
+"""Benchmark de logins concurrentes contra auth_service/app.py.
+
+Lanza N logins a la vez mientras un latido mide cuánto se retrasa el event
+loop. Con bcrypt en el pool de hilos el retraso máximo debe mantenerse en
+pocos milisegundos; con --inline (bcrypt en el propio loop) crece con cada
+login.
+
+Uso: python benchmarks/bench_login.py [--logins 50] [--inline]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from auth_service import app as auth_app
+
+HEARTBEAT_SECONDS = 0.01
+
+async def heartbeat(lags: list, stop: asyncio.Event):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(HEARTBEAT_SECONDS)
+        lags.append(time.perf_counter() - start - HEARTBEAT_SECONDS)
+
+async def login(client: httpx.AsyncClient, latencies: list):
+    start = time.perf_counter()
+    response = await client.post("/token", data={"username": "admin", "password": "admin123"})
+    response.raise_for_status()
+    latencies.append(time.perf_counter() - start)
+
+async def run(logins: int, inline: bool):
+    hasher = auth_app.password_hasher
+    if inline:
+        async def verify_inline(plain_password, hashed_password):
+            return hasher.verify_sync(plain_password, hashed_password)
+        auth_app.password_hasher.verify = verify_inline
+
+    transport = httpx.ASGITransport(app=auth_app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://auth") as client:
+        lags, latencies = [], []
+        stop = asyncio.Event()
+        beat = asyncio.create_task(heartbeat(lags, stop))
+        start = time.perf_counter()
+        await asyncio.gather(*(login(client, latencies) for _ in range(logins)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await beat
+
+    latencies.sort()
+    print(f"modo: {'inline' if inline else 'pool'} (rounds={hasher.rounds}, workers={hasher.executor._max_workers})")
+    print(f"logins: {logins} en {elapsed:.2f}s -> {logins / elapsed:.1f} logins/s")
+    print(f"latencia p50: {statistics.median(latencies) * 1000:.1f} ms, "
+          f"p99: {latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f} ms")
+    print(f"retraso del event loop: máx {max(lags, default=0) * 1000:.1f} ms, "
+          f"medio {statistics.mean(lags or [0]) * 1000:.1f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=50)
+    parser.add_argument("--inline", action="store_true", help="verificar bcrypt en el event loop (comparación)")
+    args = parser.parse_args()
+    asyncio.run(run(args.logins, args.inline))
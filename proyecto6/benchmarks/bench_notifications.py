@@ -0,0 +1,76 @@
+"""Benchmark del pipeline de notificaciones de notification_service/main.py.
+
+Publica N notificaciones repartidas entre varios estudiantes contra /notify
+usando el transporte falso (sin red ni SendGrid) y mide cuánto tarda /notify
+en responder y cuánto tarda el pipeline en vaciar la cola. Con ventana de
+agrupación los mensajes al mismo estudiante salen en un solo correo.
+
+Uso: python benchmarks/bench_notifications.py [--notifications 2000] [--students 100]
+     [--workers 4] [--window 0.2] [--latency 0.05] [--rate 0]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from notification_service import main as notification_app
+
+def student_service(request: httpx.Request):
+    student_id = request.url.path.rsplit("/", 1)[-1]
+    return httpx.Response(200, json={"student_id": student_id, "email": f"{student_id}@universidad.edu"})
+
+async def run(args):
+    transport = notification_app.FakeTransport(latency=args.latency)
+    pipeline = notification_app.NotificationPipeline(
+        transport=transport,
+        workers=args.workers,
+        coalesce_window=args.window,
+        rate_limit=args.rate,
+        dead_letters=notification_app.DeadLetterStore(None),
+    )
+    pipeline.http_client = httpx.AsyncClient(transport=httpx.MockTransport(student_service))
+    notification_app.pipeline = pipeline
+    await pipeline.start()
+
+    latencies = []
+    asgi = httpx.ASGITransport(app=notification_app.app)
+    async with httpx.AsyncClient(transport=asgi, base_url="http://notify") as client:
+        start = time.perf_counter()
+        for i in range(args.notifications):
+            sent = time.perf_counter()
+            response = await client.post("/notify", json={
+                "student_id": f"S{i % args.students:05d}",
+                "message": f"Notificación {i}",
+            })
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - sent)
+        accepted = time.perf_counter() - start
+        await pipeline.drain()
+        elapsed = time.perf_counter() - start
+    await pipeline.stop()
+
+    stats = pipeline.stats
+    latencies.sort()
+    print(f"workers: {args.workers}, ventana: {args.window}s, latencia del transporte: {args.latency * 1000:.0f} ms")
+    print(f"/notify: {args.notifications} aceptadas en {accepted:.2f}s, "
+          f"p50 {statistics.median(latencies) * 1000:.2f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f} ms")
+    print(f"entrega: {stats['messages_sent']} mensajes en {stats['emails_sent']} correos "
+          f"({stats['messages_sent'] / max(stats['emails_sent'], 1):.1f} por correo) en {elapsed:.2f}s "
+          f"-> {stats['messages_sent'] / elapsed:.0f} mensajes/s")
+    print(f"reintentos: {stats['retries']}, dead letters: {stats['dead_letters']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--notifications", type=int, default=2000)
+    parser.add_argument("--students", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--window", type=float, default=0.2, help="ventana de agrupación en segundos (0 = sin agrupar)")
+    parser.add_argument("--latency", type=float, default=0.05, help="latencia simulada por correo en segundos")
+    parser.add_argument("--rate", type=float, default=0, help="correos por segundo (0 = sin límite)")
+    asyncio.run(run(parser.parse_args()))
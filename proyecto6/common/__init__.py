@@ -0,0 +1 @@
+# Componentes compartidos por los microservicios del sistema de préstamos
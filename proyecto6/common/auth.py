@@ -0,0 +1,97 @@
+from jose import JWTError, jwt
+import os
+import time
+import requests
+
+from common.cache import TTLCache
+
+class InvalidTokenError(Exception):
+    pass
+
+class TokenVerifier:
+    """Verifica localmente la firma HS256 y la expiración de los JWT emitidos por auth_service.
+
+    Las claims decodificadas se guardan en una caché con TTL corto, de modo que
+    la comprobación de revocación opcional (`revocation_check`) solo se ejecuta
+    una vez por token y TTL, y no en cada petición.
+    """
+
+    def __init__(self, secret_key: str, algorithm: str = "HS256", cache_ttl: float = 60.0,
+                 cache_size: int = 1024, revocation_check=None):
+        self.secret_key = secret_key
+        self.algorithm = algorithm
+        self.revocation_check = revocation_check
+        self.claims_cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.revoked = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+
+    def verify(self, token: str) -> dict:
+        if not token:
+            raise InvalidTokenError("Token ausente")
+        if self.revoked.get(token):
+            raise InvalidTokenError("Token revocado")
+
+        claims = self.claims_cache.get(token)
+        if claims is not None:
+            if claims["exp"] <= time.time():
+                self.claims_cache.pop(token)
+                raise InvalidTokenError("Token expirado")
+            return claims
+
+        try:
+            claims = jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
+        except JWTError as e:
+            raise InvalidTokenError(str(e))
+        if not claims.get("sub") or "exp" not in claims:
+            raise InvalidTokenError("Token sin sujeto o sin expiración")
+
+        if self.revocation_check is not None and not self.revocation_check(token, claims):
+            self.revoke(token, claims)
+            raise InvalidTokenError("Token revocado")
+
+        # La entrada nunca sobrevive a la expiración del propio token
+        ttl = min(self.claims_cache.ttl, claims["exp"] - time.time())
+        self.claims_cache.set(token, claims, ttl=ttl)
+        return claims
+
+    def revoke(self, token: str, claims: dict | None = None):
+        self.claims_cache.pop(token)
+        if claims is None:
+            try:
+                claims = jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
+            except JWTError:
+                # Un token inválido o expirado ya es rechazado por verify()
+                return
+        # Basta con recordarlo hasta que expire por sí solo
+        self.revoked.set(token, True, ttl=max(0.0, claims["exp"] - time.time()))
+
+def auth_service_check(auth_service_url: str, timeout: float = 2.0):
+    # Confirma con auth_service que el token sigue siendo válido (usuario existente).
+    # Si auth no responde se acepta el token ya verificado localmente.
+    def check(token: str, claims: dict) -> bool:
+        try:
+            response = requests.get(
+                f"{auth_service_url}/validate-token",
+                headers={"Authorization": f"Bearer {token}"},
+                timeout=timeout,
+            )
+        except requests.RequestException:
+            return True
+        return response.status_code == 200
+    return check
+
+def create_verifier() -> TokenVerifier:
+    # Sin clave todos los tokens serían rechazados y cada ruta protegida respondería 401
+    # sin más explicación: mejor no arrancar
+    secret_key = os.getenv("SECRET_KEY")
+    if not secret_key:
+        raise RuntimeError(
+            "SECRET_KEY no está configurada: es necesaria para verificar los tokens emitidos por auth_service"
+        )
+    revocation_check = None
+    if os.getenv("TOKEN_REVOCATION_CHECK", "false").lower() == "true":
+        revocation_check = auth_service_check(os.getenv("AUTH_SERVICE_URL", "http://localhost:8000"))
+    return TokenVerifier(
+        secret_key,
+        cache_ttl=float(os.getenv("TOKEN_CACHE_TTL", "60")),
+        revocation_check=revocation_check,
+    )
@@ -0,0 +1,139 @@
+import os
+import sqlite3
+import threading
+
+class PooledConnection(sqlite3.Connection):
+    """Conexión que al cerrarse vuelve al pool en lugar de cerrarse de verdad.
+
+    close() deshace cualquier transacción sin confirmar para que el siguiente
+    uso en el mismo hilo empiece limpio.
+    """
+
+    pool = None
+    depth = 0
+
+    def close(self):
+        self.depth -= 1
+        if self.depth > 0:
+            # Uso anidado en el mismo hilo: la transacción la cierra el uso exterior
+            return
+        self.depth = 0
+        if self.in_transaction:
+            self.rollback()
+        self.pool._release(self)
+
+    def close_for_real(self):
+        super().close()
+
+class SQLitePool:
+    """Una conexión persistente por hilo con los pragmas aplicados una sola vez.
+
+    Las rutas síncronas de FastAPI se ejecutan en un pool de hilos que se
+    reutilizan, así que cada hilo termina con su conexión abierta y el coste de
+    abrirla (y de preparar las sentencias) se paga una vez.
+    """
+
+    def __init__(self, path: str, busy_timeout_ms: int = 5000, mmap_size: int = 64 * 1024 * 1024,
+                 cached_statements: int = 256, wal: bool = True):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.mmap_size = mmap_size
+        self.cached_statements = cached_statements
+        self.wal = wal
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = {}
+        self.created = 0
+        self.acquired = 0
+        self.in_use = 0
+
+    def _connect(self) -> PooledConnection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout_ms / 1000,
+            cached_statements=self.cached_statements,
+            check_same_thread=False,
+            factory=PooledConnection,
+        )
+        conn.pool = self
+        conn.row_factory = sqlite3.Row
+        if self.wal:
+            # WAL: los lectores no bloquean al escritor; con NORMAL basta un fsync por checkpoint
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def connection(self) -> PooledConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._prune()
+                self._connections[threading.current_thread()] = conn
+                self.created += 1
+        with self._lock:
+            self.acquired += 1
+            if conn.depth == 0:
+                self.in_use += 1
+        conn.depth += 1
+        return conn
+
+    def _release(self, conn: PooledConnection):
+        with self._lock:
+            self.in_use -= 1
+
+    def _prune(self):
+        # Cierra las conexiones de hilos que ya terminaron
+        for thread in [t for t in self._connections if not t.is_alive()]:
+            self._connections.pop(thread).close_for_real()
+
+    def close_all(self):
+        with self._lock:
+            for conn in self._connections.values():
+                conn.close_for_real()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "path": self.path,
+                "connections": len(self._connections),
+                "created": self.created,
+                "acquired": self.acquired,
+                "reused": self.acquired - self.created,
+                "in_use": self.in_use,
+                "journal_mode": "wal" if self.wal else "delete",
+                "busy_timeout_ms": self.busy_timeout_ms,
+                "mmap_size": self.mmap_size,
+                "cached_statements": self.cached_statements,
+            }
+
+def create_pool(path: str) -> SQLitePool:
+    return SQLitePool(
+        path,
+        busy_timeout_ms=int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+        mmap_size=int(os.getenv("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024))),
+        cached_statements=int(os.getenv("SQLITE_CACHED_STATEMENTS", "256")),
+        wal=os.getenv("SQLITE_WAL", "true").lower() == "true",
+    )
+
+def register_pool(app, pool: SQLitePool):
+    """Expone las estadísticas del pool en /metrics y lo cierra al apagar la aplicación.
+
+    Devuelve la función get_db del servicio: entrega la conexión del hilo
+    actual y su close() la devuelve al pool en lugar de cerrarla.
+    """
+    @app.get("/metrics")
+    def get_metrics():
+        return {"db": pool.stats()}
+
+    @app.on_event("shutdown")
+    def close_pool():
+        pool.close_all()
+
+    return pool.connection
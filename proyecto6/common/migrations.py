@@ -0,0 +1,56 @@
+from datetime import datetime
+
+# Cada migración es (versión, descripción, pasos); los pasos son una lista de
+# sentencias SQL o una función que recibe la conexión.
+
+def applied_versions(conn) -> set:
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
+    ''')
+    conn.commit()
+    return {row[0] for row in conn.execute("SELECT version FROM schema_migrations")}
+
+def schema_version(conn) -> int:
+    return max(applied_versions(conn), default=0)
+
+def run_migrations(conn, migrations) -> list:
+    """Aplica en orden las migraciones pendientes y devuelve las versiones aplicadas.
+
+    Cada migración va en su propia transacción junto con su registro en
+    schema_migrations, así que una migración fallida no deja cambios a medias y
+    se puede ejecutar en cada arranque sin efectos.
+    """
+    versions = [version for version, _, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError("Hay versiones de migración repetidas")
+
+    done = applied_versions(conn)
+    applied = []
+    for version, description, steps in sorted(migrations, key=lambda m: m[0]):
+        if version in done:
+            continue
+        # BEGIN IMMEDIATE: si dos procesos arrancan a la vez solo uno migra
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM schema_migrations WHERE version = ?", (version,)).fetchone():
+                conn.rollback()
+                continue
+            if callable(steps):
+                steps(conn)
+            else:
+                for statement in steps:
+                    conn.execute(statement)
+            conn.execute(
+                "INSERT INTO schema_migrations (version, description, applied_at) VALUES (?, ?, ?)",
+                (version, description, datetime.now().isoformat())
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(version)
+    return applied
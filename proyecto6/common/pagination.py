@@ -0,0 +1,56 @@
+import os
+
+# Paginación por cursor (keyset) sobre una columna entera creciente, normalmente id.
+# A diferencia de OFFSET, cada página cuesta lo mismo sin importar cuán lejos esté.
+DEFAULT_LIMIT = int(os.getenv("PAGE_DEFAULT_LIMIT", "100"))
+MAX_LIMIT = int(os.getenv("PAGE_MAX_LIMIT", "500"))
+
+def clamp_limit(limit: int | None) -> int:
+    return max(1, min(limit or DEFAULT_LIMIT, MAX_LIMIT))
+
+def keyset_page(conn, table: str, filters: list, response, cursor: int | None = None,
+                limit: int | None = None, key: str = "id", descending: bool = False):
+    """Devuelve una página de filas de `table` y anota la respuesta.
+
+    `filters` es una lista de pares (condición SQL, parámetro). Si hay más filas
+    se añade X-Next-Cursor con el valor a pasar como ?cursor= en la siguiente
+    petición; X-Total-Count solo se calcula en la primera página, que es donde
+    se muestra, para no repetir el COUNT en cada página.
+    """
+    limit = clamp_limit(limit)
+    conditions = [condition for condition, _ in filters]
+    params = [param for _, param in filters]
+    where = " AND ".join(conditions) or "1 = 1"
+
+    page_conditions, page_params = list(conditions), list(params)
+    if cursor is not None:
+        page_conditions.append(f"{key} {'<' if descending else '>'} ?")
+        page_params.append(cursor)
+    page_where = " AND ".join(page_conditions) or "1 = 1"
+
+    c = conn.cursor()
+    c.execute(
+        f"SELECT * FROM {table} WHERE {page_where} ORDER BY {key} {'DESC' if descending else 'ASC'} LIMIT ?",
+        page_params + [limit + 1]
+    )
+    rows = c.fetchall()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = str(rows[-1][key])
+    if cursor is None:
+        c.execute(f"SELECT COUNT(*) FROM {table} WHERE {where}", params)
+        response.headers["X-Total-Count"] = str(c.fetchone()[0])
+    return rows
+
+def keyset_query(query, key_column, response, cursor: int | None = None, limit: int | None = None):
+    """Lo mismo que keyset_page para una consulta de SQLAlchemy ya filtrada."""
+    limit = clamp_limit(limit)
+    if cursor is None:
+        response.headers["X-Total-Count"] = str(query.count())
+    else:
+        query = query.filter(key_column > cursor)
+    items = query.order_by(key_column).limit(limit + 1).all()
+    if len(items) > limit:
+        items = items[:limit]
+        response.headers["X-Next-Cursor"] = str(getattr(items[-1], key_column.key))
+    return items
@@ -0,0 +1,47 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import os
+
+class PasswordHasher:
+    """Hash y verificación bcrypt en un pool de hilos acotado.
+
+    bcrypt libera el GIL mientras calcula, así que un pool de hilos basta para
+    que los logins concurrentes no bloqueen el event loop, y el tamaño del pool
+    limita cuántos hashes se calculan a la vez.
+    """
+
+    def __init__(self, rounds: int = 12, max_workers: int = 4):
+        self.rounds = rounds
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bcrypt")
+        self._context = None
+
+    @property
+    def context(self):
+        # passlib se importa en el primer uso para no encarecer el arranque
+        if self._context is None:
+            from passlib.context import CryptContext
+            self._context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=self.rounds)
+        return self._context
+
+    def hash_sync(self, password: str) -> str:
+        return self.context.hash(password)
+
+    def verify_sync(self, plain_password: str, hashed_password: str) -> bool:
+        return self.context.verify(plain_password, hashed_password)
+
+    async def hash(self, password: str) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.hash_sync, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.verify_sync, plain_password, hashed_password)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+def create_hasher() -> PasswordHasher:
+    return PasswordHasher(
+        rounds=int(os.getenv("BCRYPT_ROUNDS", "12")),
+        max_workers=int(os.getenv("PASSWORD_HASH_WORKERS", "4")),
+    )
@@ -0,0 +1,45 @@
+import hashlib
+
+# Versión de los datos por tabla, mantenida con triggers: cualquier INSERT, UPDATE o
+# DELETE la incrementa. Permite responder 304 a un listado sin volver a consultarlo.
+
+def version_migration(table: str) -> list:
+    """Sentencias de migración que crean el contador de versión de `table` y sus triggers."""
+    statements = [
+        '''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 1
+        )
+        ''',
+        f"INSERT OR IGNORE INTO data_versions (name, version) VALUES ('{table}', 1)",
+    ]
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        statements.append(f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table} BEGIN
+            UPDATE data_versions SET version = version + 1 WHERE name = '{table}';
+        END
+        ''')
+    return statements
+
+def data_version(conn, table: str) -> int:
+    row = conn.execute("SELECT version FROM data_versions WHERE name = ?", (table,)).fetchone()
+    return row[0] if row else 0
+
+def list_etag(table: str, version: int, query: str) -> str:
+    # La consulta (filtros, cursor, límite) forma parte de la ETag: cada página tiene la suya
+    digest = hashlib.sha1(f"{table}:{version}:{query}".encode()).hexdigest()[:16]
+    return f'"{table}-{version}-{digest}"'
+
+def check_etag(conn, table: str, request, response):
+    """Lee la versión de `table` antes de consultar los datos y anota la ETag en la respuesta.
+
+    Devuelve True si el cliente ya tiene esa versión (If-None-Match), en cuyo
+    caso el endpoint debe responder 304 sin consultar. Leer la versión primero
+    garantiza que una escritura concurrente nunca quede oculta tras una ETag
+    más nueva que los datos.
+    """
+    etag = list_etag(table, data_version(conn, table), str(request.query_params))
+    response.headers["ETag"] = etag
+    if_none_match = request.headers.get("if-none-match", "")
+    return etag in [tag.strip() for tag in if_none_match.split(",")]
@@ -1,12 +1,24 @@
-from fastapi import FastAPI, HTTPException, Depends
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Depends, Response, Request
+from pydantic import BaseModel, Field
 from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import sqlite3
 import os
+import sys
+import threading
+import time
 from datetime import datetime, timedelta
 import requests
 from dotenv import load_dotenv
 
+# Permite importar el paquete compartido cuando el servicio se ejecuta desde su carpeta
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.db import create_pool, register_pool
+from common.migrations import run_migrations
+from common.pagination import keyset_page
+from common.versioning import check_etag, version_migration
+
 load_dotenv()
 
 app = FastAPI()
@@ -15,6 +27,27 @@ app = FastAPI()
 RESOURCE_SERVICE_URL = os.getenv("RESOURCE_SERVICE_URL", "http://localhost:8001")
 STUDENT_SERVICE_URL = os.getenv("STUDENT_SERVICE_URL", "http://localhost:8002")
 NOTIFICATION_SERVICE_URL = os.getenv("NOTIFICATION_SERVICE_URL", "http://localhost:8004")
+SERVICE_TIMEOUT = float(os.getenv("SERVICE_TIMEOUT", "5"))
+
+# Sesión HTTP compartida (reutiliza conexiones) y pool para consultas independientes en paralelo
+http = requests.Session()
+lookup_executor = ThreadPoolExecutor(max_workers=int(os.getenv("LOOKUP_WORKERS", "8")))
+
+class StageTimer:
+    # Acumula la duración de cada etapa para la cabecera Server-Timing
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, (time.perf_counter() - start) * 1000))
+
+    def header(self) -> str:
+        return ", ".join(f"{name};dur={duration:.1f}" for name, duration in self.stages)
 
 # Modelo de datos
 class Loan(BaseModel):
@@ -27,19 +60,25 @@ class Loan(BaseModel):
     return_date: Optional[str] = None
     status: str = "prestado"  # prestado, devuelto, vencido
 
+class BatchLoanItem(BaseModel):
+    resource_id: int
+    quantity: int = Field(1, gt=0)
+
+class BatchLoan(BaseModel):
+    student_id: str
+    items: List[BatchLoanItem] = Field(..., min_length=1)
+
 # Configuración de la base de datos
-DB_PATH = "loans.db"
+DB_PATH = os.getenv("LOAN_DB_PATH", "loans.db")
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Una conexión persistente por hilo (WAL, busy_timeout y sentencias en caché)
+db_pool = create_pool(DB_PATH)
+get_db = register_pool(app, db_pool)
 
-# Crear tabla si no existe
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
+# Migraciones del esquema: cada versión se aplica una sola vez y queda registrada en schema_migrations
+MIGRATIONS = [
+    (1, "esquema inicial", [
+        '''
         CREATE TABLE IF NOT EXISTS loans (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             student_id TEXT NOT NULL,
@@ -50,15 +89,98 @@ def init_db():
             return_date TEXT,
             status TEXT DEFAULT 'prestado'
         )
-    ''')
-    conn.commit()
-    conn.close()
+        ''',
+        # Bandeja de salida: intenciones de notificación escritas en la misma transacción que el préstamo
+        '''
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            student_id TEXT NOT NULL,
+            message TEXT NOT NULL,
+            status TEXT DEFAULT 'pendiente',
+            attempts INTEGER DEFAULT 0,
+            created_at TEXT NOT NULL,
+            next_attempt_at TEXT NOT NULL,
+            sent_at TEXT,
+            last_error TEXT
+        )
+        ''',
+        # Estado de las tareas periódicas (p. ej. hasta qué fecha ya se revisaron los vencimientos)
+        '''
+        CREATE TABLE IF NOT EXISTS scheduler_state (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        ''',
+    ]),
+    (2, "índices de préstamos y bandeja de salida", [
+        # Historial de un estudiante y préstamos de un recurso
+        "CREATE INDEX IF NOT EXISTS idx_loans_student_id ON loans (student_id)",
+        "CREATE INDEX IF NOT EXISTS idx_loans_resource_id ON loans (resource_id)",
+        # Búsqueda de préstamos vencidos por rango de fechas sin recorrer toda la tabla
+        "CREATE INDEX IF NOT EXISTS idx_loans_status_due_date ON loans (status, due_date)",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_pending ON notification_outbox (status, next_attempt_at)",
+    ]),
+    (3, "proyección loan_view con nombres de recurso y estudiante", [
+        # Copia desnormalizada de loans con los nombres ya resueltos, para listar sin consultar otros servicios
+        '''
+        CREATE TABLE IF NOT EXISTS loan_view (
+            loan_id INTEGER PRIMARY KEY,
+            student_id TEXT NOT NULL,
+            student_name TEXT,
+            resource_id INTEGER NOT NULL,
+            resource_name TEXT,
+            quantity INTEGER,
+            loan_date TEXT,
+            due_date TEXT,
+            return_date TEXT,
+            status TEXT
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_loan_view_status ON loan_view (status, loan_id)",
+        "CREATE INDEX IF NOT EXISTS idx_loan_view_student ON loan_view (student_id, loan_id)",
+        # Los triggers mantienen la proyección al día con cualquier cambio en loans;
+        # los nombres los completa el servicio al crear el préstamo
+        '''
+        CREATE TRIGGER IF NOT EXISTS loan_view_insert AFTER INSERT ON loans BEGIN
+            INSERT INTO loan_view (loan_id, student_id, resource_id, quantity, loan_date, due_date, return_date, status)
+            VALUES (NEW.id, NEW.student_id, NEW.resource_id, NEW.quantity, NEW.loan_date, NEW.due_date, NEW.return_date, NEW.status);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS loan_view_update AFTER UPDATE ON loans BEGIN
+            UPDATE loan_view
+            SET student_id = NEW.student_id, resource_id = NEW.resource_id, quantity = NEW.quantity,
+                loan_date = NEW.loan_date, due_date = NEW.due_date, return_date = NEW.return_date, status = NEW.status
+            WHERE loan_id = NEW.id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS loan_view_delete AFTER DELETE ON loans BEGIN
+            DELETE FROM loan_view WHERE loan_id = OLD.id;
+        END
+        ''',
+        # Préstamos existentes: los nombres se completan en segundo plano (refresh_loan_view_names)
+        '''
+        INSERT OR IGNORE INTO loan_view (loan_id, student_id, resource_id, quantity, loan_date, due_date, return_date, status)
+        SELECT id, student_id, resource_id, quantity, loan_date, due_date, return_date, status FROM loans
+        ''',
+    ]),
+    # Versión de los datos para responder 304 a los listados que no cambiaron
+    (4, "versión de datos de préstamos", version_migration("loans") + version_migration("loan_view")),
+]
+
+def init_db():
+    conn = get_db()
+    try:
+        run_migrations(conn, MIGRATIONS)
+    finally:
+        conn.close()
 
 init_db()
 
 def verify_student(student_id: str):
     try:
-        response = requests.get(f"{STUDENT_SERVICE_URL}/students/by-student-id/{student_id}")
+        response = http.get(f"{STUDENT_SERVICE_URL}/students/by-student-id/{student_id}", timeout=SERVICE_TIMEOUT)
         if response.status_code == 404:
             raise HTTPException(status_code=404, detail="Estudiante no encontrado")
         return response.json()
@@ -67,7 +189,7 @@ def verify_student(student_id: str):
 
 def verify_resource(resource_id: int, quantity: int = 1):
     try:
-        response = requests.get(f"{RESOURCE_SERVICE_URL}/resources/{resource_id}")
+        response = http.get(f"{RESOURCE_SERVICE_URL}/resources/{resource_id}", timeout=SERVICE_TIMEOUT)
         if response.status_code == 404:
             raise HTTPException(status_code=404, detail="Recurso no encontrado")
         resource = response.json()
@@ -82,64 +204,333 @@ def verify_resource(resource_id: int, quantity: int = 1):
     except requests.RequestException:
         raise HTTPException(status_code=503, detail="Servicio de recursos no disponible")
 
-def update_resource_status(resource_id: int, status: str):
+def change_resource_quantity(resource_id: int, quantity: int, action: str):
+    # action es "reserve" o "release": el servicio de recursos ajusta las N unidades en una sola transacción
     try:
-        # Actualizamos el estado directamente
-        update_response = requests.put(
-            f"{RESOURCE_SERVICE_URL}/resources/{resource_id}/status",
-            json={"status": status}
+        response = http.post(
+            f"{RESOURCE_SERVICE_URL}/resources/{resource_id}/{action}",
+            json={"quantity": quantity},
+            timeout=SERVICE_TIMEOUT
         )
-        
-        # Si hay un error, intentar obtener el detalle del error
-        if update_response.status_code != 200:
-            try:
-                error_response = update_response.json()
-                error_detail = error_response.get('detail', 'Error desconocido')
-            except Exception:
-                error_detail = f"Error {update_response.status_code}"
-            
-            raise HTTPException(
-                status_code=update_response.status_code,
-                detail=f"Error al actualizar el estado del recurso: {error_detail}"
-            )
-            
-        # Verificar la respuesta
+    except requests.RequestException as e:
+        raise HTTPException(
+            status_code=503,
+            detail=f"Servicio de recursos no disponible: {str(e)}"
+        )
+
+    if response.status_code != 200:
         try:
-            response_data = update_response.json()
-            if response_data.get('status') != status:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"El estado del recurso no se actualizó correctamente"
-                )
-        except Exception as e:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Error al verificar el estado del recurso: {str(e)}"
-            )
-            
+            error_detail = response.json().get('detail', 'Error desconocido')
+        except Exception:
+            error_detail = f"Error {response.status_code}"
+        raise HTTPException(status_code=response.status_code, detail=error_detail)
+    return response.json()
+
+def reserve_resource(resource_id: int, quantity: int):
+    return change_resource_quantity(resource_id, quantity, "reserve")
+
+def release_resource(resource_id: int, quantity: int):
+    return change_resource_quantity(resource_id, quantity, "release")
+
+def change_resource_batch(items: List[BatchLoanItem], action: str):
+    # action es "reserve-batch" o "release-batch": todo el lote se aplica o se rechaza
+    try:
+        response = http.post(
+            f"{RESOURCE_SERVICE_URL}/resources/{action}",
+            json={"items": [item.model_dump() for item in items]},
+            timeout=SERVICE_TIMEOUT
+        )
     except requests.RequestException as e:
         raise HTTPException(
             status_code=503,
             detail=f"Servicio de recursos no disponible: {str(e)}"
         )
 
-def send_notification(student_id: str, message: str):
+    if response.status_code != 200:
+        try:
+            error_detail = response.json().get('detail', 'Error desconocido')
+        except Exception:
+            error_detail = f"Error {response.status_code}"
+        raise HTTPException(status_code=response.status_code, detail=error_detail)
+    return response.json()
+
+# Configuración del despachador de la bandeja de salida
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_INTERVAL = float(os.getenv("OUTBOX_INTERVAL", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "5"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "3600"))
+
+def enqueue_notification(c, student_id: str, message: str):
+    # Se usa el cursor de la transacción en curso: la notificación se guarda junto con el préstamo
+    now = datetime.now().isoformat()
+    c.execute(
+        "INSERT INTO notification_outbox (student_id, message, created_at, next_attempt_at) VALUES (?, ?, ?, ?)",
+        (student_id, message, now, now)
+    )
+
+def deliver_notification(student_id: str, message: str):
+    # Devuelve (entregada, error, definitivo)
     try:
-        notification_data = {
-            "student_id": student_id,
-            "message": message
-        }
-        requests.post(f"{NOTIFICATION_SERVICE_URL}/notify", json=notification_data)
-    except requests.RequestException:
-        # No interrumpimos el proceso si falla la notificación
-        pass
+        response = http.post(
+            f"{NOTIFICATION_SERVICE_URL}/notify",
+            json={"student_id": student_id, "message": message},
+            timeout=SERVICE_TIMEOUT
+        )
+    except requests.RequestException as e:
+        return False, str(e), False
+    if response.status_code < 300:
+        return True, None, False
+    # Un 4xx (p. ej. estudiante inexistente) no se arregla reintentando
+    return False, f"Error {response.status_code}", response.status_code < 500
+
+def dispatch_outbox() -> int:
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        now = datetime.now()
+        c.execute(
+            """SELECT id, student_id, message, attempts FROM notification_outbox
+               WHERE status = 'pendiente' AND next_attempt_at <= ?
+               ORDER BY id LIMIT ?""",
+            (now.isoformat(), OUTBOX_BATCH_SIZE)
+        )
+        rows = c.fetchall()
+
+        sent, failed = [], []
+        for row in rows:
+            delivered, error, permanent = deliver_notification(row["student_id"], row["message"])
+            if delivered:
+                sent.append((datetime.now().isoformat(), row["id"]))
+                continue
+            attempts = row["attempts"] + 1
+            status = "fallido" if permanent or attempts >= OUTBOX_MAX_ATTEMPTS else "pendiente"
+            # Backoff exponencial: 5s, 10s, 20s... hasta OUTBOX_BACKOFF_MAX
+            delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+            next_attempt = (now + timedelta(seconds=delay)).isoformat()
+            failed.append((status, attempts, next_attempt, error, row["id"]))
+
+        c.executemany(
+            "UPDATE notification_outbox SET status = 'enviado', sent_at = ? WHERE id = ?",
+            sent
+        )
+        c.executemany(
+            "UPDATE notification_outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+            failed
+        )
+        conn.commit()
+        return len(rows)
+    finally:
+        conn.close()
+
+outbox_wakeup = threading.Event()
+outbox_stop = threading.Event()
+
+def outbox_dispatcher():
+    while not outbox_stop.is_set():
+        try:
+            processed = dispatch_outbox()
+        except Exception as e:
+            print(f"Error al despachar notificaciones: {str(e)}")
+            processed = 0
+        # Si el lote vino lleno se sigue vaciando sin esperar
+        if processed < OUTBOX_BATCH_SIZE:
+            outbox_wakeup.wait(OUTBOX_INTERVAL)
+            outbox_wakeup.clear()
+
+@app.on_event("startup")
+def start_outbox_dispatcher():
+    outbox_stop.clear()
+    threading.Thread(target=outbox_dispatcher, name="outbox-dispatcher", daemon=True).start()
+
+@app.on_event("shutdown")
+def stop_outbox_dispatcher():
+    outbox_stop.set()
+    outbox_wakeup.set()
+
+def set_loan_view_names(c, student_id: str, student_name: str, resource_names: dict, loan_ids: list):
+    # resource_names: loan_id -> nombre del recurso; va en la misma transacción que el INSERT
+    c.executemany(
+        "UPDATE loan_view SET student_name = ?, resource_name = ? WHERE loan_id = ?",
+        [(student_name, resource_names[loan_id], loan_id) for loan_id in loan_ids]
+    )
+
+# Los nombres se copian al crear el préstamo; un renombrado en el servicio de recursos o de
+# estudiantes llega a la vista en la siguiente revisión, como mucho LOAN_VIEW_REFRESH_INTERVAL después
+LOAN_VIEW_REFRESH_INTERVAL = float(os.getenv("LOAN_VIEW_REFRESH_INTERVAL", "600"))
+LOAN_VIEW_LOOKUP_CHUNK = 500
+
+def refresh_loan_view_names(only_missing: bool = False) -> int:
+    # Vuelve a resolver los nombres de la vista; con only_missing solo los que faltan.
+    # Solo se actualizan las filas cuyo nombre cambió, para no invalidar la ETag del listado sin motivo
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        missing = " WHERE student_name IS NULL" if only_missing else ""
+        c.execute(f"SELECT DISTINCT student_id FROM loan_view{missing}")
+        student_ids = [row[0] for row in c.fetchall()]
+        missing = " WHERE resource_name IS NULL" if only_missing else ""
+        c.execute(f"SELECT DISTINCT resource_id FROM loan_view{missing}")
+        resource_ids = [row[0] for row in c.fetchall()]
+        if not student_ids and not resource_ids:
+            return 0
+
+        student_names = {}
+        for i in range(0, len(student_ids), LOAN_VIEW_LOOKUP_CHUNK):
+            response = http.post(f"{STUDENT_SERVICE_URL}/students/lookup",
+                                 json={"student_ids": student_ids[i:i + LOAN_VIEW_LOOKUP_CHUNK]},
+                                 timeout=SERVICE_TIMEOUT)
+            response.raise_for_status()
+            student_names.update({s["student_id"]: s["name"] for s in response.json()["students"]})
+        resource_names = {}
+        if resource_ids:
+            # Se recorre el listado por cursor (pocas peticiones de 500) en lugar de un GET por recurso
+            wanted = set(resource_ids)
+            params = {"limit": LOAN_VIEW_LOOKUP_CHUNK}
+            while True:
+                response = http.get(f"{RESOURCE_SERVICE_URL}/resources/", params=params, timeout=SERVICE_TIMEOUT)
+                response.raise_for_status()
+                resource_names.update({r["id"]: r["name"] for r in response.json() if r["id"] in wanted})
+                next_cursor = response.headers.get("X-Next-Cursor")
+                if not next_cursor:
+                    break
+                params["cursor"] = next_cursor
+
+        c.executemany(
+            "UPDATE loan_view SET student_name = ? WHERE student_id = ? AND student_name IS NOT ?",
+            [(name, student_id, name) for student_id, name in student_names.items()]
+        )
+        updated = c.rowcount if c.rowcount > 0 else 0
+        c.executemany(
+            "UPDATE loan_view SET resource_name = ? WHERE resource_id = ? AND resource_name IS NOT ?",
+            [(name, resource_id, name) for resource_id, name in resource_names.items()]
+        )
+        updated += c.rowcount if c.rowcount > 0 else 0
+        conn.commit()
+        return updated
+    finally:
+        conn.close()
+
+def backfill_loan_view() -> int:
+    # Completa los nombres de préstamos anteriores a la proyección o creados sin ellos
+    return refresh_loan_view_names(only_missing=True)
+
+loan_view_stop = threading.Event()
+
+def loan_view_refresher():
+    # Al arrancar solo se completan los nombres que faltan; después se revisan todos periódicamente
+    only_missing = True
+    while not loan_view_stop.is_set():
+        try:
+            refresh_loan_view_names(only_missing=only_missing)
+        except (requests.RequestException, sqlite3.Error) as e:
+            print(f"Error al actualizar la vista de préstamos: {str(e)}")
+        only_missing = False
+        loan_view_stop.wait(LOAN_VIEW_REFRESH_INTERVAL)
+
+@app.on_event("startup")
+def start_loan_view_refresher():
+    loan_view_stop.clear()
+    threading.Thread(target=loan_view_refresher, name="loan-view-refresher", daemon=True).start()
+
+@app.on_event("shutdown")
+def stop_loan_view_refresher():
+    loan_view_stop.set()
+
+# Configuración del revisor de préstamos vencidos
+OVERDUE_SCAN_INTERVAL = float(os.getenv("OVERDUE_SCAN_INTERVAL", "300"))
+OVERDUE_BATCH_SIZE = int(os.getenv("OVERDUE_BATCH_SIZE", "500"))
+
+def scan_overdue(now: datetime | None = None) -> int:
+    now_iso = (now or datetime.now()).isoformat()
+    total = 0
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        while True:
+            c.execute("BEGIN IMMEDIATE")
+            # Todos los préstamos abiertos ya vencidos, usando el índice (status, due_date). Los ya
+            # marcados salen del rango al pasar a 'vencido', así que el coste depende solo de los
+            # nuevos; no hace falta marca de agua y un préstamo reabierto o prorrogado a una fecha
+            # pasada también se detecta
+            c.execute(
+                """SELECT id, student_id, due_date FROM loans
+                   WHERE status = 'prestado' AND due_date < ?
+                   ORDER BY due_date LIMIT ?""",
+                (now_iso, OVERDUE_BATCH_SIZE)
+            )
+            rows = c.fetchall()
+            if not rows:
+                conn.rollback()
+                return total
+
+            ids = [r["id"] for r in rows]
+            c.execute(
+                f"UPDATE loans SET status = 'vencido' WHERE id IN ({', '.join('?' * len(ids))})",
+                ids
+            )
+
+            # Una notificación por estudiante con todos sus préstamos vencidos del lote
+            by_student = {}
+            for r in rows:
+                by_student.setdefault(r["student_id"], []).append(r)
+            for student_id, loans in by_student.items():
+                detail = ", ".join(f"#{r['id']} (vencía el {r['due_date'].split('T')[0]})" for r in loans)
+                enqueue_notification(
+                    c,
+                    student_id,
+                    f"Tienes préstamos vencidos: {detail}. Por favor, devuelve los recursos lo antes posible."
+                )
+
+            conn.commit()
+            outbox_wakeup.set()
+            total += len(rows)
+            if len(rows) < OVERDUE_BATCH_SIZE:
+                return total
+    finally:
+        conn.close()
+
+scanner_stop = threading.Event()
+
+def overdue_scanner():
+    while not scanner_stop.is_set():
+        try:
+            marked = scan_overdue()
+            if marked:
+                print(f"Préstamos marcados como vencidos: {marked}")
+        except Exception as e:
+            print(f"Error al revisar préstamos vencidos: {str(e)}")
+        scanner_stop.wait(OVERDUE_SCAN_INTERVAL)
+
+@app.on_event("startup")
+def start_overdue_scanner():
+    scanner_stop.clear()
+    threading.Thread(target=overdue_scanner, name="overdue-scanner", daemon=True).start()
+
+@app.on_event("shutdown")
+def stop_overdue_scanner():
+    scanner_stop.set()
+
+@app.post("/loans/overdue/scan")
+def run_overdue_scan():
+    # Permite lanzar la revisión sin esperar al siguiente ciclo
+    return {"marked_overdue": scan_overdue()}
 
 @app.post("/loans/", response_model=Loan)
-def create_loan(loan: Loan):
-    # Verificar estudiante y recurso
-    student = verify_student(loan.student_id)
-    resource = verify_resource(loan.resource_id, loan.quantity)
+def create_loan(loan: Loan, response: Response):
+    timer = StageTimer()
+
+    # Verificar estudiante y recurso: son consultas independientes, se hacen en paralelo
+    with timer.stage("validate"):
+        student_lookup = lookup_executor.submit(verify_student, loan.student_id)
+        resource_lookup = lookup_executor.submit(verify_resource, loan.resource_id, loan.quantity)
+        student = student_lookup.result()
+        resource = resource_lookup.result()
     
+    # Reservar las unidades: el servicio de recursos lo hace de forma atómica
+    with timer.stage("reserve"):
+        reserve_resource(loan.resource_id, loan.quantity)
+
     # Crear el préstamo
     conn = get_db()
     try:
@@ -149,46 +540,148 @@ def create_loan(loan: Loan):
         # Establecer fecha de vencimiento a 7 días después
         due_date = (now + timedelta(days=7)).isoformat()
         
-        c.execute(
-            "INSERT INTO loans (student_id, resource_id, quantity, loan_date, due_date, status) VALUES (?, ?, ?, ?, ?, ?)",
-            (loan.student_id, loan.resource_id, loan.quantity, loan.loan_date, due_date, loan.status)
-        )
-        conn.commit()
-        loan.id = c.lastrowid
-        
-        # Actualizar estado del recurso para cada unidad prestada
-        for _ in range(loan.quantity):
-            update_resource_status(loan.resource_id, "prestado")
-        
-        # Enviar notificación
-        send_notification(
-            loan.student_id,
-            f"Se ha registrado un préstamo del recurso {resource['name']}. "
-            f"Por favor, devuélvelo antes del {due_date.split('T')[0]}."
-        )
+        with timer.stage("db"):
+            try:
+                c.execute(
+                    "INSERT INTO loans (student_id, resource_id, quantity, loan_date, due_date, status) VALUES (?, ?, ?, ?, ?, ?)",
+                    (loan.student_id, loan.resource_id, loan.quantity, loan.loan_date, due_date, loan.status)
+                )
+                loan.id = c.lastrowid
+                set_loan_view_names(c, loan.student_id, student["name"], {loan.id: resource["name"]}, [loan.id])
+                enqueue_notification(
+                    c,
+                    loan.student_id,
+                    f"Se ha registrado un préstamo del recurso {resource['name']}. "
+                    f"Por favor, devuélvelo antes del {due_date.split('T')[0]}."
+                )
+                conn.commit()
+            except sqlite3.Error:
+                # Si no se pudo registrar el préstamo se devuelven las unidades reservadas
+                conn.rollback()
+                release_resource(loan.resource_id, loan.quantity)
+                raise HTTPException(status_code=500, detail="Error al registrar el préstamo")
+        loan.due_date = due_date
+        outbox_wakeup.set()
         
+        response.headers["Server-Timing"] = timer.header()
         return loan
     finally:
         conn.close()
 
-@app.get("/loans/")
-def get_loans():
+@app.post("/loans/batch", response_model=List[Loan])
+def create_batch_loan(batch: BatchLoan, response: Response):
+    timer = StageTimer()
+
+    with timer.stage("validate"):
+        student = verify_student(batch.student_id)
+
+    # Valida y reserva todos los recursos en una sola transacción del servicio de recursos
+    with timer.stage("reserve"):
+        resources = {r["id"]: r for r in change_resource_batch(batch.items, "reserve-batch")}
+
+    now = datetime.now()
+    loan_date = now.isoformat()
+    due_date = (now + timedelta(days=7)).isoformat()
+    rows = [
+        (batch.student_id, item.resource_id, item.quantity, loan_date, due_date, "prestado")
+        for item in batch.items
+    ]
+
     conn = get_db()
     try:
         c = conn.cursor()
-        c.execute("SELECT * FROM loans ORDER BY id")
-        loans = c.fetchall()
+        with timer.stage("db"):
+            try:
+                c.executemany(
+                    "INSERT INTO loans (student_id, resource_id, quantity, loan_date, due_date, status) VALUES (?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+                # Dentro de la transacción los ids asignados son consecutivos
+                c.execute("SELECT last_insert_rowid()")
+                last_id = c.fetchone()[0]
+                loan_ids = list(range(last_id - len(rows) + 1, last_id + 1))
+                set_loan_view_names(
+                    c, batch.student_id, student["name"],
+                    {loan_id: resources[item.resource_id]["name"] for loan_id, item in zip(loan_ids, batch.items)},
+                    loan_ids
+                )
+                # Una única notificación con todos los recursos prestados
+                names = ", ".join(f"{resources[item.resource_id]['name']} (x{item.quantity})" for item in batch.items)
+                enqueue_notification(
+                    c,
+                    batch.student_id,
+                    f"Se ha registrado un préstamo de los recursos: {names}. "
+                    f"Por favor, devuélvelos antes del {due_date.split('T')[0]}."
+                )
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                change_resource_batch(batch.items, "release-batch")
+                raise HTTPException(status_code=500, detail="Error al registrar los préstamos")
+    finally:
+        conn.close()
+
+    first_id = last_id - len(rows) + 1
+    loans = [
+        Loan(id=first_id + i, student_id=row[0], resource_id=row[1], quantity=row[2],
+             loan_date=row[3], due_date=row[4], status=row[5])
+        for i, row in enumerate(rows)
+    ]
+    outbox_wakeup.set()
+
+    response.headers["Server-Timing"] = timer.header()
+    return loans
+
+def row_to_loan(row) -> Loan:
+    # Por nombre de columna: la tabla tiene quantity entre resource_id y loan_date
+    return Loan(
+        id=row["id"],
+        student_id=row["student_id"],
+        resource_id=row["resource_id"],
+        quantity=row["quantity"],
+        loan_date=row["loan_date"],
+        due_date=row["due_date"],
+        return_date=row["return_date"],
+        status=row["status"]
+    )
+
+def loan_filters(status: Optional[str], student_id: Optional[str], resource_id: Optional[int] = None,
+                 loaned_from: Optional[str] = None, loaned_to: Optional[str] = None) -> list:
+    # Las fechas son ISO 8601, así que se comparan como texto
+    filters = []
+    if status:
+        filters.append(("status = ?", status))
+    if student_id:
+        filters.append(("student_id = ?", student_id))
+    if resource_id is not None:
+        filters.append(("resource_id = ?", resource_id))
+    if loaned_from:
+        filters.append(("loan_date >= ?", loaned_from))
+    if loaned_to:
+        filters.append(("loan_date < ?", loaned_to))
+    return filters
+
+@app.get("/loans/")
+def get_loans(request: Request, response: Response, cursor: Optional[int] = None, limit: Optional[int] = None,
+              status: Optional[str] = None, student_id: Optional[str] = None, resource_id: Optional[int] = None,
+              loaned_from: Optional[str] = None, loaned_to: Optional[str] = None):
+    conn = get_db()
+    try:
+        if check_etag(conn, "loans", request, response):
+            return Response(status_code=304, headers={"ETag": response.headers["ETag"]})
+        filters = loan_filters(status, student_id, resource_id, loaned_from, loaned_to)
+        loans = keyset_page(conn, "loans", filters, response, cursor, limit)
         
         # Convertir los resultados a una lista de diccionarios
         result = [{
-            "id": l[0],
-            "student_id": str(l[1]),  # Convertir a string
-            "resource_id": str(l[2]),  # Convertir a string
-            "quantity": l[3],
-            "loan_date": l[4],
-            "due_date": l[5],
-            "return_date": l[6],
-            "status": l[7]
+            "id": l["id"],
+            "student_id": str(l["student_id"]),  # Convertir a string
+            "resource_id": str(l["resource_id"]),  # Convertir a string
+            "quantity": l["quantity"],
+            "loan_date": l["loan_date"],
+            "due_date": l["due_date"],
+            "return_date": l["return_date"],
+            "status": l["status"]
         } for l in loans]
         
         return result
@@ -197,23 +690,34 @@ def get_loans():
     finally:
         conn.close()
 
+@app.get("/loans/view")
+def get_loan_view(request: Request, response: Response, cursor: Optional[int] = None, limit: int = 50,
+                  status: Optional[str] = None, student_id: Optional[str] = None,
+                  loaned_from: Optional[str] = None, loaned_to: Optional[str] = None):
+    # Préstamos con nombres de recurso y estudiante, del más reciente al más antiguo
+    conn = get_db()
+    try:
+        if check_etag(conn, "loan_view", request, response):
+            return Response(status_code=304, headers={"ETag": response.headers["ETag"]})
+        filters = loan_filters(status, student_id, loaned_from=loaned_from, loaned_to=loaned_to)
+        rows = keyset_page(conn, "loan_view", filters, response, cursor, limit, key="loan_id", descending=True)
+        return [{**dict(row), "id": row["loan_id"]} for row in rows]
+    finally:
+        conn.close()
+
 @app.get("/loans/{loan_id}", response_model=Loan)
 def get_loan(loan_id: int):
     conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT * FROM loans WHERE id = ?", (loan_id,))
-    row = c.fetchone()
-    if row is None:
-        raise HTTPException(status_code=404, detail="Préstamo no encontrado")
-    return Loan(
-        id=row[0],
-        student_id=row[1],
-        resource_id=row[2],
-        loan_date=row[3],
-        due_date=row[4],
-        return_date=row[5],
-        status=row[6]
-    )
+    try:
+        c = conn.cursor()
+        c.execute("SELECT * FROM loans WHERE id = ?", (loan_id,))
+        row = c.fetchone()
+        if row is None:
+            raise HTTPException(status_code=404, detail="Préstamo no encontrado")
+        return row_to_loan(row)
+    finally:
+        # Con el pool es obligatorio devolver la conexión
+        conn.close()
 
 @app.put("/loans/{loan_id}", response_model=Loan)
 def update_loan(loan_id: int, loan: Loan):
@@ -235,16 +739,9 @@ def update_loan(loan_id: int, loan: Loan):
         
         # Obtener el préstamo actualizado
         c.execute("SELECT * FROM loans WHERE id = ?", (loan_id,))
-        updated_loan = c.fetchone()
-        return Loan(
-            id=updated_loan[0],
-            student_id=updated_loan[1],
-            resource_id=updated_loan[2],
-            loan_date=updated_loan[3],
-            due_date=updated_loan[4],
-            return_date=updated_loan[5],
-            status=updated_loan[6]
-        )
+        return row_to_loan(c.fetchone())
+    except HTTPException:
+        raise
     except Exception as e:
         conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
@@ -257,20 +754,7 @@ def get_student_loans(student_id: str):
     try:
         c = conn.cursor()
         c.execute("SELECT * FROM loans WHERE student_id = ?", (student_id,))
-        loans = []
-        for row in c.fetchall():
-            loans.append(
-                Loan(
-                    id=row[0],
-                    student_id=row[1],
-                    resource_id=row[2],
-                    loan_date=row[3],
-                    due_date=row[4],
-                    return_date=row[5],
-                    status=row[6]
-                )
-            )
-        return loans
+        return [row_to_loan(row) for row in c.fetchall()]
     finally:
         conn.close()
 
@@ -286,19 +770,20 @@ def return_loan(loan_id: int):
         if row is None:
             raise HTTPException(status_code=404, detail="Préstamo no encontrado")
             
-        if row[6] == 'devuelto':  # row[6] es el status
+        if row["status"] == 'devuelto':
             raise HTTPException(status_code=400, detail="El préstamo ya fue devuelto")
         
         # Obtener los datos del préstamo
-        loan_id = row[0]
-        student_id = row[1]
-        resource_id = row[2]
-        loan_date = row[3]
-        due_date = row[4]
+        loan_id = row["id"]
+        student_id = row["student_id"]
+        resource_id = row["resource_id"]
+        quantity = row["quantity"]
+        loan_date = row["loan_date"]
+        due_date = row["due_date"]
         
         try:
-            # Actualizar estado del recurso primero
-            update_resource_status(resource_id, "disponible")
+            # Liberar primero todas las unidades del préstamo
+            release_resource(resource_id, quantity)
             
             # Si se actualizó el recurso correctamente, actualizar el préstamo
             return_date = datetime.now().isoformat()
@@ -306,22 +791,19 @@ def return_loan(loan_id: int):
                 "UPDATE loans SET status = 'devuelto', return_date = ? WHERE id = ?",
                 (return_date, loan_id)
             )
+            enqueue_notification(
+                c,
+                student_id,
+                f"Se ha registrado la devolución del recurso correctamente."
+            )
             conn.commit()
-            
-            # Enviar notificación
-            try:
-                send_notification(
-                    student_id,
-                    f"Se ha registrado la devolución del recurso correctamente."
-                )
-            except Exception as e:
-                # Si falla la notificación, solo lo registramos pero no revertimos la operación
-                print(f"Error al enviar notificación: {str(e)}")
+            outbox_wakeup.set()
             
             return Loan(
                 id=loan_id,
                 student_id=student_id,
                 resource_id=resource_id,
+                quantity=quantity,
                 loan_date=loan_date,
                 due_date=due_date,
                 return_date=return_date,
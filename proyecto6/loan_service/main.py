@@ -1,13 +1,20 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Query, Response, status
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 from pydantic import BaseModel
 from datetime import datetime, timedelta
 import os
 from dotenv import load_dotenv
-import requests
+import asyncio
+import httpx
+import sys
+
+# Allow importing the shared package when the service runs from its own folder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.auth import InvalidTokenError, create_verifier
+from common.pagination import keyset_query
 
 load_dotenv()
 
@@ -20,9 +27,11 @@ Base = declarative_base()
 # Models
 class Loan(Base):
     __tablename__ = "loans"
+    # Student history, per-resource lookups and overdue range scans
+    __table_args__ = (Index("ix_loans_status_due_date", "status", "due_date"),)
     id = Column(Integer, primary_key=True, index=True)
-    resource_id = Column(Integer)
-    student_id = Column(String)
+    resource_id = Column(Integer, index=True)
+    student_id = Column(String, index=True)
     loan_date = Column(DateTime, default=datetime.utcnow)
     due_date = Column(DateTime)
     return_date = Column(DateTime, nullable=True)
@@ -30,6 +39,19 @@ class Loan(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+class NotificationOutbox(Base):
+    # Notification intents written in the same transaction as the loan change
+    __tablename__ = "notification_outbox"
+    id = Column(Integer, primary_key=True, index=True)
+    student_id = Column(String, nullable=False)
+    message = Column(String, nullable=False)
+    status = Column(String, default="pending", index=True)  # pending, sent, failed
+    attempts = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow, index=True)
+    sent_at = Column(DateTime, nullable=True)
+    last_error = Column(String, nullable=True)
+
 # Schemas
 class LoanBase(BaseModel):
     resource_id: int
@@ -52,6 +74,9 @@ class LoanResponse(LoanBase):
 
 # Database initialization
 Base.metadata.create_all(bind=engine)
+# create_all skips tables that already exist, so add any index they are missing
+for index in Loan.__table__.indexes:
+    index.create(bind=engine, checkfirst=True)
 
 # FastAPI app
 app = FastAPI(title="Loan Service",
@@ -75,62 +100,181 @@ def get_db():
     finally:
         db.close()
 
-# Authentication middleware
-async def verify_token(token: str):
-    auth_service_url = os.getenv("AUTH_SERVICE_URL", "http://localhost:8000")
+# Authentication middleware: the JWT is verified locally, without calling auth_service
+token_verifier = create_verifier()
+
+def verify_token(token: str):
     try:
-        response = requests.get(
-            f"{auth_service_url}/validate-token",
-            headers={"Authorization": f"Bearer {token}"}
-        )
-        if response.status_code == 200:
-            return response.json()
-        return None
-    except:
+        return token_verifier.verify(token)
+    except InvalidTokenError:
         return None
 
+# Shared pooled HTTP client for calls to other services
+RESOURCE_SERVICE_URL = os.getenv("RESOURCE_SERVICE_URL", "http://localhost:8001")
+STUDENT_SERVICE_URL = os.getenv("STUDENT_SERVICE_URL", "http://localhost:8002")
+NOTIFICATION_SERVICE_URL = os.getenv("NOTIFICATION_SERVICE_URL", "http://localhost:8004")
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "50"))
+RESOURCE_TIMEOUT = float(os.getenv("RESOURCE_SERVICE_TIMEOUT", "5"))
+STUDENT_TIMEOUT = float(os.getenv("STUDENT_SERVICE_TIMEOUT", "5"))
+NOTIFICATION_TIMEOUT = float(os.getenv("NOTIFICATION_SERVICE_TIMEOUT", "2"))
+
+http_client: httpx.AsyncClient | None = None
+
+def get_http_client() -> httpx.AsyncClient:
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS),
+            timeout=httpx.Timeout(RESOURCE_TIMEOUT),
+        )
+    return http_client
+
+@app.on_event("startup")
+async def open_http_client():
+    get_http_client()
+
+@app.on_event("shutdown")
+async def close_http_client():
+    if http_client is not None:
+        await http_client.aclose()
+
 # Helper functions
 async def check_resource_availability(resource_id: int):
-    resource_service_url = os.getenv("RESOURCE_SERVICE_URL", "http://localhost:8001")
     try:
-        response = requests.get(f"{resource_service_url}/resources/{resource_id}")
-        if response.status_code == 200:
-            resource = response.json()
-            return resource["status"] == "available"
-        return False
-    except:
+        response = await get_http_client().get(
+            f"{RESOURCE_SERVICE_URL}/resources/{resource_id}",
+            timeout=RESOURCE_TIMEOUT
+        )
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Resource service unavailable")
+    if response.status_code == 200:
+        resource = response.json()
+        return resource["status"] == "available"
+    return False
 
 async def check_student_exists(student_id: str):
-    student_service_url = os.getenv("STUDENT_SERVICE_URL", "http://localhost:8002")
     try:
-        response = requests.get(f"{student_service_url}/students/{student_id}")
-        return response.status_code == 200
-    except:
+        response = await get_http_client().get(
+            f"{STUDENT_SERVICE_URL}/students/{student_id}",
+            timeout=STUDENT_TIMEOUT
+        )
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Student service unavailable")
+    return response.status_code == 200
 
 async def update_resource_status(resource_id: int, status: str, token: str):
-    resource_service_url = os.getenv("RESOURCE_SERVICE_URL", "http://localhost:8001")
     try:
-        response = requests.put(
-            f"{resource_service_url}/resources/{resource_id}/status",
+        response = await get_http_client().put(
+            f"{RESOURCE_SERVICE_URL}/resources/{resource_id}/status",
             params={"status": status},
-            headers={"Authorization": f"Bearer {token}"}
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=RESOURCE_TIMEOUT
         )
-        return response.status_code == 200
-    except:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Resource service unavailable")
+    return response.status_code == 200
+
+# Notification outbox
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_INTERVAL = float(os.getenv("OUTBOX_INTERVAL", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "5"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "3600"))
+
+outbox_wakeup = asyncio.Event()
+outbox_task: asyncio.Task | None = None
+
+def enqueue_notification(db: Session, student_id: str, message: str):
+    # Added to the caller's session so it is committed together with the loan
+    db.add(NotificationOutbox(student_id=student_id, message=message))
 
-async def send_notification(student_id: str, message: str):
-    notification_service_url = os.getenv("NOTIFICATION_SERVICE_URL", "http://localhost:8004")
+async def deliver_notification(student_id: str, message: str):
+    # Returns (delivered, error, permanent)
     try:
-        requests.post(
-            f"{notification_service_url}/notify",
-            json={"student_id": student_id, "message": message}
+        response = await get_http_client().post(
+            f"{NOTIFICATION_SERVICE_URL}/notify",
+            json={"student_id": student_id, "message": message},
+            timeout=NOTIFICATION_TIMEOUT
         )
-    except:
-        # Log error but don't fail the request
-        print(f"Failed to send notification to student {student_id}")
+    except httpx.RequestError as e:
+        return False, str(e), False
+    if response.status_code < 300:
+        return True, None, False
+    # A 4xx will not succeed on retry
+    return False, f"HTTP {response.status_code}", response.status_code < 500
+
+def fetch_pending_notifications():
+    db = SessionLocal()
+    try:
+        rows = (
+            db.query(NotificationOutbox)
+            .filter(NotificationOutbox.status == "pending", NotificationOutbox.next_attempt_at <= datetime.utcnow())
+            .order_by(NotificationOutbox.id)
+            .limit(OUTBOX_BATCH_SIZE)
+            .all()
+        )
+        return [(row.id, row.student_id, row.message, row.attempts) for row in rows]
+    finally:
+        db.close()
+
+def record_delivery_results(results):
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        for outbox_id, attempts, delivered, error, permanent in results:
+            row = db.get(NotificationOutbox, outbox_id)
+            if delivered:
+                row.status = "sent"
+                row.sent_at = now
+                continue
+            row.attempts = attempts + 1
+            row.last_error = error
+            if permanent or row.attempts >= OUTBOX_MAX_ATTEMPTS:
+                row.status = "failed"
+            else:
+                # Exponential backoff: 5s, 10s, 20s... capped at OUTBOX_BACKOFF_MAX
+                delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (row.attempts - 1))
+                row.next_attempt_at = now + timedelta(seconds=delay)
+        db.commit()
+    finally:
+        db.close()
+
+async def dispatch_outbox() -> int:
+    pending = await asyncio.to_thread(fetch_pending_notifications)
+    if not pending:
+        return 0
+    outcomes = await asyncio.gather(*(deliver_notification(student_id, message) for _, student_id, message, _ in pending))
+    results = [
+        (outbox_id, attempts, *outcome)
+        for (outbox_id, _, _, attempts), outcome in zip(pending, outcomes)
+    ]
+    await asyncio.to_thread(record_delivery_results, results)
+    return len(pending)
+
+async def outbox_dispatcher():
+    while True:
+        try:
+            processed = await dispatch_outbox()
+        except Exception as e:
+            print(f"Outbox dispatch failed: {e}")
+            processed = 0
+        # Keep draining without waiting while batches come back full
+        if processed < OUTBOX_BATCH_SIZE:
+            try:
+                await asyncio.wait_for(outbox_wakeup.wait(), timeout=OUTBOX_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            outbox_wakeup.clear()
+
+@app.on_event("startup")
+async def start_outbox_dispatcher():
+    global outbox_task
+    outbox_task = asyncio.create_task(outbox_dispatcher())
+
+@app.on_event("shutdown")
+async def stop_outbox_dispatcher():
+    if outbox_task is not None:
+        outbox_task.cancel()
 
 # Routes
 @app.post("/loans/", response_model=LoanResponse)
@@ -161,24 +305,30 @@ async def create_loan(
         status="active"
     )
     db.add(db_loan)
+    enqueue_notification(
+        db,
+        loan.student_id,
+        f"Resource {loan.resource_id} has been loaned to you. Due date: {loan.due_date}"
+    )
     db.commit()
     db.refresh(db_loan)
+    outbox_wakeup.set()
 
     # Update resource status
     await update_resource_status(loan.resource_id, "borrowed", authorization)
 
-    # Send notification
-    await send_notification(
-        loan.student_id,
-        f"Resource {loan.resource_id} has been loaned to you. Due date: {loan.due_date}"
-    )
-
     return db_loan
 
 @app.get("/loans/", response_model=list[LoanResponse])
 async def list_loans(
-    skip: int = 0,
-    limit: int = 100,
+    response: Response,
+    cursor: int | None = None,
+    limit: int | None = None,
+    status_filter: str | None = Query(None, alias="status"),
+    student_id: str | None = None,
+    resource_id: int | None = None,
+    loaned_from: datetime | None = None,
+    loaned_to: datetime | None = None,
     db: Session = Depends(get_db),
     authorization: str = Depends(verify_token)
 ):
@@ -187,8 +337,19 @@ async def list_loans(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials"
         )
-    loans = db.query(Loan).offset(skip).limit(limit).all()
-    return loans
+    query = db.query(Loan)
+    if status_filter:
+        query = query.filter(Loan.status == status_filter)
+    if student_id:
+        query = query.filter(Loan.student_id == student_id)
+    if resource_id is not None:
+        query = query.filter(Loan.resource_id == resource_id)
+    if loaned_from:
+        query = query.filter(Loan.loan_date >= loaned_from)
+    if loaned_to:
+        query = query.filter(Loan.loan_date < loaned_to)
+    # Keyset pagination on id: pass X-Next-Cursor back as ?cursor=
+    return keyset_query(query, Loan.id, response, cursor, limit)
 
 @app.get("/loans/student/{student_id}", response_model=list[LoanResponse])
 async def get_student_loans(
@@ -226,17 +387,17 @@ async def return_loan(
 
     loan.return_date = datetime.utcnow()
     loan.status = "returned"
+    enqueue_notification(
+        db,
+        loan.student_id,
+        f"Resource {loan.resource_id} has been returned successfully."
+    )
     db.commit()
+    outbox_wakeup.set()
 
     # Update resource status
     await update_resource_status(loan.resource_id, "available", authorization)
 
-    # Send notification
-    await send_notification(
-        loan.student_id,
-        f"Resource {loan.resource_id} has been returned successfully."
-    )
-
     return {"message": "Loan returned successfully"}
 
 @app.get("/loans/{loan_id}", response_model=LoanResponse)
@@ -1,11 +1,20 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request
+from pydantic import BaseModel, ValidationError
+from typing import Dict, List, Optional
+import asyncio
+import json
 import os
+import re
+import sys
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
-import requests
+import httpx
 from dotenv import load_dotenv
 
+# Permite importar el paquete compartido cuando el servicio se ejecuta desde su carpeta
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.cache import TTLCache
+
 load_dotenv()
 
 app = FastAPI()
@@ -14,53 +23,233 @@ app = FastAPI()
 SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY")
 STUDENT_SERVICE_URL = os.getenv("STUDENT_SERVICE_URL", "http://localhost:8002")
 FROM_EMAIL = os.getenv("FROM_EMAIL", "universidad@example.com")
+STUDENT_SERVICE_TIMEOUT = float(os.getenv("STUDENT_SERVICE_TIMEOUT", "5"))
+EMAIL_CACHE_SIZE = int(os.getenv("EMAIL_CACHE_SIZE", "10000"))
+EMAIL_CACHE_TTL = float(os.getenv("EMAIL_CACHE_TTL", "600"))
+# Los estudiantes inexistentes se recuerdan menos tiempo por si se registran después
+EMAIL_NEGATIVE_TTL = float(os.getenv("EMAIL_NEGATIVE_TTL", "60"))
+# Envíos masivos
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "10000"))
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "10"))
 
 # Modelo de datos
 class Notification(BaseModel):
     student_id: str
     message: str
 
-def get_student_email(student_id: str):
-    try:
-        response = requests.get(f"{STUDENT_SERVICE_URL}/students/by-student-id/{student_id}")
+class Prefetch(BaseModel):
+    student_ids: List[str]
+
+class BulkItem(BaseModel):
+    student_id: str
+    message: Optional[str] = None
+    template: Optional[str] = None
+    context: Dict[str, str | int | float] = {}
+
+# Solo {nombre}: sin acceso a atributos ni índices ({email.__class__} queda tal cual). {{ y }} son llaves literales
+PLACEHOLDER = re.compile(r"\{\{|\}\}|\{(\w+)\}")
+
+# Caché student_id -> email; None marca a un estudiante que no existe
+email_cache = TTLCache(EMAIL_CACHE_SIZE, EMAIL_CACHE_TTL)
+NOT_CACHED = object()
+student_service_calls = 0
+
+http_client: httpx.AsyncClient | None = None
+
+def get_http_client() -> httpx.AsyncClient:
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = httpx.AsyncClient(timeout=STUDENT_SERVICE_TIMEOUT)
+    return http_client
+
+@app.on_event("shutdown")
+async def close_http_client():
+    if http_client is not None:
+        await http_client.aclose()
+
+def cache_email(student_id: str, email: str | None):
+    if email is None:
+        email_cache.set(student_id, None, ttl=EMAIL_NEGATIVE_TTL)
+    else:
+        email_cache.set(student_id, email)
+
+async def get_student_email(student_id: str):
+    global student_service_calls
+    email = email_cache.get(student_id, NOT_CACHED)
+    if email is NOT_CACHED:
+        student_service_calls += 1
+        try:
+            response = await get_http_client().get(f"{STUDENT_SERVICE_URL}/students/by-student-id/{student_id}")
+        except httpx.RequestError:
+            raise HTTPException(status_code=503, detail="Servicio de estudiantes no disponible")
         if response.status_code == 404:
-            raise HTTPException(status_code=404, detail="Estudiante no encontrado")
-        student = response.json()
-        return student["email"]
-    except requests.RequestException:
+            email = None
+        elif response.status_code == 200:
+            email = response.json()["email"]
+        else:
+            raise HTTPException(status_code=503, detail="Servicio de estudiantes no disponible")
+        cache_email(student_id, email)
+    if email is None:
+        raise HTTPException(status_code=404, detail="Estudiante no encontrado")
+    return email
+
+async def prefetch_emails(student_ids: List[str]) -> dict:
+    global student_service_calls
+    # Solo se consultan los que no están en caché, todos en una sola petición
+    pending = [sid for sid in dict.fromkeys(student_ids) if email_cache.get(sid, NOT_CACHED) is NOT_CACHED]
+    result = {"requested": len(student_ids), "cached": len(set(student_ids)) - len(pending), "fetched": 0, "missing": []}
+    if not pending:
+        return result
+    student_service_calls += 1
+    try:
+        response = await get_http_client().post(
+            f"{STUDENT_SERVICE_URL}/students/lookup",
+            json={"student_ids": pending}
+        )
+        response.raise_for_status()
+    except httpx.HTTPError:
         raise HTTPException(status_code=503, detail="Servicio de estudiantes no disponible")
+    data = response.json()
+    for student in data["students"]:
+        cache_email(student["student_id"], student["email"])
+    for student_id in data["missing"]:
+        cache_email(student_id, None)
+    result["fetched"] = len(data["students"])
+    result["missing"] = data["missing"]
+    return result
+
+sendgrid_client: SendGridAPIClient | None = None
+
+async def send_email(to_email: str, content: str) -> bool:
+    # Devuelve True si el correo se envió de verdad y False si solo se simuló
+    global sendgrid_client
+    if not SENDGRID_API_KEY:
+        print(f"Simulando envío de email a {to_email}: {content}")
+        return False
+    if sendgrid_client is None:
+        sendgrid_client = SendGridAPIClient(SENDGRID_API_KEY)
+    message = Mail(
+        from_email=FROM_EMAIL,
+        to_emails=to_email,
+        subject='Notificación del Sistema de Préstamos',
+        html_content=content
+    )
+    # El cliente de SendGrid es bloqueante, se ejecuta fuera del event loop
+    await asyncio.to_thread(sendgrid_client.send, message)
+    return True
 
 @app.post("/notify")
 async def send_notification(notification: Notification):
     try:
         # Obtener el email del estudiante
-        student_email = get_student_email(notification.student_id)
-        
-        # Crear el mensaje
-        message = Mail(
-            from_email=FROM_EMAIL,
-            to_emails=student_email,
-            subject='Notificación del Sistema de Préstamos',
-            html_content=notification.message
-        )
+        student_email = await get_student_email(notification.student_id)
         
-        # Enviar el email si hay API key configurada
-        if SENDGRID_API_KEY:
-            try:
-                sg = SendGridAPIClient(SENDGRID_API_KEY)
-                response = sg.send(message)
-                return {"status": "success", "message": "Notificación enviada"}
-            except Exception as e:
-                print(f"Error al enviar email: {str(e)}")
-                return {"status": "error", "message": "Error al enviar la notificación por email"}
-        else:
-            # Si no hay API key, solo simulamos el envío
-            print(f"Simulando envío de email a {student_email}: {notification.message}")
-            return {"status": "success", "message": "Notificación simulada"}
+        try:
+            sent = await send_email(student_email, notification.message)
+        except Exception as e:
+            print(f"Error al enviar email: {str(e)}")
+            return {"status": "error", "message": "Error al enviar la notificación por email"}
+        if sent:
+            return {"status": "success", "message": "Notificación enviada"}
+        return {"status": "success", "message": "Notificación simulada"}
             
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def read_bulk_items(request: Request, template: Optional[str]):
+    # Acepta una lista JSON o un cuerpo NDJSON (un objeto por línea) que se lee a medida que llega
+    raw_items = []
+    if "ndjson" in request.headers.get("content-type", ""):
+        buffer = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            raw_items.extend(line for line in lines if line.strip())
+            if len(raw_items) > BULK_MAX_ITEMS:
+                break
+        if buffer.strip():
+            raw_items.append(buffer)
+    else:
+        try:
+            raw_items = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="El cuerpo debe ser una lista JSON o NDJSON")
+        if not isinstance(raw_items, list):
+            raise HTTPException(status_code=400, detail="El cuerpo debe ser una lista JSON o NDJSON")
+    if len(raw_items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Máximo {BULK_MAX_ITEMS} notificaciones por petición")
+
+    items = []
+    for raw in raw_items:
+        try:
+            item = BulkItem.model_validate(json.loads(raw) if isinstance(raw, bytes) else raw)
+        except (ValueError, ValidationError) as e:
+            items.append((None, f"Notificación inválida: {str(e).splitlines()[0]}"))
+            continue
+        if item.message is None and (item.template or template) is None:
+            items.append((item, "Falta el mensaje o la plantilla"))
+            continue
+        items.append((item, None))
+    return items
+
+def render_message(item: BulkItem, template: Optional[str], email: str) -> str:
+    if item.message is not None:
+        return item.message
+    context = {**item.context, "student_id": item.student_id, "email": email}
+
+    def substitute(match):
+        key = match.group(1)
+        if key is None:
+            return match.group(0)[0]
+        # Los campos que falten en el contexto se dejan tal cual en lugar de fallar
+        return str(context[key]) if key in context else match.group(0)
+
+    return PLACEHOLDER.sub(substitute, item.template or template)
+
+@app.post("/notify/bulk")
+async def send_bulk_notifications(request: Request, template: Optional[str] = None):
+    items = await read_bulk_items(request, template)
+
+    # Una sola consulta al servicio de estudiantes para todos los que no estén en caché
+    await prefetch_emails([item.student_id for item, error in items if error is None])
+
+    semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+
+    async def deliver(index: int, item: BulkItem | None, error: str | None):
+        result = {"index": index, "student_id": item.student_id if item else None}
+        if error:
+            return {**result, "status": "invalid", "detail": error}
+        try:
+            # Tras el prefetch normalmente sale de la caché
+            email = await get_student_email(item.student_id)
+        except HTTPException as e:
+            status = "not_found" if e.status_code == 404 else "error"
+            return {**result, "status": status, "detail": e.detail}
+        content = render_message(item, template, email)
+        async with semaphore:
+            try:
+                sent = await send_email(email, content)
+            except Exception as e:
+                return {**result, "status": "error", "detail": str(e)}
+        return {**result, "status": "sent" if sent else "simulated"}
+
+    results = await asyncio.gather(*(deliver(i, item, error) for i, (item, error) in enumerate(items)))
+    summary = {}
+    for result in results:
+        summary[result["status"]] = summary.get(result["status"], 0) + 1
+    return {"total": len(results), "summary": summary, "results": results}
+
+@app.post("/prefetch")
+async def prefetch(request: Prefetch):
+    # Calienta la caché de emails antes de una tanda de recordatorios
+    return await prefetch_emails(request.student_ids)
+
+@app.get("/metrics")
+async def metrics():
+    return {"email_cache": email_cache.stats(), "student_service_calls": student_service_calls}
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
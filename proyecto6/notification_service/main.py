@@ -1,17 +1,39 @@
-from fastapi import FastAPI, HTTPException, status
+from fastapi import FastAPI, HTTPException, Query, status
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
+from collections import deque
+from datetime import datetime
+import asyncio
+import json
 import os
+import random
+import sqlite3
+import time
 from dotenv import load_dotenv
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
-import requests
+import httpx
 
 load_dotenv()
 
 # Constants
 SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY")
 FROM_EMAIL = "universidad@example.com"  # Replace with your verified sender
+EMAIL_SUBJECT = "Universidad Central de Préstamos - Notificación"
+STUDENT_SERVICE_URL = os.getenv("STUDENT_SERVICE_URL", "http://localhost:8002")
+STUDENT_TIMEOUT = float(os.getenv("STUDENT_SERVICE_TIMEOUT", "5"))
+
+# Delivery pipeline settings
+EMAIL_TRANSPORT = os.getenv("EMAIL_TRANSPORT", "sendgrid" if SENDGRID_API_KEY else "console")
+NOTIFY_QUEUE_SIZE = int(os.getenv("NOTIFY_QUEUE_SIZE", "10000"))
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "4"))
+NOTIFY_COALESCE_WINDOW = float(os.getenv("NOTIFY_COALESCE_WINDOW", "2"))
+NOTIFY_RATE_LIMIT = float(os.getenv("NOTIFY_RATE_LIMIT", "10"))  # emails per second
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "5"))
+NOTIFY_RETRY_BASE = float(os.getenv("NOTIFY_RETRY_BASE", "1"))
+NOTIFY_RETRY_MAX = float(os.getenv("NOTIFY_RETRY_MAX", "60"))
+DEAD_LETTER_FILE = os.getenv("DEAD_LETTER_FILE", "dead_letters.jsonl")
+NOTIFY_JOURNAL_PATH = os.getenv("NOTIFY_JOURNAL_PATH", "notification_journal.db")
 
 # FastAPI app
 app = FastAPI(title="Notification Service",
@@ -32,55 +54,365 @@ class NotificationRequest(BaseModel):
     student_id: str
     message: str
 
-async def get_student_email(student_id: str):
-    student_service_url = os.getenv("STUDENT_SERVICE_URL", "http://localhost:8002")
-    try:
-        response = requests.get(f"{student_service_url}/students/{student_id}")
-        if response.status_code == 200:
-            student = response.json()
-            return student["email"]
-        return None
-    except:
-        return None
-
-async def send_email(to_email: str, message: str):
-    if not SENDGRID_API_KEY:
-        print(f"Would send email to {to_email}: {message}")
-        return True
-        
-    try:
-        sg = SendGridAPIClient(SENDGRID_API_KEY)
+class TransportError(Exception):
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+# Email transports
+class SendGridTransport:
+    def __init__(self, api_key: str):
+        # One client for the whole process instead of one per message
+        self.client = SendGridAPIClient(api_key)
+
+    async def send(self, to_email: str, html_content: str):
         mail = Mail(
             from_email=FROM_EMAIL,
             to_emails=to_email,
-            subject='Universidad Central de Préstamos - Notificación',
-            html_content=f'<p>{message}</p>'
+            subject=EMAIL_SUBJECT,
+            html_content=html_content
         )
-        response = sg.send(mail)
-        return response.status_code == 202
-    except Exception as e:
-        print(f"Failed to send email: {str(e)}")
-        return False
+        try:
+            # The SendGrid client is blocking, keep it off the event loop
+            response = await asyncio.to_thread(self.client.send, mail)
+        except Exception as e:
+            status_code = getattr(e, "status_code", None)
+            # Bad requests will never succeed; throttling and server errors are retried
+            retryable = status_code is None or status_code == 429 or status_code >= 500
+            raise TransportError(str(e), retryable=retryable)
+        if response.status_code != 202:
+            raise TransportError(f"SendGrid returned {response.status_code}")
 
-@app.post("/notify")
-async def send_notification(notification: NotificationRequest):
-    # Get student email
-    student_email = await get_student_email(notification.student_id)
-    if not student_email:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Student not found"
+class ConsoleTransport:
+    async def send(self, to_email: str, html_content: str):
+        print(f"Would send email to {to_email}: {html_content}")
+
+class FakeTransport:
+    """Offline transport for tests and benchmarks: records mails and simulates latency."""
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.sent = []
+
+    async def send(self, to_email: str, html_content: str):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise TransportError("Simulated failure")
+        self.sent.append((to_email, html_content))
+
+def create_transport(name: str = EMAIL_TRANSPORT):
+    if name == "sendgrid":
+        return SendGridTransport(SENDGRID_API_KEY)
+    if name == "fake":
+        return FakeTransport()
+    return ConsoleTransport()
+
+class RateLimiter:
+    """Token bucket shared by all workers."""
+
+    def __init__(self, rate: float, burst: int | None = None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class DeadLetterStore:
+    """Keeps the most recent undeliverable batches in memory and appends every one to a JSONL file."""
+
+    def __init__(self, path: str | None, keep: int = 1000):
+        self.path = path
+        self.recent = deque(maxlen=keep)
+
+    def add(self, student_id: str, messages: list[str], reason: str, attempts: int):
+        entry = {
+            "student_id": student_id,
+            "messages": messages,
+            "reason": reason,
+            "attempts": attempts,
+            "failed_at": datetime.utcnow().isoformat(),
+        }
+        self.recent.append(entry)
+        if self.path:
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            except OSError as e:
+                print(f"Failed to write dead letter: {str(e)}")
+
+class NotificationJournal:
+    """Accepted notifications, persisted until they are delivered or dead-lettered.
+
+    /notify only answers 202 once the message is written here, so anything still
+    queued, coalescing or backing off when the process stops is replayed on the
+    next start. Delivery is at-least-once: a crash between sending and removing
+    the entry sends that email again.
+    """
+
+    def __init__(self, path: str | None):
+        # None keeps the journal in memory (tests); opened lazily so importing the module creates no file
+        self.path = path
+        self.conn: sqlite3.Connection | None = None
+
+    def connection(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path or ":memory:")
+            if self.path:
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS notification_journal (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    student_id TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    accepted_at TEXT NOT NULL
+                )
+            """)
+            self.conn.commit()
+        return self.conn
+
+    def add(self, student_id: str, message: str) -> int:
+        conn = self.connection()
+        cursor = conn.execute(
+            "INSERT INTO notification_journal (student_id, message, accepted_at) VALUES (?, ?, ?)",
+            (student_id, message, datetime.utcnow().isoformat()),
         )
-    
-    # Send email notification
-    success = await send_email(student_email, notification.message)
-    if not success:
+        conn.commit()
+        return cursor.lastrowid
+
+    def remove(self, entry_ids: list[int]):
+        conn = self.connection()
+        conn.executemany("DELETE FROM notification_journal WHERE id = ?", [(entry_id,) for entry_id in entry_ids])
+        conn.commit()
+
+    def pending(self) -> list[tuple[int, str, str]]:
+        return self.connection().execute(
+            "SELECT id, student_id, message FROM notification_journal ORDER BY id"
+        ).fetchall()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+class NotificationPipeline:
+    """/notify -> queue -> per-recipient coalescing window -> worker pool -> transport."""
+
+    def __init__(self, transport=None, workers: int = NOTIFY_WORKERS,
+                 coalesce_window: float = NOTIFY_COALESCE_WINDOW, rate_limit: float = NOTIFY_RATE_LIMIT,
+                 max_attempts: int = NOTIFY_MAX_ATTEMPTS, dead_letters: DeadLetterStore | None = None,
+                 journal: NotificationJournal | None = None):
+        self.transport = transport or create_transport()
+        self.workers = workers
+        self.coalesce_window = coalesce_window
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.max_attempts = max_attempts
+        self.dead_letters = dead_letters or DeadLetterStore(DEAD_LETTER_FILE)
+        self.journal = journal or NotificationJournal(NOTIFY_JOURNAL_PATH)
+        self.queue: asyncio.Queue | None = None
+        self.batches: asyncio.Queue | None = None
+        # student_id -> [(journal id, message)] waiting for the coalescing window to close
+        self.pending: dict[str, list[tuple[int, str]]] = {}
+        self.tasks: list[asyncio.Task] = []
+        self.http_client: httpx.AsyncClient | None = None
+        self.stats = {
+            "enqueued": 0,
+            "replayed": 0,
+            "rejected": 0,
+            "emails_sent": 0,
+            "messages_sent": 0,
+            "retries": 0,
+            "dead_letters": 0,
+        }
+
+    @property
+    def running(self) -> bool:
+        return bool(self.tasks)
+
+    async def start(self):
+        if self.running:
+            return
+        self.queue = asyncio.Queue(maxsize=NOTIFY_QUEUE_SIZE)
+        self.batches = asyncio.Queue()
+        if self.http_client is None or self.http_client.is_closed:
+            self.http_client = httpx.AsyncClient(timeout=STUDENT_TIMEOUT)
+        self.replay()
+        self.tasks = [asyncio.create_task(self.collect())]
+        self.tasks += [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+    async def stop(self, drain_timeout: float = 10):
+        if not self.running:
+            return
+        # Flush open windows and give workers a chance to finish before cancelling
+        for student_id in list(self.pending):
+            self.flush(student_id)
+        try:
+            await asyncio.wait_for(self.drain(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            print("Notification queue not drained before shutdown")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        await self.http_client.aclose()
+        # Whatever was cancelled is still in the journal and goes out on the next start
+        self.journal.close()
+
+    def replay(self):
+        # Notifications accepted before a crash or an undrained shutdown, one batch per recipient
+        batches: dict[str, list[tuple[int, str]]] = {}
+        for entry_id, student_id, message in self.journal.pending():
+            batches.setdefault(student_id, []).append((entry_id, message))
+        for student_id, entries in batches.items():
+            self.batches.put_nowait((student_id, entries))
+            self.stats["replayed"] += len(entries)
+
+    async def drain(self):
+        await self.queue.join()
+        for student_id in list(self.pending):
+            self.flush(student_id)
+        await self.batches.join()
+
+    def enqueue(self, student_id: str, message: str) -> bool:
+        if not self.running:
+            return False
+        if self.queue.full():
+            self.stats["rejected"] += 1
+            return False
+        # Persisted before acknowledging, so a 202 survives a crash
+        entry_id = self.journal.add(student_id, message)
+        self.queue.put_nowait((entry_id, student_id, message))
+        self.stats["enqueued"] += 1
+        return True
+
+    async def collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            entry_id, student_id, message = await self.queue.get()
+            if student_id not in self.pending:
+                # The first message for a recipient opens its window
+                self.pending[student_id] = []
+                loop.call_later(self.coalesce_window, self.flush, student_id)
+            self.pending[student_id].append((entry_id, message))
+            self.queue.task_done()
+
+    def flush(self, student_id: str):
+        entries = self.pending.pop(student_id, None)
+        if entries:
+            self.batches.put_nowait((student_id, entries))
+
+    async def work(self):
+        while True:
+            student_id, entries = await self.batches.get()
+            messages = [message for _, message in entries]
+            try:
+                await self.deliver(student_id, messages)
+            except Exception as e:
+                self.dead_letter(student_id, messages, f"Unexpected error: {str(e)}", 0)
+            finally:
+                self.batches.task_done()
+            # Sent or dead-lettered: not reached when the task is cancelled mid-delivery
+            self.journal.remove([entry_id for entry_id, _ in entries])
+
+    async def deliver(self, student_id: str, messages: list[str]):
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                email = await self.get_student_email(student_id)
+                if email is None:
+                    raise TransportError("Student not found", retryable=False)
+                await self.rate_limiter.acquire()
+                await self.transport.send(email, render_email(messages))
+            except TransportError as e:
+                if not e.retryable or attempts >= self.max_attempts:
+                    self.dead_letter(student_id, messages, str(e), attempts)
+                    return
+                self.stats["retries"] += 1
+                # Exponential backoff with full jitter so retries don't line up
+                await asyncio.sleep(random.uniform(0, min(NOTIFY_RETRY_MAX, NOTIFY_RETRY_BASE * 2 ** (attempts - 1))))
+                continue
+            self.stats["emails_sent"] += 1
+            self.stats["messages_sent"] += len(messages)
+            return
+
+    def dead_letter(self, student_id: str, messages: list[str], reason: str, attempts: int):
+        self.stats["dead_letters"] += 1
+        self.dead_letters.add(student_id, messages, reason, attempts)
+
+    async def get_student_email(self, student_id: str):
+        # Lookup by student code; /students/{id} requires a user token this service doesn't have
+        try:
+            response = await self.http_client.get(f"{STUDENT_SERVICE_URL}/students/by-student-id/{student_id}")
+        except httpx.RequestError as e:
+            raise TransportError(f"Student service unavailable: {str(e)}")
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            # A 4xx won't fix itself by retrying; only 5xx/429 are worth another attempt
+            retryable = response.status_code >= 500 or response.status_code == 429
+            raise TransportError(f"Student service returned {response.status_code}", retryable=retryable)
+        return response.json()["email"]
+
+    def metrics(self) -> dict:
+        return {
+            **self.stats,
+            "queued": self.queue.qsize() if self.queue else 0,
+            "journaled": len(self.journal.pending()) if self.journal.conn else 0,
+            "open_windows": len(self.pending),
+            "batches_waiting": self.batches.qsize() if self.batches else 0,
+            "transport": type(self.transport).__name__,
+        }
+
+def render_email(messages: list[str]) -> str:
+    if len(messages) == 1:
+        return f"<p>{messages[0]}</p>"
+    items = "".join(f"<li>{message}</li>" for message in messages)
+    return f"<p>Tienes {len(messages)} notificaciones nuevas:</p><ul>{items}</ul>"
+
+pipeline = NotificationPipeline()
+
+@app.on_event("startup")
+async def start_pipeline():
+    await pipeline.start()
+
+@app.on_event("shutdown")
+async def stop_pipeline():
+    await pipeline.stop()
+
+@app.post("/notify", status_code=status.HTTP_202_ACCEPTED)
+async def send_notification(notification: NotificationRequest):
+    # 202 means the notification is in the journal: it is delivered at least once, even across restarts
+    if not pipeline.enqueue(notification.student_id, notification.message):
+        # Callers (the loan outbox) retry later
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to send notification"
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Notification queue is full or not running"
         )
-    
-    return {"message": "Notification sent successfully"}
+    return {"message": "Notification queued"}
+
+@app.get("/metrics")
+async def get_metrics():
+    return pipeline.metrics()
+
+@app.get("/dead-letters")
+async def get_dead_letters(limit: int = Query(100, ge=1, le=1000)):
+    return list(pipeline.dead_letters.recent)[-limit:]
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,10 +1,17 @@
-from fastapi import FastAPI, HTTPException, Depends
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Depends, Response, Request
+from pydantic import BaseModel, Field
 from typing import List, Optional
-import sqlite3
 import os
+import sys
 from datetime import datetime
 
+# Permite importar el paquete compartido cuando el servicio se ejecuta desde su carpeta
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.db import create_pool, register_pool
+from common.migrations import run_migrations
+from common.pagination import keyset_page
+from common.versioning import check_etag, version_migration
+
 app = FastAPI()
 
 # Modelo de datos
@@ -17,21 +24,27 @@ class Resource(BaseModel):
     loaned_quantity: int = 0
     status: str = "disponible"
 
+class QuantityChange(BaseModel):
+    quantity: int = Field(1, gt=0)
+
+class BatchItem(BaseModel):
+    resource_id: int
+    quantity: int = Field(1, gt=0)
+
+class BatchChange(BaseModel):
+    items: List[BatchItem] = Field(..., min_length=1)
+
 # Configuración de la base de datos
-DB_PATH = "resources.db"
+DB_PATH = os.getenv("RESOURCE_DB_PATH", "resources.db")
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Una conexión persistente por hilo (WAL, busy_timeout y sentencias en caché)
+db_pool = create_pool(DB_PATH)
+get_db = register_pool(app, db_pool)
 
-# Crear tabla si no existe
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Crear la tabla si no existe
-    c.execute('''
+# Migraciones del esquema: cada versión se aplica una sola vez y queda registrada en schema_migrations
+MIGRATIONS = [
+    (1, "esquema inicial", [
+        '''
         CREATE TABLE IF NOT EXISTS resources (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
@@ -41,7 +54,22 @@ def init_db():
             loaned_quantity INTEGER DEFAULT 0,
             status TEXT DEFAULT 'disponible'
         )
-    ''')
+        ''',
+    ]),
+    (2, "índices para filtrar recursos por tipo y estado", [
+        "CREATE INDEX IF NOT EXISTS idx_resources_type ON resources (type, id)",
+        "CREATE INDEX IF NOT EXISTS idx_resources_status ON resources (status, id)",
+    ]),
+    # Versión de los datos para responder 304 a los listados que no cambiaron
+    (3, "versión de datos de recursos", version_migration("resources")),
+]
+
+# Crear tablas y datos de ejemplo si no existen
+def init_db():
+    conn = get_db()
+    c = conn.cursor()
+    
+    run_migrations(conn, MIGRATIONS)
     
     # Verificar si hay recursos, si no hay, agregar algunos de ejemplo
     c.execute('SELECT COUNT(*) FROM resources')
@@ -84,12 +112,21 @@ def create_resource(resource: Resource):
         conn.close()
 
 @app.get("/resources/")
-def get_resources():
+def get_resources(request: Request, response: Response, cursor: Optional[int] = None, limit: Optional[int] = None,
+                  type: Optional[str] = None, status: Optional[str] = None, available: Optional[bool] = None):
     conn = get_db()
     try:
-        c = conn.cursor()
-        c.execute("SELECT * FROM resources ORDER BY id")
-        resources = c.fetchall()
+        if check_etag(conn, "resources", request, response):
+            return Response(status_code=304, headers={"ETag": response.headers["ETag"]})
+        filters = []
+        if type:
+            filters.append(("type = ?", type))
+        if status:
+            filters.append(("status = ?", status))
+        if available is not None:
+            # El parámetro solo selecciona el sentido de la comparación
+            filters.append(("quantity - loaned_quantity > ?" if available else "quantity - loaned_quantity <= ?", 0))
+        resources = keyset_page(conn, "resources", filters, response, cursor, limit)
         
         # Convertir los resultados a una lista de diccionarios
         result = [{
@@ -105,7 +142,6 @@ def get_resources():
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-        return resources
     finally:
         conn.close()
 
@@ -229,6 +265,144 @@ def update_resource_status(resource_id: int, status: dict):
     finally:
         conn.close()
 
+def resource_dict(row):
+    return {
+        "id": row[0],
+        "name": row[1],
+        "description": row[2],
+        "type": row[3],
+        "quantity": row[4],
+        "loaned_quantity": row[5],
+        "status": row[6],
+        "available_quantity": row[4] - row[5]
+    }
+
+@app.post("/resources/{resource_id}/reserve")
+def reserve_resource(resource_id: int, change: QuantityChange):
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        # Un único UPDATE condicional: reserva las N unidades solo si caben
+        c.execute(
+            """UPDATE resources
+               SET loaned_quantity = loaned_quantity + ?, status = 'prestado'
+               WHERE id = ? AND loaned_quantity + ? <= quantity""",
+            (change.quantity, resource_id, change.quantity)
+        )
+        if c.rowcount == 0:
+            conn.rollback()
+            c.execute("SELECT quantity, loaned_quantity FROM resources WHERE id = ?", (resource_id,))
+            row = c.fetchone()
+            if row is None:
+                raise HTTPException(status_code=404, detail="Recurso no encontrado")
+            raise HTTPException(
+                status_code=400,
+                detail=f"No hay suficientes unidades disponibles. Disponibles: {row[0] - row[1]}"
+            )
+        c.execute("SELECT * FROM resources WHERE id = ?", (resource_id,))
+        resource = resource_dict(c.fetchone())
+        conn.commit()
+        return resource
+    finally:
+        conn.close()
+
+@app.post("/resources/{resource_id}/release")
+def release_resource(resource_id: int, change: QuantityChange):
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        c.execute(
+            """UPDATE resources
+               SET loaned_quantity = loaned_quantity - ?,
+                   status = CASE WHEN loaned_quantity - ? > 0 THEN 'prestado' ELSE 'disponible' END
+               WHERE id = ? AND loaned_quantity >= ?""",
+            (change.quantity, change.quantity, resource_id, change.quantity)
+        )
+        if c.rowcount == 0:
+            conn.rollback()
+            c.execute("SELECT loaned_quantity FROM resources WHERE id = ?", (resource_id,))
+            row = c.fetchone()
+            if row is None:
+                raise HTTPException(status_code=404, detail="Recurso no encontrado")
+            raise HTTPException(
+                status_code=400,
+                detail=f"No se pueden liberar más unidades de las prestadas. Prestadas: {row[0]}"
+            )
+        c.execute("SELECT * FROM resources WHERE id = ?", (resource_id,))
+        resource = resource_dict(c.fetchone())
+        conn.commit()
+        return resource
+    finally:
+        conn.close()
+
+def change_batch(batch: BatchChange, reserve: bool):
+    # Un mismo recurso repetido en el lote se ajusta una sola vez con la suma
+    totals = {}
+    for item in batch.items:
+        totals[item.resource_id] = totals.get(item.resource_id, 0) + item.quantity
+
+    if reserve:
+        sql = """UPDATE resources
+                 SET loaned_quantity = loaned_quantity + ?, status = 'prestado'
+                 WHERE id = ? AND loaned_quantity + ? <= quantity"""
+    else:
+        sql = """UPDATE resources
+                 SET loaned_quantity = loaned_quantity - ?,
+                     status = CASE WHEN loaned_quantity - ? > 0 THEN 'prestado' ELSE 'disponible' END
+                 WHERE id = ? AND loaned_quantity >= ?"""
+
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        # Todo el lote en una transacción: o se ajustan todos los recursos o ninguno
+        c.execute("BEGIN IMMEDIATE")
+        failed = []
+        for resource_id, quantity in totals.items():
+            params = (quantity, resource_id, quantity) if reserve else (quantity, quantity, resource_id, quantity)
+            c.execute(sql, params)
+            if c.rowcount == 0:
+                failed.append(resource_id)
+
+        placeholders = ", ".join("?" for _ in totals)
+        if failed:
+            conn.rollback()
+            c.execute(
+                f"SELECT id, quantity, loaned_quantity FROM resources WHERE id IN ({placeholders})",
+                list(totals)
+            )
+            current = {row[0]: (row[1], row[2]) for row in c.fetchall()}
+            errors = []
+            for resource_id in failed:
+                if resource_id not in current:
+                    errors.append({"resource_id": resource_id, "detail": "Recurso no encontrado"})
+                elif reserve:
+                    available = current[resource_id][0] - current[resource_id][1]
+                    errors.append({
+                        "resource_id": resource_id,
+                        "detail": f"No hay suficientes unidades disponibles. Disponibles: {available}"
+                    })
+                else:
+                    errors.append({
+                        "resource_id": resource_id,
+                        "detail": f"No se pueden liberar más unidades de las prestadas. Prestadas: {current[resource_id][1]}"
+                    })
+            raise HTTPException(status_code=400, detail={"message": "No se pudo procesar el lote", "items": errors})
+
+        c.execute(f"SELECT * FROM resources WHERE id IN ({placeholders}) ORDER BY id", list(totals))
+        resources = [resource_dict(row) for row in c.fetchall()]
+        conn.commit()
+        return resources
+    finally:
+        conn.close()
+
+@app.post("/resources/reserve-batch")
+def reserve_batch(batch: BatchChange):
+    return change_batch(batch, reserve=True)
+
+@app.post("/resources/release-batch")
+def release_batch(batch: BatchChange):
+    return change_batch(batch, reserve=False)
+
 @app.delete("/resources/{resource_id}")
 def delete_resource(resource_id: int):
     conn = get_db()
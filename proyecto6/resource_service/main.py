@@ -1,4 +1,4 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Query, Response, status
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime
 from sqlalchemy.ext.declarative import declarative_base
@@ -7,7 +7,12 @@ from pydantic import BaseModel
 from datetime import datetime
 import os
 from dotenv import load_dotenv
-import requests
+import sys
+
+# Allow importing the shared package when the service runs from its own folder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.auth import InvalidTokenError, create_verifier
+from common.pagination import keyset_query
 
 load_dotenv()
 
@@ -71,18 +76,13 @@ def get_db():
     finally:
         db.close()
 
-# Authentication middleware
-async def verify_token(token: str):
-    auth_service_url = os.getenv("AUTH_SERVICE_URL", "http://localhost:8000")
+# Authentication middleware: the JWT is verified locally, without calling auth_service
+token_verifier = create_verifier()
+
+def verify_token(token: str):
     try:
-        response = requests.get(
-            f"{auth_service_url}/validate-token",
-            headers={"Authorization": f"Bearer {token}"}
-        )
-        if response.status_code == 200:
-            return response.json()
-        return None
-    except:
+        return token_verifier.verify(token)
+    except InvalidTokenError:
         return None
 
 # Routes
@@ -111,12 +111,20 @@ async def create_resource(
 
 @app.get("/resources/", response_model=list[ResourceResponse])
 async def list_resources(
-    skip: int = 0,
-    limit: int = 100,
+    response: Response,
+    cursor: int | None = None,
+    limit: int | None = None,
+    type: str | None = None,
+    status_filter: str | None = Query(None, alias="status"),
     db: Session = Depends(get_db)
 ):
-    resources = db.query(Resource).offset(skip).limit(limit).all()
-    return resources
+    query = db.query(Resource)
+    if type:
+        query = query.filter(Resource.type == type)
+    if status_filter:
+        query = query.filter(Resource.status == status_filter)
+    # Keyset pagination on id: pass X-Next-Cursor back as ?cursor=
+    return keyset_query(query, Resource.id, response, cursor, limit)
 
 @app.get("/resources/{resource_id}", response_model=ResourceResponse)
 async def get_resource(
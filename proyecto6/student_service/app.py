@@ -1,8 +1,16 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Response, Request
 from pydantic import BaseModel
 from typing import List, Optional
 import sqlite3
 import os
+import sys
+
+# Permite importar el paquete compartido cuando el servicio se ejecuta desde su carpeta
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.db import create_pool, register_pool
+from common.migrations import run_migrations
+from common.pagination import keyset_page
+from common.versioning import check_etag, version_migration
 
 app = FastAPI()
 
@@ -16,21 +24,22 @@ class Student(BaseModel):
     semester: int
     phone: Optional[str] = None
 
+class StudentLookup(BaseModel):
+    student_ids: List[str]
+
 # Configuración de la base de datos
-DB_PATH = "students.db"
+DB_PATH = os.getenv("STUDENT_DB_PATH", "students.db")
+# SQLite limita la cantidad de parámetros por consulta
+LOOKUP_CHUNK_SIZE = 500
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Una conexión persistente por hilo (WAL, busy_timeout y sentencias en caché)
+db_pool = create_pool(DB_PATH)
+get_db = register_pool(app, db_pool)
 
-# Crear tabla si no existe
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Crear la tabla si no existe
-    c.execute('''
+# Migraciones del esquema: cada versión se aplica una sola vez y queda registrada en schema_migrations
+MIGRATIONS = [
+    (1, "esquema inicial", [
+        '''
         CREATE TABLE IF NOT EXISTS students (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
@@ -40,7 +49,21 @@ def init_db():
             semester INTEGER NOT NULL,
             phone TEXT
         )
-    ''')
+        ''',
+    ]),
+    (2, "índice para filtrar estudiantes por carrera", [
+        "CREATE INDEX IF NOT EXISTS idx_students_career ON students (career, id)",
+    ]),
+    # Versión de los datos para responder 304 a los listados que no cambiaron
+    (3, "versión de datos de estudiantes", version_migration("students")),
+]
+
+# Crear tablas y datos de ejemplo si no existen
+def init_db():
+    conn = get_db()
+    c = conn.cursor()
+    
+    run_migrations(conn, MIGRATIONS)
     
     # Verificar si hay estudiantes, si no hay, agregar algunos de ejemplo
     c.execute('SELECT COUNT(*) FROM students')
@@ -87,12 +110,20 @@ def create_student(student: Student):
         conn.close()
 
 @app.get("/students/")
-def get_students():
+def get_students(request: Request, response: Response, cursor: Optional[int] = None, limit: Optional[int] = None,
+                 career: Optional[str] = None, semester: Optional[int] = None, student_id: Optional[str] = None):
     conn = get_db()
     try:
-        c = conn.cursor()
-        c.execute("SELECT id, name, email, student_id, career, semester, phone FROM students ORDER BY id")
-        students = c.fetchall()
+        if check_etag(conn, "students", request, response):
+            return Response(status_code=304, headers={"ETag": response.headers["ETag"]})
+        filters = []
+        if career:
+            filters.append(("career = ?", career))
+        if semester is not None:
+            filters.append(("semester = ?", semester))
+        if student_id:
+            filters.append(("student_id = ?", student_id))
+        students = keyset_page(conn, "students", filters, response, cursor, limit)
         
         # Convertir los resultados a una lista de diccionarios
         result = [{
@@ -111,6 +142,30 @@ def get_students():
     finally:
         conn.close()
 
+@app.post("/students/lookup")
+def lookup_students(lookup: StudentLookup):
+    # Resuelve muchos códigos de estudiante con una consulta IN en lugar de una petición por estudiante
+    codes = list(dict.fromkeys(lookup.student_ids))
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        found = {}
+        for start in range(0, len(codes), LOOKUP_CHUNK_SIZE):
+            chunk = codes[start:start + LOOKUP_CHUNK_SIZE]
+            placeholders = ", ".join("?" * len(chunk))
+            c.execute(
+                f"SELECT id, name, email, student_id, career, semester, phone FROM students WHERE student_id IN ({placeholders})",
+                chunk
+            )
+            for row in c.fetchall():
+                found[row["student_id"]] = dict(row)
+        return {
+            "students": list(found.values()),
+            "missing": [code for code in codes if code not in found]
+        }
+    finally:
+        conn.close()
+
 @app.get("/students/{student_id}", response_model=Student)
 def get_student(student_id: int):
     conn = get_db()
@@ -1,4 +1,4 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Response, status
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy import create_engine, Column, Integer, String, DateTime
 from sqlalchemy.ext.declarative import declarative_base
@@ -7,7 +7,12 @@ from pydantic import BaseModel, EmailStr
 from datetime import datetime
 import os
 from dotenv import load_dotenv
-import requests
+import sys
+
+# Allow importing the shared package when the service runs from its own folder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.auth import InvalidTokenError, create_verifier
+from common.pagination import keyset_query
 
 load_dotenv()
 
@@ -75,18 +80,13 @@ def get_db():
     finally:
         db.close()
 
-# Authentication middleware
-async def verify_token(token: str):
-    auth_service_url = os.getenv("AUTH_SERVICE_URL", "http://localhost:8000")
+# Authentication middleware: the JWT is verified locally, without calling auth_service
+token_verifier = create_verifier()
+
+def verify_token(token: str):
     try:
-        response = requests.get(
-            f"{auth_service_url}/validate-token",
-            headers={"Authorization": f"Bearer {token}"}
-        )
-        if response.status_code == 200:
-            return response.json()
-        return None
-    except:
+        return token_verifier.verify(token)
+    except InvalidTokenError:
         return None
 
 # Routes
@@ -118,8 +118,10 @@ async def create_student(
 
 @app.get("/students/", response_model=list[StudentResponse])
 async def list_students(
-    skip: int = 0,
-    limit: int = 100,
+    response: Response,
+    cursor: int | None = None,
+    limit: int | None = None,
+    career: str | None = None,
     db: Session = Depends(get_db),
     authorization: str = Depends(verify_token)
 ):
@@ -128,8 +130,11 @@ async def list_students(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials"
         )
-    students = db.query(Student).offset(skip).limit(limit).all()
-    return students
+    query = db.query(Student)
+    if career:
+        query = query.filter(Student.career == career)
+    # Keyset pagination on id: pass X-Next-Cursor back as ?cursor=
+    return keyset_query(query, Student.id, response, cursor, limit)
 
 @app.get("/students/{student_id}", response_model=StudentResponse)
 async def get_student(
@@ -2,6 +2,7 @@ import pytest
 from fastapi.testclient import TestClient
 from api_gateway.main import app
 import responses
+import httpx
 
 client = TestClient(app)
 
@@ -45,3 +46,248 @@ def test_error_servidor():
     data = response.json()
     assert "status" in data
     assert "services" in data
+
+def test_metricas_pool(test_client):
+    """Prueba que el endpoint de métricas exponga los contadores de cada pool"""
+    response = test_client.get("/metrics")
+    assert response.status_code == 200
+    pools = response.json()["pools"]
+    assert set(pools.keys()) == {"auth", "resource", "student", "loan", "notification"}
+    assert {"requests", "in_flight", "open_connections", "timeout"} <= set(pools["loan"].keys())
+
+class AsyncBody(httpx.AsyncByteStream):
+    """Cuerpo asíncrono para que el gateway pueda transmitir la respuesta simulada"""
+    def __init__(self, data):
+        self.data = data
+
+    async def __aiter__(self):
+        yield self.data
+
+@pytest.fixture
+def mock_service():
+    """Fixture que sustituye el cliente de un servicio por un transporte simulado"""
+    from api_gateway import main
+    installed = []
+
+    def install(service, handler):
+        async def streaming_handler(request):
+            response = handler(request)
+            if not isinstance(response, httpx.Response):
+                response = await response
+            return httpx.Response(response.status_code, headers=response.headers, stream=AsyncBody(response.content))
+
+        main.clients[service] = httpx.AsyncClient(
+            base_url=main.SERVICES[service], transport=httpx.MockTransport(streaming_handler)
+        )
+        installed.append(service)
+        return main.clients[service]
+
+    yield install
+    for service in installed:
+        main.clients.pop(service, None)
+
+def test_cliente_reutilizado(test_client, mock_service):
+    """Prueba que el gateway reutilice el mismo cliente para un servicio"""
+    from api_gateway import main
+
+    client = mock_service("loan", lambda request: httpx.Response(200, json={"path": request.url.path}))
+    before = main.pool_stats["loan"]["requests"]
+
+    for _ in range(3):
+        response = test_client.get("/api/loan/loans/")
+        assert response.status_code == 200
+        assert response.json() == {"path": "/loans/"}
+
+    assert main.clients["loan"] is client
+    assert main.pool_stats["loan"]["requests"] == before + 3
+    assert main.pool_stats["loan"]["in_flight"] == 0
+
+def test_proxy_streaming_sin_json(test_client, mock_service):
+    """Prueba que el proxy conserve estado, cabeceras y cuerpos no JSON"""
+    received = {}
+
+    async def handler(request):
+        received["body"] = await request.aread()
+        return httpx.Response(201, content=b"texto plano", headers={"content-type": "text/plain", "x-servicio": "loan"})
+
+    mock_service("loan", handler)
+
+    response = test_client.post("/api/loan/loans/", content=b'{"student_id": "A2023001"}')
+    assert response.status_code == 201
+    assert response.content == b"texto plano"
+    assert response.headers["x-servicio"] == "loan"
+    assert received["body"] == b'{"student_id": "A2023001"}'
+
+def test_stream_que_falla_libera_la_conexion(test_client, mock_service):
+    """Prueba que si el servicio falla a mitad del cuerpo se cierre la respuesta y no quede in_flight colgado"""
+    from api_gateway import main
+
+    class FailingBody(httpx.AsyncByteStream):
+        closed = False
+
+        async def __aiter__(self):
+            yield b"primer trozo"
+            raise httpx.ReadError("conexión cortada")
+
+        async def aclose(self):
+            FailingBody.closed = True
+
+    mock_service("loan", lambda request: None)
+    main.clients["loan"] = httpx.AsyncClient(
+        base_url=main.SERVICES["loan"],
+        transport=httpx.MockTransport(lambda request: httpx.Response(200, stream=FailingBody())),
+    )
+    before = main.pool_stats["loan"]["in_flight"]
+
+    with pytest.raises(httpx.ReadError):
+        test_client.get("/api/loan/loans/")
+
+    assert main.pool_stats["loan"]["in_flight"] == before
+    assert FailingBody.closed
+
+def test_health_desde_cache(test_client, mock_service):
+    """Prueba que /health responda con el estado guardado sin consultar los servicios"""
+    from api_gateway import main
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.path)
+        return httpx.Response(200, json={"status": "healthy"})
+
+    for service in main.SERVICES:
+        mock_service(service, handler)
+        main.service_health[service]["last_check"] = None
+
+    data = test_client.get("/health").json()
+    assert data["services"]["resource"] == "up"
+    assert data["details"]["resource"]["consecutive_failures"] == 0
+    assert data["details"]["resource"]["last_success"] is not None
+
+    probes = len(calls)
+    test_client.get("/health")
+    assert len(calls) == probes
+
+def test_circuit_breaker_abre_y_falla_rapido(test_client, mock_service):
+    """Prueba que tras varios errores el circuito se abra y responda 503 con Retry-After"""
+    from api_gateway import main
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.path)
+        return httpx.Response(500, json={"detail": "error"})
+
+    mock_service("student", handler)
+    main.breakers["student"].reset()
+    try:
+        for _ in range(main.BREAKER_MIN_CALLS):
+            assert test_client.get("/api/student/students/").status_code == 500
+
+        response = test_client.get("/api/student/students/")
+        assert response.status_code == 503
+        assert int(response.headers["retry-after"]) >= 1
+        assert len(calls) == main.BREAKER_MIN_CALLS
+
+        state = test_client.get("/admin/circuit-breakers").json()["student"]
+        assert state["state"] == "open"
+        assert state["rejected"] >= 1
+    finally:
+        main.breakers["student"].reset()
+
+def test_circuit_breaker_no_queda_bloqueado_si_la_prueba_falla_inesperadamente(test_client, mock_service):
+    """Prueba que una excepción inesperada en la petición de prueba (half_open) vuelva a abrir el circuito"""
+    import time
+    from api_gateway import main
+
+    def handler(request):
+        raise RuntimeError("fallo inesperado del transporte")
+
+    mock_service("student", handler)
+    breaker = main.breakers["student"]
+    breaker.open()
+    breaker.opened_at = time.monotonic() - main.BREAKER_OPEN_SECONDS - 1
+    try:
+        with pytest.raises(RuntimeError):
+            test_client.get("/api/student/students/")
+        assert breaker.state == "open"
+        assert main.pool_stats["student"]["in_flight"] == 0
+
+        # Pasado el tiempo de espera el servicio recuperado vuelve a recibir peticiones
+        mock_service("student", lambda request: httpx.Response(200, json=[]))
+        breaker.opened_at = time.monotonic() - main.BREAKER_OPEN_SECONDS - 1
+        assert test_client.get("/api/student/students/").status_code == 200
+        assert breaker.state == "closed"
+    finally:
+        breaker.reset()
+
+def test_cache_get_etag_e_invalidacion(test_client, mock_service):
+    """Prueba la caché de GET: acierto, 304 con If-None-Match e invalidación tras un POST"""
+    from api_gateway import main
+    calls = []
+
+    def handler(request):
+        calls.append(request.method)
+        return httpx.Response(200, json=[{"id": 1, "name": "Laptop Dell XPS"}])
+
+    mock_service("resource", handler)
+    main.response_cache.entries.clear()
+
+    first = test_client.get("/api/resource/resources/")
+    assert first.headers["x-cache"] == "MISS"
+    etag = first.headers["etag"]
+
+    second = test_client.get("/api/resource/resources/")
+    assert second.headers["x-cache"] == "HIT"
+    assert len(second.headers.get_list("etag")) == 1
+    assert second.json() == first.json()
+    assert calls == ["GET"]
+
+    not_modified = test_client.get("/api/resource/resources/", headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+
+    test_client.post("/api/resource/resources/", json={"name": "Proyector"})
+    third = test_client.get("/api/resource/resources/")
+    assert third.headers["x-cache"] == "MISS"
+    assert calls == ["GET", "POST", "GET"]
+
+    cache = test_client.get("/metrics").json()["cache"]
+    assert cache["hits"] >= 2
+    assert cache["invalidations"] >= 1
+
+def test_cache_separa_por_accept_encoding_y_compara_etags_exactas(test_client, mock_service):
+    """Prueba que un cuerpo gzip no se sirva a quien no lo pidió y que If-None-Match compare etiquetas completas"""
+    import gzip
+    from api_gateway import main
+    calls = []
+
+    def handler(request):
+        calls.append(request.headers.get("accept-encoding"))
+        body = b"[]"
+        headers = {"content-type": "application/json", "etag": '"v1"'}
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            body = gzip.compress(body)
+            headers["content-encoding"] = "gzip"
+        # Los bytes se entregan sin decodificar, como los recibe el gateway
+        return httpx.Response(200, headers={**headers, "content-length": str(len(body))}, stream=AsyncBody(body))
+
+    # Transporte propio: el de mock_service decodificaría el cuerpo gzip
+    mock_service("resource", handler)
+    main.clients["resource"] = httpx.AsyncClient(base_url=main.SERVICES["resource"], transport=httpx.MockTransport(handler))
+    main.response_cache.entries.clear()
+
+    gzipped = test_client.get("/api/resource/resources/", headers={"Accept-Encoding": "gzip"})
+    assert gzipped.status_code == 200
+    # El servicio envía su propia ETag: la respuesta lleva una sola
+    assert gzipped.headers.get_list("etag") == ['"v1"']
+    plain = test_client.get("/api/resource/resources/", headers={"Accept-Encoding": "identity"})
+    assert plain.headers["x-cache"] == "MISS"
+    assert "content-encoding" not in plain.headers
+    assert plain.content == b"[]"
+    assert len(calls) == 2
+
+    identity = {"Accept-Encoding": "identity"}
+    not_modified = test_client.get("/api/resource/resources/", headers={**identity, "If-None-Match": 'W/"v1"'})
+    assert not_modified.status_code == 304
+    assert not_modified.headers.get_list("etag") == ['"v1"']
+    assert test_client.get("/api/resource/resources/", headers={**identity, "If-None-Match": '"x", "v1"'}).status_code == 304
+    assert test_client.get("/api/resource/resources/", headers={**identity, "If-None-Match": "*"}).status_code == 304
+    assert test_client.get("/api/resource/resources/", headers={**identity, "If-None-Match": '"v1-old"'}).status_code == 200
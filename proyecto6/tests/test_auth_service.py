@@ -0,0 +1,56 @@
+import os
+import tempfile
+import pytest
+from fastapi.testclient import TestClient
+
+os.environ.setdefault("AUTH_DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/auth_test.db")
+
+from auth_service import main
+
+client = TestClient(main.app)
+
+@pytest.fixture(scope="module")
+def token():
+    """Fixture que crea un usuario y devuelve su token"""
+    client.post("/users/", json={
+        "username": "bibliotecario", "email": "biblio@universidad.edu",
+        "role": "admin", "password": "secreto123",
+    })
+    response = client.post("/token", data={"username": "bibliotecario", "password": "secreto123"})
+    assert response.status_code == 200
+    return response.json()["access_token"]
+
+def test_validacion_caliente_sin_sqlite(token, monkeypatch):
+    """Prueba que una validación repetida no abra sesión con la base de datos"""
+    headers = {"Authorization": f"Bearer {token}"}
+    main.user_cache.clear()
+    assert client.get("/validate-token", headers=headers).status_code == 200
+
+    def no_db():
+        raise AssertionError("No se esperaba consultar SQLite")
+
+    monkeypatch.setattr(main, "SessionLocal", no_db)
+    response = client.get("/validate-token", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["user"]["username"] == "bibliotecario"
+    assert client.get("/metrics").json()["user_cache"]["hits"] >= 1
+
+def test_invalidacion_al_crear_usuario(token):
+    """Prueba que crear un usuario invalide su entrada en la caché"""
+    main.user_cache.set("nuevo", "obsoleto")
+    client.post("/users/", json={
+        "username": "nuevo", "email": "nuevo@universidad.edu",
+        "role": "staff", "password": "clave123",
+    })
+    assert main.user_cache.get("nuevo") is None
+
+def test_app_simplificada_carga_hashes_precalculados():
+    """Prueba que la app simplificada inicie sesión con el hash precalculado de users.json"""
+    from auth_service import app as auth_app
+
+    with TestClient(auth_app.app) as simple_client:
+        response = simple_client.post("/token", data={"username": "admin", "password": "admin123"})
+        assert response.status_code == 200
+        startup = simple_client.get("/metrics").json()["startup"]
+        assert startup["users_loaded"] == 1
+        assert startup["startup_ms"] is not None
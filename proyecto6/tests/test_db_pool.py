@@ -0,0 +1,64 @@
+import os
+import tempfile
+import threading
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from common.db import SQLitePool, register_pool
+
+def crear_pool():
+    pool = SQLitePool(os.path.join(tempfile.mkdtemp(), "pool_test.db"))
+    conn = pool.connection()
+    conn.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)")
+    conn.commit()
+    conn.close()
+    return pool
+
+def test_reutiliza_la_conexion_del_hilo_con_wal():
+    """Prueba que cada hilo reutilice su conexión y que los pragmas queden aplicados"""
+    pool = crear_pool()
+    conn = pool.connection()
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+    conn.close()
+    assert pool.connection() is conn
+    conn.close()
+
+    other = []
+    thread = threading.Thread(target=lambda: other.append(pool.connection()))
+    thread.start()
+    thread.join()
+    assert other[0] is not conn
+
+    stats = pool.stats()
+    assert stats["connections"] == 2
+    assert stats["reused"] == 2
+    pool.close_all()
+
+def test_close_deshace_la_transaccion_pendiente():
+    """Prueba que devolver la conexión sin confirmar descarte los cambios, salvo en un uso anidado"""
+    pool = crear_pool()
+    conn = pool.connection()
+    conn.execute("INSERT INTO items (name) VALUES ('sin confirmar')")
+    conn.close()
+    conn = pool.connection()
+    assert conn.execute("SELECT COUNT(*) FROM items").fetchone()[0] == 0
+
+    conn.execute("INSERT INTO items (name) VALUES ('exterior')")
+    inner = pool.connection()
+    inner.close()
+    assert conn.in_transaction
+    conn.commit()
+    conn.close()
+    assert pool.stats()["in_use"] == 0
+    pool.close_all()
+
+def test_register_pool_expone_metricas_y_cierra_al_apagar():
+    """Prueba que register_pool publique /metrics y cierre las conexiones al apagar la aplicación"""
+    pool = crear_pool()
+    app = FastAPI()
+    get_db = register_pool(app, pool)
+
+    with TestClient(app) as client:
+        get_db().close()
+        assert client.get("/metrics").json()["db"]["connections"] == 1
+    assert pool.stats()["connections"] == 0
@@ -0,0 +1,268 @@
+import json
+import os
+import tempfile
+import pytest
+import responses
+from fastapi.testclient import TestClient
+
+os.environ.setdefault("LOAN_DB_PATH", os.path.join(tempfile.mkdtemp(), "loans_test.db"))
+
+from loan_service import app as loan_app
+
+RESOURCE_URL = loan_app.RESOURCE_SERVICE_URL
+STUDENT_URL = loan_app.STUDENT_SERVICE_URL
+NOTIFICATION_URL = loan_app.NOTIFICATION_SERVICE_URL
+
+client = TestClient(loan_app.app)
+
+@pytest.fixture
+def servicios():
+    """Fixture que simula los servicios de estudiantes, recursos y notificaciones"""
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as mock:
+        mock.get(f"{STUDENT_URL}/students/by-student-id/A2023001",
+                 json={"student_id": "A2023001", "name": "Ana García", "email": "ana.garcia@universidad.edu"})
+        mock.get(f"{STUDENT_URL}/students/by-student-id/NOEXISTE", status=404)
+        mock.get(f"{RESOURCE_URL}/resources/1",
+                 json={"id": 1, "name": "Laptop Dell XPS", "quantity": 5, "loaned_quantity": 0, "status": "disponible"})
+        mock.get(f"{RESOURCE_URL}/resources/",
+                 json=[{"id": 1, "name": "Laptop Dell XPS", "quantity": 5, "loaned_quantity": 0, "status": "disponible"}])
+        mock.post(f"{RESOURCE_URL}/resources/1/reserve",
+                  json={"id": 1, "name": "Laptop Dell XPS", "quantity": 5, "loaned_quantity": 1, "status": "prestado"})
+        mock.post(f"{RESOURCE_URL}/resources/1/release",
+                  json={"id": 1, "name": "Laptop Dell XPS", "quantity": 5, "loaned_quantity": 0, "status": "disponible"})
+        mock.post(f"{NOTIFICATION_URL}/notify", json={"status": "success"})
+        mock.post(f"{STUDENT_URL}/students/lookup", json={
+            "students": [{"student_id": "A2023001", "name": "Ana García"}], "missing": []})
+        yield mock
+
+def test_crear_prestamo_con_server_timing(servicios):
+    """Prueba que crear un préstamo informe la duración de cada etapa"""
+    response = client.post("/loans/", json={"student_id": "A2023001", "resource_id": 1, "quantity": 1})
+    assert response.status_code == 200
+    stages = [stage.split(";")[0] for stage in response.headers["server-timing"].split(", ")]
+    assert stages[0] == "validate"
+    assert "db" in stages
+
+def test_crear_prestamo_estudiante_inexistente(servicios):
+    """Prueba que un estudiante inexistente se rechace con 404"""
+    response = client.post("/loans/", json={"student_id": "NOEXISTE", "resource_id": 1, "quantity": 1})
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Estudiante no encontrado"
+
+def test_prestamo_reserva_y_libera_todas_las_unidades(servicios):
+    """Prueba que un préstamo de varias unidades haga una sola reserva y una sola liberación"""
+    response = client.post("/loans/", json={"student_id": "A2023001", "resource_id": 1, "quantity": 3})
+    assert response.status_code == 200
+    loan_id = response.json()["id"]
+
+    reserves = [call for call in servicios.calls if call.request.url.endswith("/reserve")]
+    assert len(reserves) == 1
+    assert reserves[0].request.body == b'{"quantity": 3}'
+
+    response = client.put(f"/loans/{loan_id}/return")
+    assert response.status_code == 200
+    assert response.json()["status"] == "devuelto"
+    releases = [call for call in servicios.calls if call.request.url.endswith("/release")]
+    assert releases[0].request.body == b'{"quantity": 3}'
+
+def test_prestamo_en_lote(servicios):
+    """Prueba que un lote reserve todo de una vez, registre cada préstamo y envíe una sola notificación"""
+    servicios.post(f"{RESOURCE_URL}/resources/reserve-batch", json=[
+        {"id": 1, "name": "Laptop Dell XPS", "quantity": 5, "loaned_quantity": 1, "status": "prestado"},
+        {"id": 2, "name": "Proyector EPSON", "quantity": 2, "loaned_quantity": 2, "status": "prestado"},
+    ])
+    response = client.post("/loans/batch", json={
+        "student_id": "A2023001",
+        "items": [{"resource_id": 1, "quantity": 1}, {"resource_id": 2, "quantity": 2}],
+    })
+    assert response.status_code == 200
+    loans = response.json()
+    assert [loan["resource_id"] for loan in loans] == [1, 2]
+    assert loans[1]["id"] == loans[0]["id"] + 1
+
+    loan_app.dispatch_outbox()
+    notifications = [call for call in servicios.calls
+                     if call.request.url.endswith("/notify") and b"Proyector EPSON" in call.request.body]
+    assert len(notifications) == 1
+    assert b"Proyector EPSON (x2)" in notifications[0].request.body
+
+def pendientes():
+    conn = loan_app.get_db()
+    try:
+        return conn.execute(
+            "SELECT * FROM notification_outbox WHERE status = 'pendiente' ORDER BY id"
+        ).fetchall()
+    finally:
+        conn.close()
+
+def test_notificacion_se_guarda_en_bandeja_de_salida(servicios):
+    """Prueba que el préstamo no espere al servicio de notificaciones y que la bandeja la entregue después"""
+    loan_app.dispatch_outbox()
+    response = client.post("/loans/", json={"student_id": "A2023001", "resource_id": 1, "quantity": 1})
+    assert response.status_code == 200
+    assert not [call for call in servicios.calls if call.request.url.endswith("/notify")]
+    assert "Laptop Dell XPS" in pendientes()[-1]["message"]
+
+    loan_app.dispatch_outbox()
+    assert len([call for call in servicios.calls if call.request.url.endswith("/notify")]) == 1
+    assert pendientes() == []
+
+def test_notificacion_fallida_se_reintenta_con_espera(servicios):
+    """Prueba que un fallo del servicio de notificaciones deje la notificación pendiente con backoff"""
+    loan_app.dispatch_outbox()
+    servicios.replace(responses.POST, f"{NOTIFICATION_URL}/notify", status=503)
+    response = client.post("/loans/", json={"student_id": "A2023001", "resource_id": 1, "quantity": 1})
+    assert response.status_code == 200
+
+    loan_app.dispatch_outbox()
+    row = pendientes()[-1]
+    assert row["attempts"] == 1
+    assert row["last_error"] == "Error 503"
+    assert row["next_attempt_at"] > row["created_at"]
+
+    # Mientras no llegue la hora del siguiente intento no se vuelve a llamar
+    calls = len(servicios.calls)
+    loan_app.dispatch_outbox()
+    assert len(servicios.calls) == calls
+
+    conn = loan_app.get_db()
+    conn.execute("UPDATE notification_outbox SET status = 'enviado' WHERE id = ?", (row["id"],))
+    conn.commit()
+    conn.close()
+
+def test_prestamo_en_lote_rechazado(servicios):
+    """Prueba que si un recurso del lote no está disponible no se registre ningún préstamo"""
+    servicios.post(f"{RESOURCE_URL}/resources/reserve-batch", status=400, json={"detail": {
+        "message": "No se pudo procesar el lote",
+        "items": [{"resource_id": 2, "detail": "No hay suficientes unidades disponibles. Disponibles: 0"}],
+    }})
+    before = int(client.get("/loans/").headers["x-total-count"])
+    response = client.post("/loans/batch", json={
+        "student_id": "A2023001",
+        "items": [{"resource_id": 1}, {"resource_id": 2}],
+    })
+    assert response.status_code == 400
+    assert response.json()["detail"]["items"][0]["resource_id"] == 2
+    assert int(client.get("/loans/").headers["x-total-count"]) == before
+
+def test_revision_de_prestamos_vencidos(servicios):
+    """Prueba que la revisión marque los préstamos vencidos una sola vez y encole su notificación"""
+    response = client.post("/loans/", json={"student_id": "A2023001", "resource_id": 1, "quantity": 1})
+    loan_id = response.json()["id"]
+    conn = loan_app.get_db()
+    conn.execute("UPDATE loans SET due_date = ? WHERE id = ?", ("2000-01-01T00:00:00", loan_id))
+    conn.commit()
+    conn.close()
+
+    assert loan_app.scan_overdue() >= 1
+    conn = loan_app.get_db()
+    status = conn.execute("SELECT status FROM loans WHERE id = ?", (loan_id,)).fetchone()["status"]
+    conn.close()
+    assert status == "vencido"
+    assert f"#{loan_id} (vencía el 2000-01-01)" in pendientes()[-1]["message"]
+
+    # Los ya marcados no se vuelven a procesar
+    assert loan_app.scan_overdue() == 0
+
+    # Un préstamo reabierto con una fecha anterior a la última revisión también se detecta
+    conn = loan_app.get_db()
+    conn.execute("UPDATE loans SET status = 'prestado', due_date = ? WHERE id = ?", ("1999-06-01T00:00:00", loan_id))
+    conn.commit()
+    conn.close()
+    assert loan_app.scan_overdue() == 1
+    loan_app.dispatch_outbox()
+
+def test_vista_de_prestamos_paginada_con_nombres(servicios):
+    """Prueba que la vista devuelva los nombres ya resueltos y pagine con cursor"""
+    for quantity in (1, 2):
+        client.post("/loans/", json={"student_id": "A2023001", "resource_id": 1, "quantity": quantity})
+
+    response = client.get("/loans/view", params={"limit": 1})
+    assert response.status_code == 200
+    [loan] = response.json()
+    assert loan["resource_name"] == "Laptop Dell XPS"
+    assert loan["student_name"] == "Ana García"
+    assert loan["quantity"] == 2
+    assert int(response.headers["x-total-count"]) >= 2
+
+    next_page = client.get("/loans/view", params={"limit": 1, "cursor": response.headers["x-next-cursor"]})
+    assert next_page.json()[0]["id"] < loan["id"]
+    assert "x-total-count" not in next_page.headers
+
+    # Los cambios de estado llegan a la vista por trigger y GET /loans/{id} lee por nombre de columna
+    client.put(f"/loans/{loan['id']}/return")
+    assert client.get("/loans/view", params={"limit": 1}).json()[0]["status"] == "devuelto"
+    assert client.get(f"/loans/{loan['id']}").json()["quantity"] == 2
+
+def test_backfill_completa_nombres_de_la_vista(servicios):
+    """Prueba que los préstamos sin nombres en la vista se completen consultando los servicios"""
+    conn = loan_app.get_db()
+    conn.execute(
+        "INSERT INTO loans (student_id, resource_id, quantity, loan_date, due_date) VALUES (?, ?, ?, ?, ?)",
+        ("A2023001", 1, 1, "2024-01-01T00:00:00", "2024-01-08T00:00:00")
+    )
+    loan_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+    conn.commit()
+    conn.close()
+
+    loan_app.backfill_loan_view()
+    conn = loan_app.get_db()
+    row = conn.execute("SELECT * FROM loan_view WHERE loan_id = ?", (loan_id,)).fetchone()
+    conn.close()
+    assert (row["student_name"], row["resource_name"]) == ("Ana García", "Laptop Dell XPS")
+
+def test_refresco_periodico_recoge_renombrados(servicios):
+    """Prueba que la revisión periódica recorra el listado de recursos por cursor y solo toque los renombrados"""
+    from common.versioning import data_version
+    names = {1: "Laptop Dell XPS"}
+
+    def resource_pages(request):
+        # Dos páginas: el recurso 1 y, tras el cursor, el resto vacío
+        if "cursor=" in request.url:
+            return 200, {}, json.dumps([])
+        body = [{"id": rid, "name": name, "quantity": 5, "loaned_quantity": 0, "status": "disponible"}
+                for rid, name in names.items()]
+        return 200, {"X-Next-Cursor": "1"}, json.dumps(body)
+
+    servicios.remove(responses.GET, f"{RESOURCE_URL}/resources/")
+    servicios.add_callback(responses.GET, f"{RESOURCE_URL}/resources/", callback=resource_pages)
+    client.post("/loans/", json={"student_id": "A2023001", "resource_id": 1, "quantity": 1})
+    loan_app.refresh_loan_view_names()
+
+    conn = loan_app.get_db()
+    version = data_version(conn, "loan_view")
+    conn.close()
+    calls = len(servicios.calls)
+    assert loan_app.refresh_loan_view_names() == 0
+    # Una consulta de estudiantes y dos páginas de recursos, sin un GET por recurso
+    assert len(servicios.calls) - calls == 3
+
+    servicios.replace(responses.POST, f"{STUDENT_URL}/students/lookup", json={
+        "students": [{"student_id": "A2023001", "name": "Ana García López"}], "missing": []})
+    names[1] = "Laptop Dell XPS 13"
+    # Solo se completan los que faltan: los renombrados esperan a la revisión completa
+    loan_app.backfill_loan_view()
+    loan = client.get("/loans/view", params={"student_id": "A2023001", "limit": 1}).json()[0]
+    assert loan["student_name"] == "Ana García"
+
+    assert loan_app.refresh_loan_view_names() > 0
+    loan = client.get("/loans/view", params={"student_id": "A2023001", "limit": 1}).json()[0]
+    assert (loan["student_name"], loan["resource_name"]) == ("Ana García López", "Laptop Dell XPS 13")
+    conn = loan_app.get_db()
+    assert data_version(conn, "loan_view") > version
+    conn.close()
+
+def test_listado_de_prestamos_por_cursor_y_filtros(servicios):
+    """Prueba que el listado pagine por id con cursor y aplique los filtros en el servidor"""
+    client.post("/loans/", json={"student_id": "A2023001", "resource_id": 1, "quantity": 1})
+    client.post("/loans/", json={"student_id": "A2023001", "resource_id": 1, "quantity": 1})
+
+    first = client.get("/loans/", params={"limit": 1})
+    assert len(first.json()) == 1
+    second = client.get("/loans/", params={"limit": 1, "cursor": first.headers["x-next-cursor"]})
+    assert second.json()[0]["id"] > first.json()[0]["id"]
+
+    client.put(f"/loans/{second.json()[0]['id']}/return")
+    returned = client.get("/loans/", params={"status": "devuelto", "limit": 500})
+    assert returned.json() and all(loan["status"] == "devuelto" for loan in returned.json())
+    assert int(returned.headers["x-total-count"]) == len(returned.json())
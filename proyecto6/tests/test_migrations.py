@@ -0,0 +1,42 @@
+import os
+import sqlite3
+import tempfile
+import pytest
+
+os.environ.setdefault("LOAN_DB_PATH", os.path.join(tempfile.mkdtemp(), "loans_test.db"))
+
+from common.migrations import run_migrations, schema_version
+from loan_service import app as loan_app
+
+MIGRATIONS = [
+    (1, "tabla", ["CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)"]),
+    (2, "índice", ["CREATE INDEX idx_items_name ON items (name)"]),
+]
+
+def test_migraciones_se_aplican_una_sola_vez():
+    """Prueba que las migraciones se apliquen en orden y que volver a ejecutarlas no haga nada"""
+    conn = sqlite3.connect(":memory:")
+    assert run_migrations(conn, list(reversed(MIGRATIONS))) == [1, 2]
+    assert run_migrations(conn, MIGRATIONS) == []
+    assert schema_version(conn) == 2
+
+def test_migracion_fallida_no_deja_cambios():
+    """Prueba que una migración con error se revierta completa y no quede registrada"""
+    conn = sqlite3.connect(":memory:")
+    broken = MIGRATIONS + [(3, "rota", ["ALTER TABLE items ADD COLUMN price REAL", "SELECT * FROM no_existe"])]
+    with pytest.raises(sqlite3.OperationalError):
+        run_migrations(conn, broken)
+    assert schema_version(conn) == 2
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(items)")]
+    assert "price" not in columns
+
+def test_historial_de_estudiante_usa_indice():
+    """Prueba que la consulta de préstamos por estudiante use el índice en lugar de recorrer la tabla"""
+    conn = loan_app.get_db()
+    try:
+        plan = " ".join(row[-1] for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM loans WHERE student_id = ?", ("A2023001",)
+        ))
+    finally:
+        conn.close()
+    assert "idx_loans_student_id" in plan
@@ -0,0 +1,231 @@
+import asyncio
+import json
+import os
+import tempfile
+import httpx
+from fastapi.testclient import TestClient
+from notification_service import main
+from notification_service import app as notification_app
+from notification_service.main import FakeTransport, NotificationPipeline, NotificationJournal, DeadLetterStore, TransportError
+
+os.environ.setdefault("STUDENT_DB_PATH", os.path.join(tempfile.mkdtemp(), "students_test.db"))
+from student_service import app as student_app
+
+STUDENTS = {"A2023001": "ana.garcia@universidad.edu"}
+
+def student_service(request: httpx.Request):
+    student_id = request.url.path.rsplit("/", 1)[-1]
+    if student_id not in STUDENTS:
+        return httpx.Response(404, json={"detail": "Student not found"})
+    return httpx.Response(200, json={"student_id": student_id, "email": STUDENTS[student_id]})
+
+def crear_pipeline(transport, **kwargs):
+    kwargs.setdefault("journal", NotificationJournal(None))
+    pipeline = NotificationPipeline(transport=transport, coalesce_window=0.05, rate_limit=0,
+                                    dead_letters=DeadLetterStore(None), **kwargs)
+    pipeline.http_client = httpx.AsyncClient(transport=httpx.MockTransport(student_service))
+    return pipeline
+
+async def notificar(pipeline, notifications):
+    """Publica las notificaciones por /notify y espera a que el pipeline las procese"""
+    main.pipeline = pipeline
+    await pipeline.start()
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://notify") as client:
+        responses = [await client.post("/notify", json=n) for n in notifications]
+    await pipeline.drain()
+    await pipeline.stop()
+    return responses
+
+def test_notify_encola_y_agrupa_por_destinatario():
+    """Prueba que /notify responda 202 y que varios mensajes al mismo estudiante salgan en un solo correo"""
+    transport = FakeTransport()
+    pipeline = crear_pipeline(transport)
+    responses = asyncio.run(notificar(pipeline, [
+        {"student_id": "A2023001", "message": "Préstamo registrado"},
+        {"student_id": "A2023001", "message": "Préstamo devuelto"},
+    ]))
+
+    assert [r.status_code for r in responses] == [202, 202]
+    assert len(transport.sent) == 1
+    to_email, body = transport.sent[0]
+    assert to_email == "ana.garcia@universidad.edu"
+    assert "Préstamo registrado" in body and "Préstamo devuelto" in body
+    assert pipeline.stats["messages_sent"] == 2
+
+def test_fallos_se_reintentan_y_terminan_en_dead_letter(monkeypatch):
+    """Prueba que un fallo transitorio se reintente y que un estudiante inexistente vaya a dead letters"""
+    monkeypatch.setattr(main, "NOTIFY_RETRY_BASE", 0.001)
+
+    class FlakyTransport(FakeTransport):
+        async def send(self, to_email, html_content):
+            if not self.sent and not getattr(self, "failed", False):
+                self.failed = True
+                raise TransportError("429 Too Many Requests")
+            await super().send(to_email, html_content)
+
+    transport = FlakyTransport()
+    pipeline = crear_pipeline(transport)
+    asyncio.run(notificar(pipeline, [
+        {"student_id": "A2023001", "message": "Préstamo registrado"},
+        {"student_id": "NOEXISTE", "message": "Préstamo registrado"},
+    ]))
+
+    assert len(transport.sent) == 1
+    assert pipeline.stats["retries"] == 1
+    dead = list(pipeline.dead_letters.recent)
+    assert [entry["student_id"] for entry in dead] == ["NOEXISTE"]
+    assert dead[0]["reason"] == "Student not found"
+
+def test_cache_de_emails_evita_consultas_repetidas():
+    """Prueba que el prefetch resuelva todo en una consulta y que los recordatorios no vuelvan a consultar"""
+    requests_seen = []
+
+    def students(request: httpx.Request):
+        requests_seen.append(request.url.path)
+        if request.url.path == "/students/lookup":
+            return httpx.Response(200, json={
+                "students": [{"student_id": "A2023001", "email": STUDENTS["A2023001"]}],
+                "missing": ["NOEXISTE"],
+            })
+        return student_service(request)
+
+    notification_app.email_cache.clear()
+    notification_app.http_client = httpx.AsyncClient(transport=httpx.MockTransport(students))
+    client = TestClient(notification_app.app)
+
+    response = client.post("/prefetch", json={"student_ids": ["A2023001", "NOEXISTE", "A2023001"]})
+    assert response.json()["missing"] == ["NOEXISTE"]
+    assert requests_seen == ["/students/lookup"]
+
+    for _ in range(3):
+        assert client.post("/notify", json={"student_id": "A2023001", "message": "Recordatorio"}).status_code == 200
+    # El estudiante inexistente queda en caché negativa
+    assert client.post("/notify", json={"student_id": "NOEXISTE", "message": "Recordatorio"}).status_code == 404
+    assert requests_seen == ["/students/lookup"]
+
+def test_notificacion_masiva_con_plantilla_y_ndjson(monkeypatch):
+    """Prueba que /notify/bulk resuelva los emails en una consulta y devuelva un resultado por notificación"""
+    requests_seen = []
+
+    def students(request: httpx.Request):
+        requests_seen.append(request.url.path)
+        ids = json.loads(request.content)["student_ids"]
+        return httpx.Response(200, json={
+            "students": [{"student_id": sid, "email": STUDENTS[sid]} for sid in ids if sid in STUDENTS],
+            "missing": [sid for sid in ids if sid not in STUDENTS],
+        })
+
+    monkeypatch.setattr(notification_app, "SENDGRID_API_KEY", None)
+    notification_app.email_cache.clear()
+    notification_app.http_client = httpx.AsyncClient(transport=httpx.MockTransport(students))
+    client = TestClient(notification_app.app)
+
+    body = "\n".join(json.dumps(item) for item in [
+        {"student_id": "A2023001", "context": {"resource": "Laptop Dell XPS"}},
+        {"student_id": "NOEXISTE", "context": {"resource": "Proyector"}},
+        {"message": "sin estudiante"},
+    ])
+    response = client.post(
+        "/notify/bulk",
+        params={"template": "Devuelve {resource} ({student_id})"},
+        content=body,
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert [r["status"] for r in data["results"]] == ["simulated", "not_found", "invalid"]
+    assert data["summary"] == {"simulated": 1, "not_found": 1, "invalid": 1}
+    assert requests_seen == ["/students/lookup"]
+
+def test_dead_letters_valida_el_limite():
+    """Prueba que /dead-letters rechace límites nulos o negativos en lugar de invertir el recorte"""
+    main.pipeline = crear_pipeline(FakeTransport())
+    for student_id in ("A1", "A2", "A3"):
+        main.pipeline.dead_letters.add(student_id, ["Préstamo registrado"], "Student not found", 1)
+    client = TestClient(main.app)
+
+    assert [e["student_id"] for e in client.get("/dead-letters", params={"limit": 2}).json()] == ["A2", "A3"]
+    assert client.get("/dead-letters", params={"limit": 0}).status_code == 422
+    assert client.get("/dead-letters", params={"limit": -1}).status_code == 422
+
+def test_plantilla_no_evalua_atributos_ni_indices(monkeypatch):
+    """Prueba que la plantilla solo sustituya {nombre} y deje tal cual atributos, índices y campos desconocidos"""
+    def students(request: httpx.Request):
+        return httpx.Response(200, json={
+            "students": [{"student_id": "A2023001", "email": STUDENTS["A2023001"]}], "missing": [],
+        })
+
+    sent = []
+
+    async def send_email(to_email, content):
+        sent.append(content)
+        return False
+
+    monkeypatch.setattr(notification_app, "send_email", send_email)
+    notification_app.email_cache.clear()
+    notification_app.http_client = httpx.AsyncClient(transport=httpx.MockTransport(students))
+    client = TestClient(notification_app.app)
+
+    response = client.post("/notify/bulk", json=[
+        {"student_id": "A2023001", "template": "Hola {email.__class__}"},
+        {"student_id": "A2023001", "template": "Hola {student_id[0]} {desconocido}"},
+        {"student_id": "A2023001", "template": "Hola {student_id} {{literal}}"},
+    ])
+    assert response.status_code == 200
+    assert [r["status"] for r in response.json()["results"]] == ["simulated"] * 3
+    assert sorted(sent) == sorted(["Hola {email.__class__}", "Hola {student_id[0]} {desconocido}", "Hola A2023001 {literal}"])
+
+def test_pipeline_consulta_el_servicio_de_estudiantes_real():
+    """Prueba que el pipeline resuelva el email contra el servicio de estudiantes sin token y no reintente un 4xx"""
+    transport = FakeTransport()
+    pipeline = crear_pipeline(transport)
+    pipeline.http_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=student_app.app))
+    asyncio.run(notificar(pipeline, [
+        {"student_id": "A2023001", "message": "Préstamo registrado"},
+        {"student_id": "NOEXISTE", "message": "Préstamo registrado"},
+    ]))
+
+    assert [to_email for to_email, _ in transport.sent] == ["ana.garcia@universidad.edu"]
+    assert [entry["student_id"] for entry in pipeline.dead_letters.recent] == ["NOEXISTE"]
+
+    def forbidden(request: httpx.Request):
+        return httpx.Response(403, json={"detail": "Forbidden"})
+
+    pipeline = crear_pipeline(FakeTransport())
+    pipeline.http_client = httpx.AsyncClient(transport=httpx.MockTransport(forbidden))
+    asyncio.run(notificar(pipeline, [{"student_id": "A2023001", "message": "Préstamo registrado"}]))
+    assert pipeline.stats["retries"] == 0
+    assert pipeline.dead_letters.recent[0]["attempts"] == 1
+
+def test_notificaciones_aceptadas_sobreviven_a_un_apagado_sin_drenar():
+    """Prueba que lo aceptado con 202 y no entregado antes de apagar se reenvíe al volver a arrancar"""
+    path = os.path.join(tempfile.mkdtemp(), "journal.db")
+
+    class StuckTransport(FakeTransport):
+        async def send(self, to_email, html_content):
+            await asyncio.sleep(3600)
+
+    async def interrumpido():
+        pipeline = crear_pipeline(StuckTransport(), journal=NotificationJournal(path))
+        main.pipeline = pipeline
+        await pipeline.start()
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://notify") as client:
+            response = await client.post("/notify", json={"student_id": "A2023001", "message": "Préstamo registrado"})
+        assert response.status_code == 202
+        await asyncio.sleep(0.1)
+        await pipeline.stop(drain_timeout=0.1)
+
+    asyncio.run(interrumpido())
+
+    async def reinicio():
+        transport = FakeTransport()
+        pipeline = crear_pipeline(transport, journal=NotificationJournal(path))
+        await pipeline.start()
+        await pipeline.drain()
+        await pipeline.stop()
+        return transport, pipeline
+
+    transport, pipeline = asyncio.run(reinicio())
+    assert [to_email for to_email, _ in transport.sent] == ["ana.garcia@universidad.edu"]
+    assert pipeline.stats["replayed"] == 1
+    assert NotificationJournal(path).pending() == []
@@ -0,0 +1,93 @@
+import os
+import tempfile
+from fastapi.testclient import TestClient
+
+os.environ.setdefault("RESOURCE_DB_PATH", os.path.join(tempfile.mkdtemp(), "resources_test.db"))
+
+from resource_service import app as resource_app
+
+client = TestClient(resource_app.app)
+
+def crear_recurso(quantity):
+    response = client.post("/resources/", json={
+        "name": "Cámara Sony", "description": "Cámara", "type": "Equipo Fotográfico", "quantity": quantity,
+    })
+    return response.json()["id"]
+
+def test_reservar_y_liberar_unidades():
+    """Prueba que reservar y liberar ajuste las unidades prestadas en una sola operación"""
+    resource_id = crear_recurso(5)
+
+    response = client.post(f"/resources/{resource_id}/reserve", json={"quantity": 3})
+    assert response.status_code == 200
+    assert response.json()["loaned_quantity"] == 3
+    assert response.json()["status"] == "prestado"
+
+    response = client.post(f"/resources/{resource_id}/release", json={"quantity": 3})
+    assert response.status_code == 200
+    assert response.json()["loaned_quantity"] == 0
+    assert response.json()["status"] == "disponible"
+
+def test_reserva_sin_unidades_suficientes():
+    """Prueba que no se reserven más unidades de las disponibles"""
+    resource_id = crear_recurso(2)
+
+    response = client.post(f"/resources/{resource_id}/reserve", json={"quantity": 3})
+    assert response.status_code == 400
+    assert "Disponibles: 2" in response.json()["detail"]
+    assert client.get(f"/resources/{resource_id}").json()["loaned_quantity"] == 0
+
+def test_reserva_recurso_inexistente():
+    """Prueba que reservar un recurso inexistente devuelva 404"""
+    response = client.post("/resources/99999/reserve", json={"quantity": 1})
+    assert response.status_code == 404
+
+def test_reserva_en_lote_todo_o_nada():
+    """Prueba que un lote con un recurso sin unidades no reserve ninguno"""
+    laptop = crear_recurso(3)
+    camara = crear_recurso(1)
+
+    response = client.post("/resources/reserve-batch", json={"items": [
+        {"resource_id": laptop, "quantity": 2}, {"resource_id": camara, "quantity": 2},
+    ]})
+    assert response.status_code == 400
+    assert [item["resource_id"] for item in response.json()["detail"]["items"]] == [camara]
+    assert client.get(f"/resources/{laptop}").json()["loaned_quantity"] == 0
+
+    response = client.post("/resources/reserve-batch", json={"items": [
+        {"resource_id": laptop, "quantity": 2}, {"resource_id": camara, "quantity": 1},
+    ]})
+    assert response.status_code == 200
+    assert [r["loaned_quantity"] for r in response.json()] == [2, 1]
+
+def test_listado_filtra_por_disponibilidad_y_pagina():
+    """Prueba que el listado filtre en el servidor y devuelva el cursor de la siguiente página"""
+    agotado = crear_recurso(1)
+    client.post(f"/resources/{agotado}/reserve", json={"quantity": 1})
+
+    disponibles = client.get("/resources/", params={"available": "true", "limit": 500}).json()
+    assert agotado not in [r["id"] for r in disponibles]
+    assert all(r["quantity"] > r["loaned_quantity"] for r in disponibles)
+
+    page = client.get("/resources/", params={"limit": 2})
+    assert len(page.json()) == 2
+    assert int(page.headers["x-total-count"]) > 2
+    rest = client.get("/resources/", params={"cursor": page.headers["x-next-cursor"], "limit": 500})
+    assert rest.json()[0]["id"] > page.json()[-1]["id"]
+
+def test_listado_responde_304_mientras_no_cambien_los_datos():
+    """Prueba que el listado devuelva 304 con la misma ETag y que cualquier escritura la invalide"""
+    crear_recurso(1)
+    first = client.get("/resources/", params={"limit": 5})
+    etag = first.headers["etag"]
+
+    again = client.get("/resources/", params={"limit": 5}, headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.headers["etag"] == etag
+    # Otra página u otros filtros tienen su propia ETag
+    assert client.get("/resources/", params={"limit": 6}, headers={"If-None-Match": etag}).status_code == 200
+
+    crear_recurso(1)
+    changed = client.get("/resources/", params={"limit": 5}, headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["etag"] != etag
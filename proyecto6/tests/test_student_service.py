@@ -0,0 +1,18 @@
+import os
+import tempfile
+from fastapi.testclient import TestClient
+
+os.environ.setdefault("STUDENT_DB_PATH", os.path.join(tempfile.mkdtemp(), "students_test.db"))
+
+from student_service.app import app
+
+client = TestClient(app)
+
+def test_consulta_masiva_de_estudiantes():
+    """Prueba que la consulta masiva devuelva los estudiantes encontrados y los códigos inexistentes"""
+    response = client.post("/students/lookup", json={"student_ids": ["A2023001", "A2023003", "NOEXISTE", "A2023001"]})
+    assert response.status_code == 200
+    data = response.json()
+    assert sorted(s["student_id"] for s in data["students"]) == ["A2023001", "A2023003"]
+    assert data["students"][0]["email"].endswith("@universidad.edu")
+    assert data["missing"] == ["NOEXISTE"]
@@ -0,0 +1,56 @@
+import pytest
+from datetime import datetime, timedelta
+from jose import jwt
+from common.auth import InvalidTokenError, TokenVerifier, create_verifier
+
+SECRET_KEY = "clave_de_prueba"
+
+def make_token(sub="admin", minutes=30, key=SECRET_KEY):
+    expire = datetime.utcnow() + timedelta(minutes=minutes)
+    return jwt.encode({"sub": sub, "exp": expire}, key, algorithm="HS256")
+
+def test_token_valido():
+    """Prueba que un token firmado con la clave compartida se acepte localmente"""
+    verifier = TokenVerifier(SECRET_KEY)
+    claims = verifier.verify(make_token())
+    assert claims["sub"] == "admin"
+
+def test_token_con_firma_invalida():
+    """Prueba que se rechace un token firmado con otra clave"""
+    verifier = TokenVerifier(SECRET_KEY)
+    with pytest.raises(InvalidTokenError):
+        verifier.verify(make_token(key="otra_clave"))
+
+def test_token_expirado():
+    """Prueba que se rechace un token expirado"""
+    verifier = TokenVerifier(SECRET_KEY)
+    with pytest.raises(InvalidTokenError):
+        verifier.verify(make_token(minutes=-1))
+
+def test_cache_y_revocacion():
+    """Prueba que la comprobación de revocación se haga una vez por token y que revocar lo invalide"""
+    checks = []
+
+    def revocation_check(token, claims):
+        checks.append(token)
+        return True
+
+    verifier = TokenVerifier(SECRET_KEY, revocation_check=revocation_check)
+    token = make_token()
+    verifier.verify(token)
+    verifier.verify(token)
+    assert len(checks) == 1
+    assert verifier.claims_cache.hits == 1
+
+    verifier.revoke(token)
+    with pytest.raises(InvalidTokenError):
+        verifier.verify(token)
+
+def test_create_verifier_exige_secret_key(monkeypatch):
+    """Prueba que sin SECRET_KEY el servicio no arranque en lugar de rechazar todos los tokens"""
+    monkeypatch.delenv("SECRET_KEY", raising=False)
+    with pytest.raises(RuntimeError, match="SECRET_KEY"):
+        create_verifier()
+
+    monkeypatch.setenv("SECRET_KEY", SECRET_KEY)
+    assert create_verifier().verify(make_token())["sub"] == "admin"
@@ -0,0 +1,110 @@
+import os
+from datetime import datetime, timedelta
+import pytest
+import requests
+import responses
+from jose import jwt
+
+os.environ.setdefault("SECRET_KEY", "clave-de-pruebas")
+
+from web_interface import app as web_app
+
+RESOURCE_URL = web_app.RESOURCE_SERVICE_URL
+STUDENT_URL = web_app.STUDENT_SERVICE_URL
+
+@pytest.fixture
+def cliente():
+    """Cliente de Flask con una sesión ya autenticada"""
+    token = jwt.encode(
+        {"sub": "admin", "exp": datetime.utcnow() + timedelta(minutes=30)},
+        web_app.token_verifier.secret_key,
+        algorithm=web_app.token_verifier.algorithm,
+    )
+    with web_app.app.test_client() as client:
+        with client.session_transaction() as session:
+            session["token"] = token
+        yield client
+
+def test_formulario_de_prestamo_se_degrada_si_un_servicio_falla(cliente):
+    """Prueba que si el servicio de recursos no responde el formulario se muestre con los estudiantes"""
+    with responses.RequestsMock() as mock:
+        mock.get(f"{RESOURCE_URL}/resources/", body=requests.exceptions.ReadTimeout("sin respuesta"))
+        mock.get(f"{STUDENT_URL}/students/", json=[{
+            "id": 1, "name": "Ana García", "email": "ana.garcia@universidad.edu", "student_id": "A2023001",
+            "career": "Ingeniería de Software", "semester": 4, "phone": None,
+        }])
+        response = cliente.get("/loans/create")
+
+    assert response.status_code == 200
+    html = response.get_data(as_text=True)
+    assert "Ana García" in html
+    assert "Error al obtener recursos" in html
+
+def test_sesion_reutiliza_la_validacion_del_token(cliente, monkeypatch):
+    """Prueba que solo la primera página valide el token y las siguientes usen las claims de la sesión"""
+    calls = []
+    verify = web_app.token_verifier.verify
+    monkeypatch.setattr(web_app.token_verifier, "verify", lambda token: calls.append(token) or verify(token))
+    saved = web_app.auth_stats["saved"]
+
+    with responses.RequestsMock() as mock:
+        mock.get(f"{RESOURCE_URL}/resources/", json=[])
+        for _ in range(3):
+            assert cliente.get("/resources").status_code == 200
+
+    assert len(calls) == 1
+    assert web_app.auth_stats["saved"] == saved + 2
+    assert cliente.get("/metrics").get_json()["auth"]["saved"] == saved + 2
+
+    # Pasado el intervalo se vuelve a validar
+    monkeypatch.setattr(web_app, "AUTH_REVALIDATE_INTERVAL", 0)
+    with responses.RequestsMock() as mock:
+        mock.get(f"{RESOURCE_URL}/resources/", json=[])
+        cliente.get("/resources")
+    assert len(calls) == 2
+
+def test_cache_de_fragmentos_y_304_al_navegador(cliente):
+    """Prueba que un 304 del servicio reutilice las filas renderizadas y que el navegador reciba 304"""
+    web_app.render_cache.clear()
+    stats = web_app.render_cache.stats()
+    resource = {
+        "id": 7, "name": "Proyector Epson", "description": "Proyector", "type": "Equipo Audiovisual",
+        "quantity": 2, "loaned_quantity": 0, "status": "disponible", "updated_at": "2024-01-01T00:00:00",
+    }
+
+    with responses.RequestsMock() as mock:
+        mock.get(f"{RESOURCE_URL}/resources/", json=[resource], headers={"ETag": '"resources-3-abc"', "X-Total-Count": "1"})
+        first = cliente.get("/resources")
+        assert "If-None-Match" not in mock.calls[0].request.headers
+
+    with responses.RequestsMock() as mock:
+        mock.get(f"{RESOURCE_URL}/resources/", status=304, headers={"ETag": '"resources-3-abc"'})
+        second = cliente.get("/resources")
+        assert mock.calls[0].request.headers["If-None-Match"] == '"resources-3-abc"'
+        # El navegador revalida con la ETag de la página y no se renderiza nada
+        third = cliente.get("/resources", headers={"If-None-Match": first.headers["ETag"]})
+
+    assert "Proyector Epson" in second.get_data(as_text=True)
+    assert "1 recursos" in second.get_data(as_text=True)
+    assert second.headers["ETag"] == first.headers["ETag"]
+    assert third.status_code == 304
+    assert third.get_data() == b""
+
+    metrics = cliente.get("/metrics").get_json()["render_cache"]
+    assert metrics["hits"] == stats["hits"] + 2
+    assert metrics["misses"] == stats["misses"] + 1
+    assert metrics["browser_not_modified"] == stats["browser_not_modified"] + 1
+    assert metrics["bytes"] > 0 and metrics["bytes_served"] >= 2 * metrics["bytes"]
+
+def test_fetch_all_respeta_el_plazo_y_el_maximo_de_paginas(monkeypatch):
+    """Prueba que fetch_all no siga pidiendo páginas pasado el plazo ni más allá del máximo"""
+    import time
+    monkeypatch.setattr(web_app, "FETCH_ALL_MAX_PAGES", 2)
+
+    with responses.RequestsMock() as mock:
+        mock.get(f"{RESOURCE_URL}/resources/", json=[{"id": 1}], headers={"X-Next-Cursor": "1"})
+        assert web_app.fetch_all(f"{RESOURCE_URL}/resources/") == [{"id": 1}, {"id": 1}]
+        assert len(mock.calls) == 2
+
+        assert web_app.fetch_all(f"{RESOURCE_URL}/resources/", deadline=time.monotonic() - 1) is None
+        assert len(mock.calls) == 2
@@ -1,9 +1,21 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, make_response
+from markupsafe import Markup
 import requests
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 from functools import wraps
+import hashlib
 import os
+import threading
+import time
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
+import sys
+
+# Permite importar el paquete común al ejecutar la aplicación desde su carpeta
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.auth import InvalidTokenError, create_verifier
 
 load_dotenv()
 
@@ -15,6 +27,243 @@ AUTH_SERVICE_URL = os.getenv("AUTH_SERVICE_URL", "http://localhost:8000")
 RESOURCE_SERVICE_URL = os.getenv("RESOURCE_SERVICE_URL", "http://localhost:8001")
 STUDENT_SERVICE_URL = os.getenv("STUDENT_SERVICE_URL", "http://localhost:8002")
 LOAN_SERVICE_URL = os.getenv("LOAN_SERVICE_URL", "http://localhost:8003")
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "50"))
+
+# Sesión HTTP compartida: reutiliza conexiones entre peticiones y nunca espera sin límite
+HTTP_POOL_SIZE = int(os.getenv("WEB_HTTP_POOL_SIZE", "20"))
+TIMEOUT = (float(os.getenv("WEB_CONNECT_TIMEOUT", "2")), float(os.getenv("WEB_READ_TIMEOUT", "5")))
+# Tiempo máximo que una página espera a sus consultas concurrentes antes de mostrarse incompleta
+PAGE_BUDGET = float(os.getenv("WEB_PAGE_BUDGET", "6"))
+# Máximo de páginas que fetch_all recorre para llenar un selector
+FETCH_ALL_MAX_PAGES = int(os.getenv("WEB_FETCH_ALL_MAX_PAGES", "20"))
+
+http = requests.Session()
+http.mount("http://", HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+http.mount("https://", HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+fetch_executor = ThreadPoolExecutor(max_workers=int(os.getenv("WEB_FETCH_WORKERS", "8")), thread_name_prefix="fetch")
+
+# El token se verifica localmente con la SECRET_KEY compartida con auth_service
+token_verifier = create_verifier()
+# Las claims validadas se guardan en la sesión (cookie firmada) y solo se revalidan
+# cada AUTH_REVALIDATE_INTERVAL segundos o cuando falta poco para que expire el token
+AUTH_REVALIDATE_INTERVAL = float(os.getenv("WEB_AUTH_REVALIDATE_INTERVAL", "300"))
+AUTH_EXPIRY_MARGIN = float(os.getenv("WEB_AUTH_EXPIRY_MARGIN", "60"))
+
+auth_stats = {"validations": 0, "saved": 0}
+auth_stats_lock = threading.Lock()
+
+def count_auth(kind):
+    with auth_stats_lock:
+        auth_stats[kind] += 1
+
+class RenderCache:
+    """Filas de tabla ya renderizadas por URL del servicio, acotadas por bytes (LRU).
+
+    Cada entrada guarda la ETag con la que el servicio devolvió los datos; mientras
+    el servicio responda 304 a esa ETag se sirve el HTML guardado sin volver a
+    descargar ni renderizar el listado.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_served = 0
+        self.not_modified = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        if entry['size'] > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old['size']
+            self._entries[key] = entry
+            self.bytes += entry['size']
+            while self.bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted['size']
+                self.evictions += 1
+
+    def count_hit(self, entry):
+        with self._lock:
+            self.hits += 1
+            self.bytes_served += entry['size']
+
+    def count_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def count_not_modified(self):
+        with self._lock:
+            self.not_modified += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "bytes_served": self.bytes_served,
+                "browser_not_modified": self.not_modified,
+            }
+
+render_cache = RenderCache(int(os.getenv("WEB_RENDER_CACHE_MAX_BYTES", str(8 * 1024 * 1024))))
+
+def validate_session_token():
+    # Devuelve True si la sesión tiene un token válido
+    token = session.get('token')
+    if not token:
+        return False
+    now = time.time()
+    cached = session.get('auth')
+    if cached and cached.get('token_id') == token[-16:]:
+        if now >= cached['exp']:
+            return False
+        if now - cached['checked_at'] < AUTH_REVALIDATE_INTERVAL and cached['exp'] - now > AUTH_EXPIRY_MARGIN:
+            count_auth("saved")
+            return True
+
+    count_auth("validations")
+    try:
+        claims = token_verifier.verify(token)
+    except InvalidTokenError:
+        return False
+    session['auth'] = {
+        'sub': claims['sub'],
+        'exp': claims['exp'],
+        'checked_at': now,
+        # Para detectar que la sesión cambió de token sin guardar el token dos veces
+        'token_id': token[-16:],
+    }
+    return True
+
+def page_request(*filter_names):
+    # Parámetros para el servicio (tamaño de página, cursor y filtros) y filtros activos para los enlaces
+    filters = {name: request.args[name] for name in filter_names if request.args.get(name)}
+    params = {'limit': PAGE_SIZE, **filters}
+    if request.args.get('cursor'):
+        params['cursor'] = request.args['cursor']
+    return params, filters
+
+def render_list(url, params, template, headers=None):
+    # Filas del listado renderizadas con `template`, reutilizando las ya guardadas si el
+    # servicio confirma con 304 que los datos no cambiaron. Devuelve None si el servicio falla
+    key = (url, tuple(sorted(params.items())))
+    cached = render_cache.get(key)
+    request_headers = dict(headers or {})
+    if cached:
+        request_headers['If-None-Match'] = cached['etag']
+    response = http.get(url, params=params, headers=request_headers, timeout=TIMEOUT)
+    if response.status_code == 304 and cached:
+        render_cache.count_hit(cached)
+        return cached
+    if response.status_code != 200:
+        return None
+
+    render_cache.count_miss()
+    html = render_template(template, items=response.json())
+    listing = {
+        'rows': Markup(html),
+        'etag': response.headers.get('ETag'),
+        'next_cursor': response.headers.get('X-Next-Cursor'),
+        'total': response.headers.get('X-Total-Count'),
+        'size': len(html.encode()),
+    }
+    if listing['etag']:
+        render_cache.set(key, listing)
+    return listing
+
+def render_listing_page(template, listing, filters):
+    # Página completa con ETag propia: misma URL, mismos datos y mismo usuario dan la misma página.
+    # Con mensajes flash pendientes la página es única y no se marca
+    response = None
+    etag = None
+    if listing['etag'] and not session.get('_flashes'):
+        user = session.get('auth', {}).get('sub', '')
+        etag = hashlib.sha1(f"{request.full_path}|{listing['etag']}|{user}".encode()).hexdigest()
+        if request.if_none_match.contains(etag):
+            # El navegador ya tiene esta página: no se renderiza nada
+            render_cache.count_not_modified()
+            response = make_response('', 304)
+    if response is None:
+        response = make_response(render_template(
+            template,
+            rows=listing['rows'],
+            next_cursor=listing['next_cursor'],
+            total=listing['total'],
+            filters=filters,
+        ))
+    if etag:
+        response.set_etag(etag)
+    # private: la página depende de la sesión; no-cache: el navegador siempre revalida
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def fetch_all(url, params=None, headers=None, deadline=None):
+    # Para los selectores del formulario: recorre todas las páginas del listado.
+    # Con deadline (time.monotonic()) deja de pedir páginas al agotarse el tiempo y devuelve None;
+    # cada petición espera como mucho lo que queda, así el hilo no sigue trabajando mucho después
+    params = {**(params or {}), 'limit': 500}
+    items = []
+    for _ in range(FETCH_ALL_MAX_PAGES):
+        timeout = TIMEOUT
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            timeout = (min(TIMEOUT[0], remaining), min(TIMEOUT[1], remaining))
+        response = http.get(url, params=params, headers=headers, timeout=timeout)
+        if response.status_code != 200:
+            return None
+        items.extend(response.json())
+        next_cursor = response.headers.get('X-Next-Cursor')
+        if not next_cursor:
+            return items
+        params['cursor'] = next_cursor
+    app.logger.warning(f'{url} tiene más de {FETCH_ALL_MAX_PAGES} páginas; se omite el resto')
+    return items
+
+def fetch_concurrently(**calls):
+    # Lanza las consultas independientes a la vez; la página tarda lo que la más lenta y no la suma.
+    # Las que fallan o no terminan dentro de PAGE_BUDGET devuelven None para que la página se degrade.
+    # cancel() solo evita las que aún no empezaron: una consulta en curso sigue ocupando su hilo
+    # hasta terminar, por eso cada llamada debe acotar su propio trabajo (ver deadline en fetch_all)
+    futures = {name: fetch_executor.submit(call) for name, call in calls.items()}
+    wait(futures.values(), timeout=PAGE_BUDGET)
+    results = {}
+    for name, future in futures.items():
+        if not future.done():
+            future.cancel()
+            app.logger.warning(f'Consulta {name} sin respuesta tras {PAGE_BUDGET}s')
+            results[name] = None
+        elif future.exception() is not None:
+            app.logger.warning(f'Consulta {name} falló: {future.exception()}')
+            results[name] = None
+        else:
+            results[name] = future.result()
+    return results
 
 def login_required(f):
     @wraps(f)
@@ -22,14 +271,8 @@ def login_required(f):
         if 'token' not in session:
             return redirect(url_for('login'))
         
-        # Validate token
-        headers = {'Authorization': f'Bearer {session["token"]}'}
-        try:
-            response = requests.get(f"{AUTH_SERVICE_URL}/validate-token", headers=headers)
-            if response.status_code != 200:
-                session.clear()
-                return redirect(url_for('login'))
-        except:
+        # Validate token (desde la sesión mientras siga siendo reciente)
+        if not validate_session_token():
             session.clear()
             return redirect(url_for('login'))
             
@@ -51,10 +294,11 @@ def login():
         try:
             print(f"Enviando solicitud a {AUTH_SERVICE_URL}/token")
             # Usar application/x-www-form-urlencoded como espera FastAPI
-            response = requests.post(
+            response = http.post(
                 f"{AUTH_SERVICE_URL}/token",
                 data={"username": username, "password": password},
-                headers={"Content-Type": "application/x-www-form-urlencoded"}
+                headers={"Content-Type": "application/x-www-form-urlencoded"},
+                timeout=TIMEOUT
             )
             print(f"Respuesta recibida - Status Code: {response.status_code}")
             print(f"Respuesta headers: {response.headers}")
@@ -75,6 +319,12 @@ def login():
             
     return render_template('login.html')
 
+@app.route('/metrics')
+def metrics():
+    with auth_stats_lock:
+        auth = dict(auth_stats)
+    return jsonify({"auth": auth, "render_cache": render_cache.stats()})
+
 @app.route('/logout')
 def logout():
     session.clear()
@@ -84,12 +334,14 @@ def logout():
 @login_required
 def resources():
     try:
-        response = requests.get(f"{RESOURCE_SERVICE_URL}/resources/")
-        resources = response.json() if response.status_code == 200 else []
-        return render_template('resources.html', resources=resources)
+        params, filters = page_request('type', 'status')
+        listing = render_list(f"{RESOURCE_SERVICE_URL}/resources/", params, '_resources_rows.html')
+        if listing is None:
+            return render_template('resources.html', rows='', filters=filters)
+        return render_listing_page('resources.html', listing, filters)
     except:
         flash('Error al obtener recursos', 'error')
-        return render_template('resources.html', resources=[])
+        return render_template('resources.html', rows='', filters={})
 
 @app.route('/resources/add', methods=['GET', 'POST'])
 @login_required
@@ -104,9 +356,10 @@ def add_resource():
                 'status': 'disponible'
             }
             
-            response = requests.post(
+            response = http.post(
                 f"{RESOURCE_SERVICE_URL}/resources/",
-                json=data
+                json=data,
+                timeout=TIMEOUT
             )
             
             if response.status_code == 200:
@@ -127,15 +380,14 @@ def add_resource():
 def students():
     try:
         headers = {'Authorization': f'Bearer {session["token"]}'}
-        response = requests.get(
-            f"{STUDENT_SERVICE_URL}/students/",
-            headers=headers
-        )
-        students = response.json() if response.status_code == 200 else []
-        return render_template('students.html', students=students)
+        params, filters = page_request('career')
+        listing = render_list(f"{STUDENT_SERVICE_URL}/students/", params, '_students_rows.html', headers=headers)
+        if listing is None:
+            return render_template('students.html', rows='', filters=filters)
+        return render_listing_page('students.html', listing, filters)
     except:
         flash('Error al obtener estudiantes', 'error')
-        return render_template('students.html', students=[])
+        return render_template('students.html', rows='', filters={})
 
 @app.route('/students/add', methods=['GET', 'POST'])
 @login_required
@@ -157,9 +409,10 @@ def add_student():
                 flash('Todos los campos son requeridos', 'error')
                 return render_template('add_student.html')
             
-            response = requests.post(
+            response = http.post(
                 f"{STUDENT_SERVICE_URL}/students/",
-                json=data
+                json=data,
+                timeout=TIMEOUT
             )
             
             if response.status_code == 200:
@@ -182,54 +435,18 @@ def add_student():
 def loans():
     try:
         headers = {'Authorization': f'Bearer {session["token"]}'}
+        params, filters = page_request('status', 'student_id')
         
-        # Obtener préstamos
-        response = requests.get(
-            f'{LOAN_SERVICE_URL}/loans/',
-            headers=headers
-        )
-        if response.status_code != 200:
+        # Una sola consulta: el servicio de préstamos ya devuelve los nombres de recurso y estudiante
+        listing = render_list(f'{LOAN_SERVICE_URL}/loans/view', params, '_loans_rows.html', headers=headers)
+        if listing is None:
             flash('Error al obtener préstamos', 'error')
-            return render_template('loans.html', loans=[], resources={}, students={})
-        loans = response.json()
-        
-        # Obtener recursos
-        response_resources = requests.get(
-            f'{RESOURCE_SERVICE_URL}/resources/',
-            headers=headers
-        )
-        if response_resources.status_code != 200:
-            flash('Error al obtener recursos', 'error')
-            return render_template('loans.html', loans=[], resources={}, students={})
-        
-        # Crear diccionario de recursos usando id como clave
-        resources = {}
-        for resource in response_resources.json():
-            resources[str(resource['id'])] = resource
-        
-        # Obtener estudiantes
-        response_students = requests.get(
-            f'{STUDENT_SERVICE_URL}/students/',
-            headers=headers
-        )
-        if response_students.status_code != 200:
-            flash('Error al obtener estudiantes', 'error')
-            return render_template('loans.html', loans=[], resources={}, students={})
-            
-        # Crear diccionario de estudiantes usando student_id como clave
-        students = {}
-        for student in response_students.json():
-            students[student['student_id']] = student
+            return render_template('loans.html', rows='', filters=filters)
         
-        # Debug: imprimir información
-        print("Loans:", loans)
-        print("Resources:", resources)
-        print("Students:", students)
-        
-        return render_template('loans.html', loans=loans, resources=resources, students=students)
+        return render_listing_page('loans.html', listing, filters)
     except Exception as e:
         flash(f'Error al cargar los préstamos: {str(e)}', 'error')
-        return render_template('loans.html', loans=[], resources={}, students={})
+        return render_template('loans.html', rows='', filters={})
 
 @app.route('/loans/<int:loan_id>/return', methods=['POST'])
 @login_required
@@ -237,9 +454,10 @@ def return_loan(loan_id):
     try:
         headers = {'Authorization': f'Bearer {session["token"]}'}
         # Obtener el préstamo actual
-        response = requests.get(
+        response = http.get(
             f'{LOAN_SERVICE_URL}/loans/{loan_id}',
-            headers=headers
+            headers=headers,
+            timeout=TIMEOUT
         )
         if response.status_code == 404:
             flash('Préstamo no encontrado', 'error')
@@ -252,17 +470,19 @@ def return_loan(loan_id):
         loan['return_date'] = datetime.now().isoformat()
         
         # Enviar actualización al servicio de préstamos
-        response = requests.put(
+        response = http.put(
             f'{LOAN_SERVICE_URL}/loans/{loan_id}',
             json=loan,
-            headers=headers
+            headers=headers,
+            timeout=TIMEOUT
         )
         if response.status_code == 200:
             # Actualizar el estado del recurso a disponible
-            resource_response = requests.put(
+            resource_response = http.put(
                 f'{RESOURCE_SERVICE_URL}/resources/{loan["resource_id"]}/status',
                 json={"status": "disponible"},
-                headers=headers
+                headers=headers,
+                timeout=TIMEOUT
             )
             if resource_response.status_code == 200:
                 flash('Recurso devuelto exitosamente', 'success')
@@ -296,34 +516,11 @@ def create_loan():
                 'quantity': quantity
             }
             
-            # Primero verificamos que el recurso esté disponible
-            resource_response = requests.get(
-                f"{RESOURCE_SERVICE_URL}/resources/{data['resource_id']}"
-            )
-            
-            if resource_response.status_code != 200:
-                flash('Error: El recurso seleccionado no existe', 'error')
-                return redirect(url_for('create_loan'))
-                
-            resource = resource_response.json()
-            available_quantity = resource['quantity'] - resource['loaned_quantity']
-            if available_quantity < quantity:
-                flash(f'Error: Solo hay {available_quantity} unidades disponibles', 'error')
-                return redirect(url_for('create_loan'))
-            
-            # Verificamos que el estudiante exista
-            student_response = requests.get(
-                f"{STUDENT_SERVICE_URL}/students/by-student-id/{data['student_id']}"
-            )
-            
-            if student_response.status_code != 200:
-                flash('Error: El estudiante seleccionado no existe', 'error')
-                return redirect(url_for('create_loan'))
-            
-            # Creamos el préstamo
-            response = requests.post(
+            # Creamos el préstamo (el servicio de préstamos ya valida estudiante y disponibilidad)
+            response = http.post(
                 f"{LOAN_SERVICE_URL}/loans/",
-                json=data
+                json=data,
+                timeout=TIMEOUT
             )
             
             if response.status_code == 200:
@@ -342,36 +539,23 @@ def create_loan():
             app.logger.error(f'Error inesperado: {str(e)}')
             flash('Error inesperado. Por favor intente más tarde.', 'error')
     
-    # Get available resources and students for the form
-    try:
-        resources_response = requests.get(f"{RESOURCE_SERVICE_URL}/resources/")
-        students_response = requests.get(f"{STUDENT_SERVICE_URL}/students/")
-        
-        if resources_response.status_code != 200:
-            flash('Error al obtener recursos', 'error')
-            return render_template('create_loan.html', resources=[], students=[])
-            
-        if students_response.status_code != 200:
-            flash('Error al obtener estudiantes', 'error')
-            return render_template('create_loan.html', resources=[], students=[])
-        
-        resources = resources_response.json()
-        students = students_response.json()
-        
-        # Filter resources that have available units
-        available_resources = [r for r in resources if r.get('quantity', 0) > r.get('loaned_quantity', 0)]
-        
-        return render_template('create_loan.html',
-                             resources=available_resources,
-                             students=students)
-    except requests.RequestException as e:
-        app.logger.error(f'Error de conexión: {str(e)}')
-        flash('Error al conectar con los servicios. Por favor intente más tarde.', 'error')
-    except Exception as e:
-        app.logger.error(f'Error inesperado: {str(e)}')
-        flash('Error inesperado al cargar el formulario', 'error')
+    # Recursos y estudiantes para el formulario: son independientes, se piden a la vez
+    deadline = time.monotonic() + PAGE_BUDGET
+    data = fetch_concurrently(
+        # Solo recursos con unidades disponibles, filtrados en el servicio
+        resources=lambda: fetch_all(f"{RESOURCE_SERVICE_URL}/resources/", params={'available': 'true'}, deadline=deadline),
+        students=lambda: fetch_all(f"{STUDENT_SERVICE_URL}/students/", deadline=deadline)
+    )
+    
+    # Si un servicio falla se muestra lo que sí llegó en lugar de vaciar el formulario
+    if data['resources'] is None:
+        flash('Error al obtener recursos', 'error')
+    if data['students'] is None:
+        flash('Error al obtener estudiantes', 'error')
     
-    return render_template('create_loan.html', resources=[], students=[])
+    return render_template('create_loan.html',
+                         resources=data['resources'] or [],
+                         students=data['students'] or [])
 
 @app.route('/loans/<int:loan_id>/devolver', methods=['POST'])
 @login_required
@@ -380,17 +564,19 @@ def devolver_recurso(loan_id):
         headers = {'Authorization': f'Bearer {session["token"]}'}
 
         # Usar el endpoint específico para devolver préstamos
-        response = requests.put(
+        response = http.put(
             f'{LOAN_SERVICE_URL}/loans/{loan_id}/return',
-            headers=headers
+            headers=headers,
+            timeout=TIMEOUT
         )
 
         if response.status_code != 200:
             # Si falla la actualización del préstamo, intentar revertir el estado del recurso
-            requests.put(
+            http.put(
                 f'{RESOURCE_SERVICE_URL}/resources/{resource_id}/status',
                 json={"status": "prestado"},
-                headers=headers
+                headers=headers,
+                timeout=TIMEOUT
             )
             flash('Error al actualizar el préstamo', 'error')
             return redirect(url_for('loans'))
@@ -407,9 +593,10 @@ def devolver_recurso(loan_id):
 def student_loans(student_id):
     try:
         headers = {'Authorization': f'Bearer {session["token"]}'}
-        response = requests.get(
+        response = http.get(
             f"{LOAN_SERVICE_URL}/loans/student/{student_id}",
-            headers=headers
+            headers=headers,
+            timeout=TIMEOUT
         )
         loans = response.json() if response.status_code == 200 else []
         return render_template('student_loans.html', loans=loans, student_id=student_id)